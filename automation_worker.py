@@ -1,21 +1,18 @@
 import os
-<<<<<<< HEAD
 import sys
 from dotenv import load_dotenv
 
 # 1. LOAD ENV IMMEDIATELY
 load_dotenv()
 
-=======
->>>>>>> d06dac19010c3e2f3fff8aa92dad6ccd137cd9b7
 import asyncio
 import logging
 import sqlite3
 import json
-<<<<<<< HEAD
 import time
-import random
-import subprocess
+import hashlib
+import httpx
+import aiofiles
 from pathlib import Path
 
 # Import our modular tools and utils
@@ -27,15 +24,41 @@ from mcp_core.utils import gitlab_automation as git_service
 from mcp_core.services.llm_coder import LLMCoder
 from mcp_core.services.repo_search import RepoSearch
 from mcp_core.services.router_cache import RouterCache
-from mcp_core.utils.validator import validate_code
+from mcp_core.services.job_queue import JobQueue, DEBOUNCE_WINDOW
+from mcp_core.services.frame_fingerprints import FrameFingerprintStore
+from mcp_core.services.pipeline_spans import span, span_recorder, current_event_id, current_frame_id
+from mcp_core.services.figma_stream import FrameSpool, STREAM_FRAMES, ijson_available, streaming_enabled
+from mcp_core.services.image_prep import PreparedImage, prepare_image
+from mcp_core.utils.validator import check_code
+from mcp_core.utils.formatter import format_code
+from mcp_core.utils.atomic_write import write_text_atomic
+from mcp_core.services import cassette
 
 # Config
 # DB_PATH: Ye wo file hai jahan hum events save karte hain taake duplicate kaam na ho.
 DB_PATH = Path(__file__).parent / "events.db"
-# BASE_POLL_INTERVAL: Worker har 2 second baad check karega ke koi naya kaam hai ya nahi.
-BASE_POLL_INTERVAL = 2  # Check frequently for debounce readiness
 # DEBOUNCE_WINDOW: Agar Figma mein jaldi jaldi changes ho rahi hain, to hum 30 seconds wait karte hain taake saari changes ek saath process hon.
-DEBOUNCE_WINDOW = 30    # Seconds
+# Ye ab database mein har event ke `due_at` column se enforce hota hai (job_queue.DEBOUNCE_WINDOW, env se configurable).
+# EVENT_STREAM_URL: Webhook server ka push stream. Naya event commit hote hi yahan se foran khabar milti hai.
+EVENT_STREAM_URL = os.getenv("EVENT_STREAM_URL", "http://localhost:8000/events/stream")
+# FALLBACK_POLL_INTERVAL: Agar stream toot jaye to hum purane tareeqe se har 5 second database check karte hain.
+FALLBACK_POLL_INTERVAL = 5
+# STREAM_SAFETY_POLL_INTERVAL: Stream chal raha ho tab bhi kabhi kabhi DB check karo (scripts seedha DB mein likhte hain).
+STREAM_SAFETY_POLL_INTERVAL = 60
+# FIGMA_POLL_INTERVAL: DEMO mode mein change ke foran baad Figma version kitni jaldi check karna hai.
+FIGMA_POLL_INTERVAL = 5
+# FIGMA_POLL_MAX_INTERVAL: File idle ho to interval double hota rehta hai, is had tak.
+FIGMA_POLL_MAX_INTERVAL = float(os.getenv("FIGMA_POLL_MAX_INTERVAL", "120"))
+# FRAME_CONCURRENCY: Ek page ke kitne frames ek saath process ho sakte hain (LLM round-trips parallel).
+FRAME_CONCURRENCY = int(os.getenv("FRAME_CONCURRENCY", "4"))
+# CLAIM_BATCH_SIZE: Ek tick mein kitne events lease karne hain. Chhota rakho taake N workers mein kaam barabar bate.
+CLAIM_BATCH_SIZE = int(os.getenv("WORKER_CLAIM_BATCH", "4"))
+# STUCK_SWEEP_INTERVAL: Har itne seconds baad phanse hue (stuck) events dhoondo, chahe tick lamba chal raha ho.
+STUCK_SWEEP_INTERVAL = float(os.getenv("WORKER_SWEEP_INTERVAL", "60"))
+# FIGMA_FETCH_DEPTH: Figma node tree kitni gehrai tak mangwana hai.
+FIGMA_FETCH_DEPTH = 5
+# VOLATILE_FRAME_KEYS: Ye fields design badle baghair bhi badal jati hain (render bounds, plugin data), fingerprint mein shamil nahi.
+VOLATILE_FRAME_KEYS = {"absoluteRenderBounds", "pluginData", "sharedPluginData"}
 
 # Windows Console Fix: Force UTF-8
 # Windows mein kabhi kabhi printing mein masla hota hai (encoding issues), ye code usay fix karta hai taake emojis aur special characters sahi nazar ayen.
@@ -231,7 +254,60 @@ def extract_top_level_frames(document_node: dict) -> list:
     logger.info(f"📋 Found {len(frames)} top-level frames: {[f.get('name') for f in frames]}")
     return frames
 
-async def process_pipeline(ctx: ToolContext, event: dict, node_id: str, coder: LLMCoder, router_cache: RouterCache, search_engine: RepoSearch, project_root: str) -> bool:
+def canonical_frame_hash(frame_node: dict) -> str:
+    """
+    Content-addressed fingerprint of a frame subtree.
+
+    Frame ka poora JSON sorted keys ke saath hash hota hai, volatile fields hata kar.
+    `absoluteBoundingBox` ko frame ke origin ke relative kar dete hain, taake canvas par frame
+    sirf move karne se fingerprint na badle. Same design = same hash = dobara generate karne ki zaroorat nahi.
+    """
+    origin = frame_node.get("absoluteBoundingBox") or {}
+    origin_x, origin_y = origin.get("x", 0), origin.get("y", 0)
+
+    def canonical(value):
+        if isinstance(value, dict):
+            result = {}
+            for key, item in value.items():
+                if key in VOLATILE_FRAME_KEYS:
+                    continue
+                if key == "absoluteBoundingBox" and isinstance(item, dict):
+                    item = dict(item, x=item.get("x", 0) - origin_x, y=item.get("y", 0) - origin_y)
+                result[key] = canonical(item)
+            return result
+        if isinstance(value, list):
+            return [canonical(item) for item in value]
+        return value
+
+    blob = json.dumps(canonical(frame_node), sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def is_explicit_request(event: dict) -> bool:
+    """
+    Designer ne khud `!sync`/`!generate` comment kiya hai: frame same ho tab bhi dobara generate karna hai,
+    is liye fingerprint skip in events par nahi lagta.
+    """
+    return event.get("event_type") == "TARGETED_SYNC" or event.get("lane") == "targeted"
+
+
+async def frame_is_unchanged(fingerprints: FrameFingerprintStore, file_key: str, node_id: str, fingerprint: str, project_root: str) -> bool:
+    """
+    Pichli kamyab run ka fingerprint match kare (aur DEMO mode mein output file abhi bhi mojood ho) to True.
+    """
+    try:
+        previous = await fingerprints.get(file_key, node_id)
+    except Exception as e:
+        logger.warning(f"⚠️ Fingerprint lookup failed (regenerating): {e}")
+        return False
+    if not previous or previous["fingerprint"] != fingerprint:
+        return False
+    if DEMO_MODE and not (previous["output_path"] and os.path.exists(os.path.join(project_root, previous["output_path"]))):
+        return False
+    return True
+
+
+async def process_pipeline(ctx: ToolContext, event: dict, node_id: str, coder: LLMCoder, router_cache: RouterCache, search_engine: RepoSearch, project_root: str, fingerprints: FrameFingerprintStore = None) -> bool:
     """
     Explicitly process a single 'Ready' event. Handles multi-frame files.
     
@@ -249,13 +325,25 @@ async def process_pipeline(ctx: ToolContext, event: dict, node_id: str, coder: L
         # 1. Fetch design pattern from Figma
         # Figma API se design ka data mangwao.
         has_specific_node = ":" in node_id
-        pattern_result = await figma.fetch_figma_pattern(ctx, {"file_key": file_key, "node_ids": [node_id] if has_specific_node else [], "depth": 5})
+        if not has_specific_node and streaming_enabled():
+            # Poori file: document stream ho kar parse hota hai, sirf frames disk spool mein jate hain
+            return await process_streamed_file(ctx, event, coder, router_cache, search_engine, project_root, fingerprints)
+        # Poll events version saath laate hain: us version ka result node cache mein ho to network call nahi hoti
+        version = event.get("payload", {}).get("version")
+        with span("figma_fetch") as fetch_span:
+            pattern_result = await figma.fetch_figma_pattern(ctx, {"file_key": file_key, "node_ids": [node_id] if has_specific_node else [], "depth": FIGMA_FETCH_DEPTH, "version": version})
+            if not pattern_result.get("nodes"):
+                fetch_span.outcome = "empty"
+            elif pattern_result.get("cached"):
+                fetch_span.outcome = "cache_hit"
         
         if not pattern_result.get("nodes"):
             logger.warning(f"⚠️ No nodes found for {file_key}, skipping.")
             return True 
         
         root_node = pattern_result["nodes"][0]
+        # Images (render + download) isi version ke hisab se memory mein rakhi jati hain
+        version = pattern_result.get("version") or version
         
         # 2. MULTI-FRAME HANDLING: If we got the Document root, extract all frames
         # Agar humein koi specific node nahi di gayi, to hum samajhte hain ke shayed puri file process karni hai.
@@ -266,36 +354,221 @@ async def process_pipeline(ctx: ToolContext, event: dict, node_id: str, coder: L
                 logger.warning(f"⚠️ No FRAME nodes found in {file_name}, skipping.")
                 return True
             
-            # Process each frame
-            # Har frame ke liye alag process chalao.
-            all_success = True
-            for frame in frames:
-                frame_name = frame.get("name", "Unknown")
-                logger.info(f"🎯 Processing frame: {frame_name}")
-                success = await process_single_frame(ctx, event, frame, coder, router_cache, search_engine, project_root)
-                if not success:
-                    all_success = False
-            return all_success
+            # Process frames concurrently (bounded by FRAME_CONCURRENCY)
+            # Har frame ke liye alag process chalao, lekin ek waqt mein sirf N.
+            return await process_frames_concurrently(ctx, event, frames, coder, router_cache, search_engine, project_root, fingerprints=fingerprints, version=version)
         else:
             # Single frame mode (specific node_id provided)
             # Agar specific node ID thi, to bas usi ek ko process karo.
-            return await process_single_frame(ctx, event, root_node, coder, router_cache, search_engine, project_root)
+            return await process_single_frame(ctx, event, root_node, coder, router_cache, search_engine, project_root, fingerprints, version)
             
     except Exception as e:
-        logger.error(f"Pipeline error: {e}")
-        import traceback
-        traceback.print_exc()
-        return True  # Mark as processed to avoid requeue (taake worker stuck na ho)
+        # Figma 5xx, Gemini error waghaira: process_tick event ko backoff ke saath retry (ya dead_letter) karta hai
+        logger.exception(f"Pipeline error: {e}")
+        raise
+
+
+async def process_streamed_file(ctx: ToolContext, event: dict, coder: LLMCoder, router_cache: RouterCache, search_engine: RepoSearch, project_root: str, fingerprints: FrameFingerprintStore = None) -> bool:
+    """
+    Whole-file sync for large documents.
+    
+    Poora `/v1/files` JSON memory mein load karne ke bajaye response aate aate parse hota hai (ijson):
+    har top-level FRAME ek ek kar ke ban'ta hai aur FrameSpool (temp file) mein chala jata hai, baaki document
+    wahin chhor diya jata hai. Phir frames spool se sirf apni baari par parhe jate hain, is liye worker ki memory
+    file ke size se nahi, sirf chal rahe frames se barhti hai.
+    """
+    file_key = event["file_key"]
+    with span("figma_fetch") as fetch_span:
+        spool = await figma.stream_file_frames(ctx, file_key, FIGMA_FETCH_DEPTH, fingerprint=canonical_frame_hash)
+        fetch_span.bytes_out = spool.bytes
+        if not len(spool):
+            fetch_span.outcome = "empty"
+    try:
+        if not len(spool):
+            logger.warning(f"⚠️ No FRAME nodes found in {event['file_name']}, skipping.")
+            return True
+        logger.info(f"📋 Found {len(spool)} top-level frames: {[entry.get('name') for entry in spool.entries]}")
+        return await process_frames_concurrently(ctx, event, spool, coder, router_cache, search_engine, project_root,
+                                                 fingerprints=fingerprints, version=spool.meta.get("version"))
+    finally:
+        spool.close()
+
+
+def frame_entries(frames) -> list:
+    """Har frame ka id, naam aur fingerprint (spool mein ye parse ke waqt hi ban jate hain)."""
+    if isinstance(frames, FrameSpool):
+        return frames.entries
+    return [{"id": frame.get("id"), "name": frame.get("name"), "fingerprint": canonical_frame_hash(frame)} for frame in frames]
+
+
+async def load_frame(frames, index: int) -> dict:
+    # Spool wale frames disk par hain: parhna thread mein, taake loop na ruke
+    if isinstance(frames, FrameSpool):
+        return await asyncio.to_thread(frames.__getitem__, index)
+    return frames[index]
 
 
-async def process_single_frame(ctx: ToolContext, event: dict, frame_node: dict, coder: LLMCoder, router_cache: RouterCache, search_engine: RepoSearch, project_root: str) -> bool:
+async def process_frames_concurrently(ctx: ToolContext, event: dict, frames: list, coder: LLMCoder, router_cache: RouterCache, search_engine: RepoSearch, project_root: str, concurrency: int = FRAME_CONCURRENCY, fingerprints: FrameFingerprintStore = None, version: str = None) -> bool:
+    """
+    Bounded concurrent frame executor.
+    
+    Saare frames ek saath start hote hain lekin Semaphore ki wajah se sirf `concurrency` frames
+    ek waqt mein chalte hain. Ek frame fail (ya crash) ho jaye to baaki frames chalte rehte hain;
+    aakhir mein sab ka result mila kar overall success banta hai.
+    20 frames aur N=4 ho to ~ceil(20/4) = 5 LLM round-trips ka waqt lagta hai.
+    Badle hue frames ki images pehle hi ek render call se mangwa li jati hain (prefetch_vision_images).
+    `frames` list bhi ho sakti hai ya FrameSpool; frame apni baari aane par hi load hota hai.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    entries = frame_entries(frames)
+    # !sync par har frame generate hota hai, to sab ki images chahiye (fingerprint filter nahi)
+    prefetch_fingerprints = None if is_explicit_request(event) else fingerprints
+    await prefetch_vision_images(ctx, event.get("file_key"), version, entries, project_root, prefetch_fingerprints)
+
+    async def run_frame(index: int) -> bool:
+        frame_name = entries[index].get("name") or "Unknown"
+        async with semaphore:
+            logger.info(f"🎯 Processing frame: {frame_name}")
+            try:
+                frame = await load_frame(frames, index)
+                return await process_single_frame(ctx, event, frame, coder, router_cache, search_engine, project_root, fingerprints, version)
+            except Exception as e:
+                # Failure isolation: ek frame ka crash poore page ko nahi girata.
+                logger.error(f"💥 Frame '{frame_name}' crashed: {e}")
+                return False
+
+    results = await asyncio.gather(*(run_frame(index) for index in range(len(entries))))
+
+    failed = [entry.get("name") or "Unknown" for entry, ok in zip(entries, results) if not ok]
+    if failed:
+        logger.warning(f"⚠️ {len(failed)}/{len(frames)} frames failed: {failed}")
+    else:
+        logger.info(f"✅ All {len(frames)} frames processed.")
+    return not failed
+
+
+async def prefetch_vision_images(ctx: ToolContext, file_key: str, version: str, entries: list, project_root: str, fingerprints: FrameFingerprintStore = None):
+    """
+    Page ke saare badle hue frames ki images ek hi `/v1/images` render call se, aur downloads ek saath (connection cap ke saath).
+    Ye background mein chalta hai; har frame `fetch_vision_image` mein apni image ka intezar karta hai jo aksar pehle hi aa chuki hoti hai.
+    Unchanged frames (fingerprint hit) skip honge, un ki image render nahi karwate.
+    """
+    async def changed(entry: dict) -> bool:
+        if not fingerprints or not entry.get("id"):
+            return True
+        return not await frame_is_unchanged(fingerprints, file_key, entry["id"], entry["fingerprint"], project_root)
+
+    # Version ke baghair images store mein nahi rakhi jatin, to frames prefetch ki hui image dhoond hi nahi sakte
+    # aur har image do baar mangwai jati. Aise mein har frame apni image khud mangwata hai.
+    if not file_key or not version:
+        return
+    try:
+        flags = await asyncio.gather(*(changed(entry) for entry in entries))
+        node_ids = [entry["id"] for entry, flag in zip(entries, flags) if flag and entry.get("id")]
+        if node_ids:
+            figma.prefetch_frame_images(ctx, file_key, version, node_ids)
+    except Exception as e:
+        # Prefetch sirf speed ke liye hai; fail ho to har frame apni image khud mangwa leta hai
+        logger.warning(f"⚠️ Vision image prefetch failed: {e}")
+
+
+async def fetch_vision_image(ctx: ToolContext, file_key: str, node_id: str, version: str = None) -> PreparedImage:
+    """
+    Vision Context: Design ki image, memory mein, prompt ke liye choti ki hui (image_prep). Fail ho to None.
+    Prefetch ho chuki ho to foran milti hai, warna abhi mangwai jati hai.
+    """
+    try:
+        with span("image_download") as image_span:
+            image_data = await figma.get_frame_image(ctx, file_key, version, node_id)
+            if not image_data:
+                image_span.outcome = "missing"
+                return None
+            image_span.bytes_out = len(image_data)
+    except Exception as e:
+        logger.warning(f"⚠️ Failed to fetch vision image: {e}")
+        return None
+
+    # Decode/resize CPU ka kaam hai, is liye thread mein, taake baaki frames ka loop na ruke.
+    # bytes_in/bytes_out se pata chalta hai image kitni choti hui.
+    with span("image_prep", bytes_in=len(image_data)) as prep_span:
+        image = await asyncio.to_thread(prepare_image, image_data)
+        prep_span.bytes_out = len(image.data)
+        prep_span.outcome = "skipped" if image.outcome == "skipped" else "ok"
+        prep_span.detail = image.describe()
+    logger.info(f"👁️ Vision image captured for {node_id} ({image.original_bytes} -> {len(image.data)} bytes, {image.describe()})")
+    return image
+
+
+async def load_project_context() -> str:
+    # Project ka context (tailwind config, etc) load karo. Disk read thread mein, taake loop na ruke.
+    with span("project_context") as context_span:
+        project_context = await asyncio.to_thread(get_project_context)
+        context_span.bytes_out = len(project_context)
+    return project_context
+
+
+async def read_rag_example(project_root: str, rel_path: str) -> str:
+    full_path = os.path.join(project_root, rel_path)
+    try:
+        async with aiofiles.open(full_path, "r", encoding="utf-8") as f:
+            # Sirf shuru ke 2000 characters bhejte hain taake context limit cross na ho.
+            content = await f.read(2000)
+    except Exception:
+        return ""
+    return f"\n--- START EXAMPLE: {rel_path} ---\n{content}\n--- END EXAMPLE ---\n"
+
+
+async def build_rag_context(frame_node: dict, comp_name: str, search_engine: RepoSearch, project_root: str) -> str:
+    """
+    RAG ka matlab hai 'Retrieval Augmented Generation'. Hum AI ko purana code dikhate hain.
+    Vector search thread mein chalti hai aur example files async I/O se ek saath parhi jati hain.
+    """
+    rag_context = ""
+    try:
+        with span("rag") as rag_span:
+            design_text = extract_text_from_figma(frame_node)
+            if len(design_text) > 20: # Agar design mein kafi text hai tabhi search karo.
+                logger.info(f"🔍 RAG: Searching for components similar to '{comp_name}'...")
+                similar_files = await asyncio.to_thread(search_engine.search, query=design_text, limit=3)
+                
+                if similar_files:
+                    logger.info(f"    Found {len(similar_files)} matches: {similar_files}")
+                    examples = await asyncio.gather(*(read_rag_example(project_root, rel_path) for rel_path in similar_files))
+                    rag_context = "\n### SIMILAR CODEBASE EXAMPLES (REFERENCE ONLY):\n" + "".join(examples)
+                    logger.info(f"📖 RAG: Injected {len(rag_context)} chars of context.")
+            else:
+                rag_span.outcome = "skipped"
+            rag_span.bytes_out = len(rag_context)
+    except Exception as e:
+        logger.warning(f"⚠️ RAG Search failed (non-critical): {e}")
+    return rag_context
+
+
+async def process_single_frame(ctx: ToolContext, event: dict, frame_node: dict, coder: LLMCoder, router_cache: RouterCache, search_engine: RepoSearch, project_root: str, fingerprints: FrameFingerprintStore = None, version: str = None) -> bool:
+    """
+    Process a single frame node, timed as one 'frame' span (har stage ka apna span andar record hota hai).
+    """
+    # Single-frame path caller ke task mein chalta hai; reset na karein to frame id agle events ke spans par lagi rehti
+    frame_token = current_frame_id.set(frame_node.get("id"))
+    try:
+        with span("frame") as frame_span:
+            ok = await run_frame_stages(ctx, event, frame_node, coder, router_cache, search_engine, project_root, fingerprints, version)
+            frame_span.outcome = "ok" if ok else "failed"
+            return ok
+    finally:
+        current_frame_id.reset(frame_token)
+
+
+async def run_frame_stages(ctx: ToolContext, event: dict, frame_node: dict, coder: LLMCoder, router_cache: RouterCache, search_engine: RepoSearch, project_root: str, fingerprints: FrameFingerprintStore = None, version: str = None) -> bool:
     """
     Process a single frame node.
     
     Ye sab se important function hai. Iska workflow ye hai:
+    0.  Fingerprint: Frame pichli kamyab run se nahi badla to poora kaam skip.
     1.  Target File Dhoondo: `find_target_file` se pata karo code kahan likhna hai.
-    2.  Vision Image Lo: Figma se image download karo taake AI dekh sake design kaisa hai.
+    2.  Vision Image Lo: Figma se image (memory mein, aksar pehle se prefetch) taake AI dekh sake design kaisa hai.
     3.  RAG Context: Project mein milti julti files dhoondo taake AI unka style copy kar sake.
+        (2, 3 aur project context ek saath, asyncio.gather se)
     4.  Generate Code: LLM ko data bhejo aur Code generate karwao.
     5.  Validate & Fix: Code ko check karo (syntax check), agar ghalati ho to AI se fix karwao.
     6.  Prettier: Code ko format karo taake sunda dikhe.
@@ -304,92 +577,70 @@ async def process_single_frame(ctx: ToolContext, event: dict, frame_node: dict,
     file_key = event["file_key"]
     file_name = event["file_name"]  # Needed for MR creation
     comp_name = frame_node.get("name", "Component").replace(" ", "").replace("-", "")
+    frame_id = frame_node.get("id", "")
+    
+    # 0. FINGERPRINT CHECK
+    # Design same hai to Gemini, image download aur MR sab bach jate hain (explicit !sync ke ilawa).
+    with span("fingerprint") as fingerprint_span:
+        fingerprint = canonical_frame_hash(frame_node)
+        forced = is_explicit_request(event)
+        unchanged = bool(not forced and fingerprints and frame_id and await frame_is_unchanged(fingerprints, file_key, frame_id, fingerprint, project_root))
+        fingerprint_span.outcome = "forced" if forced else "hit" if unchanged else "miss"
+    if unchanged:
+        logger.info(f"⏭️ Frame '{comp_name}' unchanged since last run, skipping.")
+        return True
     
     try:
         # 2. RESOLVE FILE PATH (Hunter Logic)
         # file kahan banani/update karni hai?
-        computed_file_path = find_target_file(frame_node, project_root, search_engine)
-
-        # 3. Vision Context
-        # Design ki image mangwa rahe hain.
-        image_path = None
-        try:
-            image_path = await figma.download_node_image_to_temp(ctx, file_key, frame_node["id"])
-            if image_path:
-                logger.info(f"👁️ Vision image captured: {image_path}")
-        except Exception as e:
-            logger.warning(f"⚠️ Failed to fetch vision image: {e}")
-
-        # 4. Generate Code
-        # Project ka context (tailwind config, etc) load karo.
-        project_context = get_project_context()
-
-        # --- RAG: Fetch Similar Examples ---
-        # RAG ka matlab hai 'Retrieval Augmented Generation'. Hum AI ko purana code dikhate hain.
-        rag_context = ""
-        try:
-            design_text = extract_text_from_figma(frame_node)
-            if len(design_text) > 20: # Agar design mein kafi text hai tabhi search karo.
-                logger.info(f"🔍 RAG: Searching for components similar to '{comp_name}'...")
-                similar_files = search_engine.search(query=design_text, limit=3)
-                
-                if similar_files:
-                    logger.info(f"    Found {len(similar_files)} matches: {similar_files}")
-                    rag_context = "\n### SIMILAR CODEBASE EXAMPLES (REFERENCE ONLY):\n"
-                    
-                    for rel_path in similar_files:
-                        full_path = os.path.join(project_root, rel_path)
-                        if os.path.exists(full_path):
-                            try:
-                                with open(full_path, "r", encoding="utf-8") as f:
-                                    content = f.read()
-                                    # Sirf shuru ke 2000 characters bhejte hain taake context limit cross na ho.
-                                    rag_context += f"\n--- START EXAMPLE: {rel_path} ---\n{content[:2000]}\n--- END EXAMPLE ---\n"
-                            except Exception:
-                                pass
-                    logger.info(f"📖 RAG: Injected {len(rag_context)} chars of context.")
+        with span("route"):
+            computed_file_path = find_target_file(frame_node, project_root, search_engine)
 
-        except Exception as e:
-            logger.warning(f"⚠️ RAG Search failed (non-critical): {e}")
+        # 3-4. PREFETCH (Vision image + Project context + RAG)
+        # Teeno ek dusre par depend nahi karte, is liye ek saath chalte hain. Pehle ye ek ke baad ek
+        # chalte the aur Gemini call se pehle hi kai seconds lag jate the.
+        image, project_context, rag_context = await asyncio.gather(
+            fetch_vision_image(ctx, file_key, frame_node["id"], version),
+            load_project_context(),
+            build_rag_context(frame_node, comp_name, search_engine, project_root)
+        )
 
         try:
             # AI ko sab kuch bhej ke code generate karwao.
-            llm_result = coder.generate_component(
-                figma_data=frame_node, 
-                context_files=project_context,
-                rag_context=rag_context,
-                image_path=image_path
-            )
+            # Async call hai, is dauran event loop baaki frames, heartbeat aur polling chalata rehta hai.
+            prompt_chars = len(json.dumps(frame_node)) + len(project_context) + len(rag_context)
+            # bytes_in = jo image bheji gayi; detail mein original size, taake report latency ka farq dikha sake
+            with span("generate", bytes_in=len(image.data) if image else None, prompt_chars=prompt_chars,
+                      detail=f"image {image.original_bytes} -> {len(image.data)} bytes" if image else None) as generate_span:
+                llm_result = await coder.agenerate_component(
+                    figma_data=frame_node, 
+                    context_files=project_context,
+                    rag_context=rag_context,
+                    image_data=image.data if image else None,
+                    image_mime_type=image.mime_type if image else "image/png"
+                )
+                generate_span.bytes_out = len(llm_result.get("code", ""))
         except ValueError as e:
             if "GEMINI_API_KEY" in str(e):
                 logger.error("❌ GEMINI_API_KEY missing.")
                 return False
             raise e
-        finally:
-            # Image ab delete kardo, kaam khatam.
-            if image_path and os.path.exists(image_path):
-                try: os.remove(image_path) 
-                except: pass
         
         code = llm_result["code"]
         
         # 5. Validation & Self-Healing Loop
-        # Ab hum code ko check karenge.
-        ext = ".jsx" 
-        temp_filename = f"temp_gen_{comp_name}{ext}"
-        temp_file = os.path.join(project_root, temp_filename)
-        
+        # Ab hum code ko check karenge. Code memory se hi check hota hai (project root mein temp file nahi);
+        # .tsx files us waqt ready baaki frames ke saath ek hi tsc program mein check hoti hain.
         validation_passed = False
         
         try:
             # Hum 2 attempts (koshish) karte hain. Agar pehli baar error aya, to hum AI ko bolte hain fix kare.
             for attempt in range(2): 
-                with open(temp_file, "w", encoding="utf-8") as f:
-                    f.write(code)
-                
                 logger.info(f"🛡️ Running Compiler Check (Attempt {attempt+1})...")
                 # Ye function check karta hai ke syntax error to nahi.
-                is_valid, error_msg = validate_code(temp_file, cwd=project_root)
+                with span("validate", bytes_in=len(code)) as validate_span:
+                    is_valid, error_msg = await check_code(code, computed_file_path, project_root)
+                    validate_span.outcome = "ok" if is_valid else "invalid"
                 
                 if is_valid:
                     logger.info("✅ Compiler Check Passed.")
@@ -400,13 +651,12 @@ async def process_single_frame(ctx: ToolContext, event: dict, frame_node: dict,
                     if attempt < 1: 
                         logger.info("💊 Attempting AI Fix...")
                         # Coder se kaho ke error fix kare.
-                        code = coder.fix_code(code, error_msg)
+                        with span("fix", bytes_in=len(code), prompt_chars=len(code) + len(error_msg)) as fix_span:
+                            code = await coder.afix_code(code, error_msg)
+                            fix_span.bytes_out = len(code)
                     else:
                         logger.error("💀 Auto-fix failed twice.")
 
-            # Cleanup temp file
-            if os.path.exists(temp_file): os.remove(temp_file)
-
             # Agar fix nahi hua to process rok do.
             if not validation_passed:
                 logger.error(f"🛑 Aborting PR. Code failed validation.")
@@ -414,28 +664,15 @@ async def process_single_frame(ctx: ToolContext, event: dict, frame_node: dict,
 
             # 6. Prettier Formatting
             # Code ko standardize karo (indentation, spacing etc).
-            with open(temp_file, "w", encoding="utf-8") as f:
-                f.write(code)
-                
+            # Worker ka ek hi Prettier daemon chalta hai: na har frame pe npx, na temp file.
             try:
                 logger.info("🎨 Running Prettier formatting...")
-                result = subprocess.run(
-                    ["npx", "prettier", "--write", temp_file], 
-                    capture_output=True, 
-                    shell=True, 
-                    cwd=project_root,
-                    timeout=10
-                )
-                if result.returncode == 0:
-                    logger.info("✅ Prettier formatting complete")
+                with span("prettier", bytes_in=len(code)) as prettier_span:
+                    code = await format_code(code, computed_file_path, project_root)
+                    prettier_span.bytes_out = len(code)
+                logger.info("✅ Prettier formatting complete")
             except Exception as e:
                 logger.warning(f"⚠️ Prettier skipped: {e}")
-            
-            # Read back formatted code
-            if os.path.exists(temp_file):
-                with open(temp_file, "r", encoding="utf-8") as f:
-                    code = f.read()
-                os.remove(temp_file)
                 
         except Exception as e:
             logger.warning(f"⚠️ Validation step failed: {e}")
@@ -444,30 +681,35 @@ async def process_single_frame(ctx: ToolContext, event: dict, frame_node: dict,
             logger.info(f"🔥 DEMO MODE: Writing file directly to {computed_file_path}")
             final_path = os.path.join(project_root, computed_file_path)
             
-            # Ensure directory exists
-            os.makedirs(os.path.dirname(final_path), exist_ok=True)
-            
-            # Write final code
-            with open(final_path, "w", encoding="utf-8") as f:
-                f.write(code)
+            # Write final code: project mein sirf yahi ek write hota hai, atomically (temp + os.replace),
+            # taake Vite jaise watchers kabhi adhi likhi file na dekhein.
+            with span("write", bytes_out=len(code)) as write_span:
+                written = await asyncio.to_thread(write_text_atomic, final_path, code)
+                if not written:
+                    write_span.outcome = "unchanged"
                 
-            logger.info(f"✅ Success! File updated locally.")
+            logger.info(f"✅ Success! File updated locally." if written else "✅ Success! File already up to date.")
+            await record_fingerprint(fingerprints, file_key, frame_id, fingerprint, computed_file_path)
             return True
             
         else:
             # Sab theek hai to GitLab pe bhej do.
             logger.info(f"📦 Creating MR for: {computed_file_path}")
             
-            mr_url = git_service.create_merge_request(
-                file_path=computed_file_path,
-                content=code,
-                file_name=file_name,
-                figma_file_key=file_key,
-                repo_path=project_root
-            )
+            with span("merge_request", bytes_out=len(code)) as mr_span:
+                mr_url = git_service.create_merge_request(
+                    file_path=computed_file_path,
+                    content=code,
+                    file_name=file_name,
+                    figma_file_key=file_key,
+                    repo_path=project_root
+                )
+                if not mr_url:
+                    mr_span.outcome = "failed"
             
             if mr_url:
                 logger.info(f"✅ Success! MR: {mr_url}")
+                await record_fingerprint(fingerprints, file_key, frame_id, fingerprint, computed_file_path)
                 return True
             else:
                 logger.error("❌ Failed to create Merge Request.")
@@ -478,81 +720,318 @@ async def process_single_frame(ctx: ToolContext, event: dict, frame_node: dict,
         return False
 
 
-async def process_tick(ctx: ToolContext, pending_jobs: dict, search_engine: RepoSearch, project_root: str) -> bool:
+async def record_fingerprint(fingerprints: FrameFingerprintStore, file_key: str, frame_id: str, fingerprint: str, output_path: str):
+    # Fingerprint sirf kamyab run ke baad save hota hai; save fail ho to agli baar bas dobara generate hoga.
+    if not fingerprints or not frame_id:
+        return
+    try:
+        await fingerprints.record(file_key, frame_id, fingerprint, output_path)
+    except Exception as e:
+        logger.warning(f"⚠️ Failed to record frame fingerprint: {e}")
+
+
+class EventStreamListener:
+    """
+    Subscribes to the webhook server's /events/stream (SSE) and wakes the worker loop
+    as soon as a new event is committed.
+
+    Jab tak stream connected hai, worker ko DB poll karne ki zaroorat nahi. Agar stream toot jaye
+    to `connected` False ho jata hai aur main loop wapis FALLBACK_POLL_INTERVAL wali polling pe chala jata hai.
+    """
+
+    def __init__(self, url: str = EVENT_STREAM_URL, max_backoff: float = 30.0):
+        self.url = url
+        self.max_backoff = max_backoff
+        self.wakeup = asyncio.Event()
+        self.connected = False
+
+    async def run(self):
+        backoff = 1.0
+        # Read timeout server ke keepalive (15s) se zyada rakha hai taake idle connection na toote.
+        timeout = httpx.Timeout(10.0, read=60.0)
+        while True:
+            try:
+                async with httpx.AsyncClient(timeout=timeout) as client:
+                    async with client.stream("GET", self.url, headers={"Accept": "text/event-stream"}) as resp:
+                        resp.raise_for_status()
+                        self.connected = True
+                        backoff = 1.0
+                        logger.info(f"📡 Event stream connected: {self.url}")
+                        # Disconnect ke dauran aaye events ke liye ek dafa tick chalao.
+                        self.wakeup.set()
+                        # Notice ka payload nahi chahiye: kya karna hai wo queue batati hai, stream sirf jagati hai.
+                        async for line in resp.aiter_lines():
+                            if line.startswith("data:"):
+                                self.wakeup.set()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if self.connected:
+                    logger.warning(f"⚠️ Event stream dropped ({e}). Falling back to DB polling.")
+            if self.connected:
+                self.connected = False
+                self.wakeup.set()
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    async def wait(self, timeout: float) -> bool:
+        """Sleep until a stream notification arrives or `timeout` passes. Returns True if woken by the stream."""
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout=timeout)
+            woken = True
+        except asyncio.TimeoutError:
+            woken = False
+        self.wakeup.clear()
+        return woken
+
+    def poll_interval(self) -> float:
+        return STREAM_SAFETY_POLL_INTERVAL if self.connected else FALLBACK_POLL_INTERVAL
+
+
+def next_poll_interval(current: float, changed: bool) -> float:
+    """
+    Adaptive polling: change mila to wapis tez (FIGMA_POLL_INTERVAL), file idle hai to
+    interval double (exponential backoff) FIGMA_POLL_MAX_INTERVAL tak.
+    """
+    if changed:
+        return FIGMA_POLL_INTERVAL
+    return min(FIGMA_POLL_MAX_INTERVAL, max(current, FIGMA_POLL_INTERVAL) * 2)
+
+
+def polled_file_keys() -> list:
+    # FIGMA_FILE_KEY mein comma se alag kai files di ja sakti hain: "keyA,keyB"
+    return [key.strip() for key in os.getenv("FIGMA_FILE_KEY", "").split(",") if key.strip()]
+
+
+async def poll_file_changes(ctx: ToolContext, queue: JobQueue, wakeup: asyncio.Event, file_key: str):
+    """
+    Ek Figma file ka version check karta hai aur change milne par artificial event database queue mein daalta hai.
+    """
+    last_version = None
+    interval = FIGMA_POLL_INTERVAL
+    while True:
+        changed = False
+        try:
+            # Get File Version (versions endpoint + ETag, file download nahi hota)
+            file_meta = await figma.get_file_meta(ctx, file_key)
+            current_version = file_meta.get("version") or file_meta.get("lastModified")
+            
+            logger.debug(f"🔍 Checking Figma {file_key}... [Current: {current_version} | Last: {last_version}]")
+            
+            # Trigger if changed OR if this is the first check (so we get the design immediately)
+            if current_version and (last_version is None or current_version != last_version):
+                changed = True
+                if last_version is None:
+                    logger.info(f"🚀 Initial Sync: Fetching latest design for {file_key} (v{current_version})...")
+                else:
+                    logger.info(f"🔄 Detected Change in Figma {file_key}! (v{current_version})")
+                
+                # Inject artificial event (same table as webhooks, so it coalesces and any worker can claim it)
+                fake_event = {
+                    "webhook_id": "poll",
+                    "source": "poll",  # 'poll' lane: webhooks aur !sync is se pehle uthaye jate hain
+                    "event_type": "FILE_UPDATE",
+                    "file_key": file_key,
+                    "file_name": file_meta.get("name", "PolledFile"),
+                    "node_id": "0:1", # Default to first frame
+                    "version": file_meta.get("version"),
+                    "timestamp": str(time.time())
+                }
+                await queue.enqueue(fake_event)
+                wakeup.set()
+                last_version = current_version
+        except Exception as e:
+            logger.warning(f"Poll failed for {file_key}: {e}")
+
+        interval = next_poll_interval(interval, changed)
+        await asyncio.sleep(interval)
+
+
+async def poll_figma_changes(ctx: ToolContext, queue: JobQueue, wakeup: asyncio.Event):
+    """
+    DEMO mode: Har FIGMA_FILE_KEY ke liye alag adaptive poller, sab ek hi loop mein concurrently.
+    Ye alag task mein chalta hai taake worker ka main loop sirf naye kaam par jaage.
+    """
+    file_keys = polled_file_keys()
+    if not file_keys:
+        logger.warning("FIGMA_FILE_KEY not set, Figma polling disabled.")
+        return
+    logger.info(f"⚡ Polling {len(file_keys)} Figma file(s): {file_keys}")
+    await asyncio.gather(*(poll_file_changes(ctx, queue, wakeup, key) for key in file_keys))
+
+
+def prime_node_fetches(ctx: ToolContext, jobs: list):
     """
-    Worker Tick: Fetches events, manages queue, triggers pipeline.
+    Events ek ek kar ke chalte hain, lekin ek hi file ke targeted nodes ka design pehle hi ek saath mangwa lo:
+    node loader inhe ek `/nodes?ids=a,b,c` call mein jorta hai aur tick khatam hone tak result rakhta hai.
+    Jin events ke saath version hai (poll) wo node cache se aate hain, unhe prime nahi karte.
+    """
+    node_loader = figma.get_node_loader(ctx)
+    # Pichle tick ka koi bacha hua result istemal na ho
+    node_loader.clear()
+    if not os.getenv("FIGMA_ACCESS_TOKEN"):
+        return node_loader
+    for event in jobs:
+        node_id = event.get("node_id") or ""
+        if ":" in node_id and not event.get("payload", {}).get("version"):
+            node_loader.prime(event["file_key"], FIGMA_FETCH_DEPTH, [node_id])
+    return node_loader
+
+
+async def process_tick(ctx: ToolContext, queue: JobQueue, search_engine: RepoSearch, project_root: str) -> bool:
+    """
+    Worker Tick: Claims events from the shared job queue and triggers the pipeline.
     
     Ye loop ka ek chakkar (tick) hai. Har baar jab ye chalta hai, ye ye karta hai:
-    1. Pending Events Check: Figma plugin se puchta hai "koi updates hain?".
-    2. Queue Update: Naye events ko list mein dalta hai.
-    3. Debounce Check: Dekhta hai ke kya "DEBOUNCE_WINDOW" (30 sec) guzar gaye?
-       (Taake agar designer abhi kaam kar raha ho to hum foran code generate na karein, thora wait karein).
-    4. Execute: Agar time pura ho gaya hai, to `process_pipeline` chalao.
+    1. Reaper: Jo events kisi crashed ya hung worker ke paas phanse hain (lease expire ho gayi, ya processing
+       PROCESSING_TIMEOUT se lambi ho gayi), unhe wapis 'pending' karo. Bar bar phansne wale 'dead_letter' mein.
+    2. Claim: Database se atomically woh pending events apne naam lease karo jinka debounce time (`due_at`) pura ho gaya
+       (dusra worker inhe nahi uthayega). Order lanes ke hisab se: pehle '!sync' (targeted), phir webhooks, phir poll,
+       aur har lane mein files baari baari - ek shor machane wali file baaki sab ko rok nahi sakti.
+    3. Execute: Har claimed event ke liye (agar lease abhi bhi apni hai) `process_pipeline` chalao. Tick beech mein
+       toote to baaki claimed events `queue.release` se wapis queue mein.
+    4. Complete: Kamyab event 'processed'. Fail hua (ya exception) to `queue.fail`: backoff ke baad dobara
+       'pending', aur `max_attempts` ke baad 'dead_letter'.
     """
     if not DB_PATH.exists():
         return True
 
-    # --- STEP 1: FILL THE QUEUE ---
+    # --- STEP 1: REAP + CLAIM ---
+    # Ingest ke waqt hi same node ke events coalesce ho jate hain, is liye har node ka sirf latest event aata hai.
+    # Sirf wohi events claim hote hain jinka `due_at` (last edit + DEBOUNCE_WINDOW) guzar chuka hai.
     try:
-        events_result = await figma.list_pending_events(ctx, {"limit": 50})
-        new_events = events_result.get("events", [])
-        
-        for event in new_events:
-            node_id = event.get("node_id") or event["file_key"]
-            file_name = event["file_name"]
-            
-            # Agar event pehle hi queue mein hai, to usay update (supersede) kardo.
-            if node_id in pending_jobs:
-                 logger.info(f"♻️  Superseding previous event for {file_name} ({node_id})")
-            else:
-                 logger.info(f"📥 Queuing new event for {file_name} ({node_id})")
-
-            pending_jobs[node_id] = {
-                "data": event,
-                "timestamp": time.time()
-            }
-            # Figma ko bata do ke humne ye note kar liya hai (status: processing).
-            await figma.mark_event_processed(ctx, {"event_id": event["id"], "status": "processing"})
-            
+        await queue.reap_expired()
+        jobs = await queue.claim_batch(CLAIM_BATCH_SIZE)
     except Exception as e:
-        logger.error(f"Error fetching events: {e}")
+        logger.error(f"Error claiming events: {e}")
         return False
 
-    # --- STEP 2: CHECK DEBOUNCE TIMERS ---
-    # Check karo kon se jobs ready hain.
-    current_time = time.time()
-    ready_to_process = []
-    
-    for node_id, job in pending_jobs.items():
-        elapsed = current_time - job["timestamp"]
-        # Agar 30 seconds (DEBOUNCE_WINDOW) se zada waqt guzar gaya, to process karo.
-        # if elapsed > DEBOUNCE_WINDOW:
-        ready_to_process.append(node_id)
-
-    # --- STEP 3: EXECUTE PIPELINE ---
-    if ready_to_process:
-        coder = LLMCoder()
-        router_cache = RouterCache()
-
-        for node_id in ready_to_process:
-            job = pending_jobs.pop(node_id)
-            event = job["data"]
-            file_name = event["file_name"]
-            
-            logger.info(f"⏰ Debounce settled. Processing {file_name}...")
-            
-            # Asal pipeline chalao.
-            success = await process_pipeline(ctx, event, node_id, coder, router_cache, search_engine, project_root)
-            
-            # Mark processed (chahye fail ho ya pass, humne try kar liya).
-            await figma.mark_event_processed(ctx, {"event_id": event["id"], "status": "processed"})
+    if not jobs:
+        return True
 
+    # --- STEP 2: EXECUTE PIPELINE ---
+    coder = LLMCoder(rate_limiter=ctx.rate_limiter)
+    router_cache = RouterCache()
+    fingerprints = FrameFingerprintStore(DB_PATH)
+    node_loader = prime_node_fetches(ctx, jobs)
+    # Jo jobs abhi tak complete/fail record nahi huin. Tick beech mein toot jaye (DB error waghaira) to ye
+    # finally mein wapis 'pending' hoti hain, warna heartbeat inki lease PROCESSING_TIMEOUT tak barhata rehta.
+    unfinished = {event["id"] for event in jobs}
+    try:
+        for event in jobs:
+            await run_claimed_job(ctx, queue, event, coder, router_cache, search_engine, project_root, fingerprints)
+            unfinished.discard(event["id"])
+    finally:
+        node_loader.clear()
+        if unfinished:
+            try:
+                released = await queue.release(unfinished)
+                logger.warning(f"↩️ Tick aborted: released {released} claimed events back to the queue")
+            except Exception as e:
+                logger.error(f"Could not release claimed events {sorted(unfinished)}: {e}")
     return True
 
 
+async def run_claimed_job(ctx: ToolContext, queue: JobQueue, event: dict, coder: LLMCoder, router_cache: RouterCache, search_engine: RepoSearch, project_root: str, fingerprints: FrameFingerprintStore):
+    """
+    Ek claimed event: pehle lease check (batch ke pehle events chalte chalte reaper ne ye event kisi aur worker ko
+    de diya ho to do worker ek hi kaam na karein), phir pipeline, phir result record. Record fail ho to exception
+    upar jati hai aur process_tick baaki jobs release kar deta hai.
+    """
+    if not await queue.renew(event["id"]):
+        logger.warning(f"⚠️ Lease lost for event {event['id']} before it started - skipping, another worker owns it now.")
+        return
+
+    node_id = event.get("node_id") or event["file_key"]
+    file_name = event["file_name"]
+    revision = event.get("revision", 1)
+    attempts = event.get("attempts", 1)
+    if attempts > 1:
+        logger.warning(f"🔁 Retrying {file_name} ({node_id}): attempt {attempts}/{queue.max_attempts}")
+
+    lane = event.get("lane", "webhook")
+    if revision > 1:
+        logger.info(f"⏰ Debounce settled. Processing {file_name} ({node_id}) [{lane}] - {revision - 1} earlier updates coalesced")
+    else:
+        logger.info(f"⏰ Debounce settled. Processing {file_name} ({node_id}) [{lane}]")
+    
+    # Asal pipeline chalao. Is event ke saare spans isi event id ke neeche record hote hain.
+    event_token = current_event_id.set(event["id"])
+    error = None
+    try:
+        with span("pipeline") as pipeline_span:
+            success = await process_pipeline(ctx, event, node_id, coder, router_cache, search_engine, project_root, fingerprints)
+            pipeline_span.outcome = "ok" if success else "failed"
+    except Exception as e:
+        success, error = False, f"{type(e).__name__}: {e}"[:500]
+    finally:
+        current_event_id.reset(event_token)
+    
+    # Lease ke saath complete karo. Agar lease kho gayi (reaper ne kisi aur ko de di), to sirf warning.
+    if success:
+        completed = await queue.complete(event["id"], "processed")
+    else:
+        completed = await queue.fail(event["id"], error or "Pipeline reported failure") is not None
+    if not completed:
+        logger.warning(f"⚠️ Lease lost for event {event['id']} - another worker owns it now.")
+    try:
+        await span_recorder.flush()
+    except Exception as e:
+        # Timings sirf report ke liye hain; in ki wajah se event dobara nahi chalna chahiye
+        logger.warning(f"Span flush failed: {e}")
+
+
+async def seconds_until_next_due(queue: JobQueue, cap: float) -> float:
+    """
+    Scheduler: Database ka `due_at` index hi humara heap hai. MIN(due_at) nikal kar
+    worker bilkul utni dair soata hai jitni agle event ke ready hone mein baqi hai (zyada se zyada `cap`).
+    """
+    try:
+        next_due = await queue.next_due_at()
+    except Exception as e:
+        logger.warning(f"Could not read next due time: {e}")
+        return cap
+    if next_due is None:
+        return cap
+    return max(0.0, min(cap, next_due - time.time()))
+
+
+async def heartbeat_leases(queue: JobQueue):
+    """
+    Jab tak worker zinda hai, uske paas jitne events leased hain un sab ki lease barhata rehta hai.
+    Worker crash ho jaye to heartbeat ruk jati hai aur reaper unhe wapis queue mein daal deta hai.
+    """
+    while True:
+        await asyncio.sleep(queue.lease_seconds / 3)
+        try:
+            await queue.heartbeat()
+        except Exception as e:
+            logger.warning(f"Lease heartbeat failed: {e}")
+
+
+async def sweep_stuck_events(queue: JobQueue):
+    """
+    Periodic sweeper: process_tick bhi reap karta hai, lekin ek lamba tick (bari file, slow Gemini) minutes le sakta hai.
+    Ye task alag se chalta hai taake dusre (crashed) workers ke events itni dair phanse na rahein.
+    """
+    while True:
+        await asyncio.sleep(STUCK_SWEEP_INTERVAL)
+        try:
+            await queue.reap_expired()
+        except Exception as e:
+            logger.warning(f"Stuck-event sweep failed: {e}")
+
+
 async def main():
     logger.info("🤖 Figma-to-GitLab Automation Worker Started (Daemon Mode)")
 
+    # CASSETTE_MODE=record|replay: Figma/Gemini/GitLab calls disk pe record hoti hain ya wahan se replay (offline benchmark).
+    cassette.install_from_env()
+
+    # ijson na ho to whole-file sync poora document memory mein parse karta hai - chupke se nahi, log mein batao
+    if STREAM_FRAMES not in ("0", "false", "no", "off") and not ijson_available():
+        logger.warning("⚠️ ijson not installed: whole-file syncs will parse the full Figma document in memory (pip install ijson)")
+
     # Tools initialize karo (Security, Search, etc)
     ctx = ToolContext(config=None, security=None, audit=None, search_config=None, approval_secret="automation-secret")
     search_engine = RepoSearch()
@@ -588,53 +1067,39 @@ async def main():
             
     logger.info("📚 Repo Search Engine Online.")
 
-    pending_jobs = {}
-    backoff = 2
+    # Shared job queue: kai worker processes ek hi events.db se kaam le sakte hain.
+    queue = JobQueue(DB_PATH)
+    logger.info(f"🆔 Worker ID: {queue.worker_id} (lease {queue.lease_seconds:.0f}s)")
+
+    # Startup recovery: pichla worker process (isi machine pe) crash hua tha to uske 'processing' events
+    # lease expire hone ka intezar kiye baghair foran wapis queue mein.
+    try:
+        recovered = await queue.recover_orphans()
+        if recovered:
+            logger.info(f"♻️ Recovered {recovered} events left in 'processing' by a previous run")
+    except Exception as e:
+        logger.warning(f"Startup recovery failed: {e}")
+
+    asyncio.create_task(heartbeat_leases(queue))
+    asyncio.create_task(sweep_stuck_events(queue))
+
+    # Push stream: webhook server naye events ki khabar foran deta hai.
+    listener = EventStreamListener()
+    asyncio.create_task(listener.run())
     
-    # Main Loop (Infinite Loop)
-    logger.info("⚡ Polling Mode Activated: Checking Figma every 10 seconds...")
-    last_version = None
+    if DEMO_MODE:
+        logger.info(f"⚡ Polling Mode Activated: Checking Figma every {FIGMA_POLL_INTERVAL}-{FIGMA_POLL_MAX_INTERVAL:.0f} seconds (adaptive)...")
+        asyncio.create_task(poll_figma_changes(ctx, queue, listener.wakeup))
     
+    # Main Loop (Infinite Loop)
     while True:
         try:
             # 1. Process Pending Jobs from Webhook
-            success = await process_tick(ctx, pending_jobs, search_engine, project_root)
-            
-            # 2. AUTO-POLL: Check if Figma file version changed
-            if DEMO_MODE:
-                try:
-                    current_file_key = os.getenv("FIGMA_FILE_KEY")
-                    if current_file_key:
-                        # Get File Version
-                        file_meta = await figma.get_file_meta(ctx, current_file_key)
-                        current_version = file_meta.get("version") or file_meta.get("lastModified")
-                        
-                        logger.info(f"🔍 Checking Figma... [Current: {current_version} | Last: {last_version}]")
-                        
-                        # Trigger if changed OR if this is the first check (so we get the design immediately)
-                        if last_version is None or current_version != last_version:
-                            if last_version is None:
-                                logger.info(f"🚀 Initial Sync: Fetching latest design (v{current_version})...")
-                            else:
-                                logger.info(f"🔄 Detected Change in Figma! (v{current_version})")
-                            
-                            # Inject artificial event
-                            fake_event = {
-                                "id": f"poll_{int(time.time())}_{random.randint(1000, 9999)}",
-                                "event_type": "FILE_UPDATE",
-                                "file_key": current_file_key,
-                                "file_name": file_meta.get("name", "PolledFile"),
-                                "node_id": "0:1", # Default to first frame
-                                "timestamp": str(time.time())
-                            }
-                            pending_jobs[fake_event["id"]] = {"data": fake_event, "timestamp": time.time()}
-                            
-                        last_version = current_version
-                except Exception as e:
-                    logger.warning(f"Poll failed: {e}")
-
-            # Sleep logic
-            await asyncio.sleep(5) # 5 seconds wait (Faster Poll)
+            success = await process_tick(ctx, queue, search_engine, project_root)
+
+            # 2. Agla event due hone tak, ya stream se notification aane tak so jao
+            #    (stream down ho to zyada se zyada FALLBACK_POLL_INTERVAL).
+            await listener.wait(await seconds_until_next_due(queue, listener.poll_interval()))
             
         except KeyboardInterrupt:
             break
@@ -644,123 +1109,3 @@ async def main():
 
 if __name__ == "__main__":
     asyncio.run(main())
-=======
-from pathlib import Path
-from dotenv import load_dotenv
-
-# Import our modular tools and utils
-# Import our modular tools and utils
-from mcp_core.context import ToolContext
-from mcp_core.config import ServerConfig
-from mcp_core.tools import figma
-from mcp_core.utils.github_automation import create_figma_update_pr
-
-# Setup logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-logger = logging.getLogger("AutomationWorker")
-
-load_dotenv()
-
-DB_PATH = Path(__file__).parent / "events.db"
-POLL_INTERVAL = 30 # seconds
-
-async def process_pending_events(ctx: ToolContext):
-    """
-    Checks the inbox for pending Figma events and creates GitHub PRs.
-    """
-    if not DB_PATH.exists():
-        return
-
-    # 1. Fetch pending events
-    events_result = await figma.list_pending_events(ctx, {"limit": 10})
-    events = events_result.get("events", [])
-    
-    if not events:
-        return
-
-    logger.info(f"Found {len(events)} pending events to process...")
-
-    for event in events:
-        event_id = event["id"]
-        file_key = event["file_key"]
-        file_name = event["file_name"]
-        
-        try:
-            logger.info(f"Processing event {event_id} for file: {file_name}")
-            
-            # 2. Fetch design pattern from Figma
-            pattern_result = await figma.fetch_figma_pattern(ctx, {"file_key": file_key, "depth": 4})
-            
-            # 3. Generate React component code
-            # Note: In a real scenario, we might want to target specific frames.
-            # Here we'll generate code for the first node as a default.
-            if not pattern_result.get("nodes"):
-                logger.warning(f"No nodes found for file {file_key}, skipping.")
-                await figma.mark_event_processed(ctx, {"event_id": event_id})
-                continue
-                
-            main_node = pattern_result["nodes"][0]
-            comp_name = file_name.replace(" ", "").replace("-", "")
-            
-            gen_result = await figma.generate_react_code(ctx, {
-                "component_name": comp_name,
-                "pattern": main_node
-            })
-            
-            code = gen_result["code"]
-            
-            # Use configurable output path
-            output_dir = os.getenv("CODE_GEN_OUTPUT_PATH", "src/components/generated")
-            file_path = f"{output_dir}/{gen_result['file_name']}"
-            
-            # 4. Create GitHub PR
-            # 4. Create GitHub PR (Run in executor to avoid blocking event loop)
-            logger.info(f"Creating GitHub PR for {comp_name}...")
-            loop = asyncio.get_running_loop()
-            pr_url = await loop.run_in_executor(
-                None, 
-                create_figma_update_pr, 
-                file_path, 
-                code, 
-                file_name, 
-                file_key
-            )
-            
-            if pr_url:
-                logger.info(f"✅ Created PR: {pr_url}")
-                # 5. Mark as processed
-                await figma.mark_event_processed(ctx, {"event_id": event_id})
-            else:
-                logger.error(f"❌ Failed to create PR for event {event_id}")
-
-        except Exception as e:
-            logger.error(f"Error processing event {event_id}: {str(e)}")
-
-async def main():
-    logger.info("Figma-to-GitHub Automation Worker Started")
-    
-    # Initialize proper configuration
-    base_dir = Path(__file__).parent.resolve()
-    config = ServerConfig(
-        allowed_repos=["*"],
-        allowed_roots=[
-            Path.home() / "Desktop", 
-            base_dir,
-            base_dir.parent
-        ],
-        max_file_size=1_000_000
-    )
-    
-    # Initialize a mock context for our tools
-    ctx = ToolContext(
-        config=config, security=None, audit=None, 
-        search_config=None, approval_secret="automation-secret"
-    )
-
-    while True:
-        await process_pending_events(ctx)
-        await asyncio.sleep(POLL_INTERVAL)
-
-if __name__ == "__main__":
-    asyncio.run(main())
->>>>>>> d06dac19010c3e2f3fff8aa92dad6ccd137cd9b7
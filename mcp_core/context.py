@@ -3,6 +3,10 @@ from typing import Set, Any
 from .config import ServerConfig, SearchConfig
 from .security import SecurityValidator
 from .audit import AuditLogger
+from .services.figma_client import FigmaClient
+from .services.node_cache import FigmaNodeCache
+from .services.image_store import FrameImageStore
+from .services.rate_limiter import RateLimiter
 
 @dataclass
 class ToolContext:
@@ -12,3 +16,15 @@ class ToolContext:
     search_config: SearchConfig
     approval_secret: str
     used_nonces: Set[str] = field(default_factory=set)
+    # Pooled keep-alive client shared by every Figma API call made with this context
+    figma: FigmaClient = field(default_factory=FigmaClient)
+    # Versioned on-disk cache of fetch_figma_pattern results
+    node_cache: FigmaNodeCache = field(default_factory=FigmaNodeCache)
+    # Rendered frame images in memory, keyed by (file_key, version, node_id)
+    frame_images: FrameImageStore = field(default_factory=FrameImageStore)
+    # Per-endpoint token buckets shared with every other worker/server process (Figma and Gemini)
+    rate_limiter: RateLimiter = field(default_factory=RateLimiter)
+
+    def __post_init__(self):
+        if self.figma.limiter is None:
+            self.figma.limiter = self.rate_limiter
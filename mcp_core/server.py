@@ -159,11 +159,20 @@ class RepoToolsServer:
                             "minItems": 1
                         },
                         "include_tokens": {"type": "boolean", "default": True},
-                        "depth": {"type": "integer", "minimum": 1, "maximum": 10}
+                        "depth": {"type": "integer", "minimum": 1, "maximum": 10},
+                        "version": {
+                            "type": "string",
+                            "description": "File version (e.g. the 'version' of an earlier result). A cached result for it is returned without calling Figma."
+                        }
                     },
                     "required": ["file_key"]
                 }
             ),
+            Tool(
+                name="figma_cache_stats",
+                description="Hit/miss counters and size of the local Figma node cache, plus the shared API rate-limit buckets.",
+                inputSchema={"type": "object", "properties": {}, "required": []}
+            ),
             Tool(
                 name="save_code_file",
                 description="Persist generated React code to a local file. Requires approval token.",
@@ -224,6 +233,9 @@ class RepoToolsServer:
                     result_obj = await git.create_branch(self.ctx, arguments)
                 elif name == "fetch_figma_pattern":
                     result_obj = await figma.fetch_figma_pattern(self.ctx, arguments)
+                elif name == "figma_cache_stats":
+                    result_obj = await figma.get_node_cache(self.ctx).stats()
+                    result_obj["rate_limits"] = await asyncio.to_thread(self.ctx.rate_limiter.stats)
                 elif name == "save_code_file":
                     result_obj = await filesystem.save_code_file(self.ctx, arguments)
                 elif name == "list_pending_events":
@@ -0,0 +1,328 @@
+"""
+cassette.py - Record / replay of the worker's external calls (Figma, Gemini, GitLab)
+
+The pipeline normally hits live services, which makes throughput impossible to
+benchmark or regression-test. This module wraps the few functions the worker
+uses to talk to the outside world:
+
+    figma.fetch_figma_pattern          -> "figma_fetch"
+    figma.stream_file_frames           -> "figma_fetch"   (same entries as a whole-file fetch)
+    figma.download_node_image_to_temp  -> "figma_image"   (PNG stored next to the entry)
+    figma.fetch_frame_images           -> "figma_image"   (one entry per node, same keys)
+    LLMCoder.generate_component / agenerate_component -> "generate"
+    LLMCoder.fix_code / afix_code      -> "fix"
+    gitlab_automation.create_merge_request -> "merge_request"
+
+NodeLoader.prime (the worker's batched /nodes prefetch) does nothing in replay:
+node fetches are served through fetch_figma_pattern instead.
+
+record: calls go through to the real service; the response and how long it
+        took are saved as <cassette_dir>/<target>/<key>.json.
+replay: nothing leaves the process; the recorded response is returned after
+        sleeping for the recorded latency (scaled, or a fixed value).
+
+Keys are derived from the request (file key + node ids, a hash of the frame
+JSON, a hash of code + error, ...), so a replay only matches the same request.
+With `loose=True` a miss falls back to a recording of the same target chosen
+deterministically from the key, which lets synthetic events reuse a small
+cassette set (scripts/bench_pipeline.py).
+
+Enable in the worker with CASSETTE_MODE=record|replay (see install_from_env).
+"""
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import tempfile
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from mcp_core.utils.atomic_write import write_text_atomic
+
+logger = logging.getLogger(__name__)
+
+CASSETTE_DIR = Path(__file__).parent.parent.parent / "cassettes"
+MODES = ("off", "record", "replay")
+
+
+class CassetteMiss(LookupError):
+    """Replay mode found no recording for a request."""
+
+
+def request_key(*parts: Any) -> str:
+    """Stable key for a request: sha1 of its canonical JSON (first 20 hex chars)."""
+    payload = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:20]
+
+
+class Cassette:
+    def __init__(self, directory: Path = CASSETTE_DIR, mode: str = "replay", latency_scale: float = 1.0,
+                 latency_ms: Optional[float] = None, loose: bool = False):
+        if mode not in MODES:
+            raise ValueError(f"Unknown cassette mode '{mode}' (expected one of {', '.join(MODES)})")
+        self.directory = Path(directory)
+        self.mode = mode
+        self.latency_scale = latency_scale
+        # Fixed simulated latency per call; overrides the recorded latency when set
+        self.latency_ms = latency_ms
+        self.loose = loose
+        self.hits = 0
+        self.misses = 0
+        self.recorded = 0
+        self._listing: Dict[str, List[Path]] = {}
+
+    # --- storage ---------------------------------------------------------------
+
+    def _entry_path(self, target: str, key: str) -> Path:
+        return self.directory / target / f"{key}.json"
+
+    def save(self, target: str, key: str, request: Dict[str, Any], response: Any, latency_ms: float,
+             blob: Optional[bytes] = None):
+        path = self._entry_path(target, key)
+        if blob is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.with_suffix(".bin").write_bytes(blob)
+        entry = {"target": target, "key": key, "request": request, "response": response,
+                 "latency_ms": round(latency_ms, 2), "has_blob": blob is not None}
+        write_text_atomic(str(path), json.dumps(entry, indent=2, default=str))
+        self._listing.pop(target, None)
+        self.recorded += 1
+
+    def load(self, target: str, key: str) -> Dict[str, Any]:
+        path = self._entry_path(target, key)
+        if not path.exists():
+            self.misses += 1
+            if not self.loose:
+                raise CassetteMiss(f"No '{target}' recording for key {key} in {self.directory}")
+            if target not in self._listing:
+                self._listing[target] = sorted((self.directory / target).glob("*.json"))
+            candidates = self._listing[target]
+            if not candidates:
+                raise CassetteMiss(f"No '{target}' recordings in {self.directory}")
+            path = candidates[int(key, 16) % len(candidates)]
+        else:
+            self.hits += 1
+        entry = json.loads(path.read_text(encoding="utf-8"))
+        if entry.get("has_blob"):
+            entry["blob"] = path.with_suffix(".bin").read_bytes()
+        return entry
+
+    def delay(self, entry: Dict[str, Any]) -> float:
+        """Seconds to wait before returning a replayed response."""
+        if self.latency_ms is not None:
+            return self.latency_ms / 1000
+        return entry.get("latency_ms", 0) * self.latency_scale / 1000
+
+    # --- call wrappers ---------------------------------------------------------
+
+    async def acall(self, target: str, key: str, request: Dict[str, Any], call: Callable):
+        if self.mode == "replay":
+            entry = self.load(target, key)
+            await asyncio.sleep(self.delay(entry))
+            return entry["response"]
+        start = time.perf_counter()
+        response = await call()
+        if self.mode == "record":
+            self.save(target, key, request, response, (time.perf_counter() - start) * 1000)
+        return response
+
+    def call(self, target: str, key: str, request: Dict[str, Any], call: Callable):
+        """Sync variant: replay blocks the calling thread, just like the real client does."""
+        if self.mode == "replay":
+            entry = self.load(target, key)
+            time.sleep(self.delay(entry))
+            return entry["response"]
+        start = time.perf_counter()
+        response = call()
+        if self.mode == "record":
+            self.save(target, key, request, response, (time.perf_counter() - start) * 1000)
+        return response
+
+    async def acall_image(self, key: str, request: Dict[str, Any], call: Callable) -> Optional[str]:
+        """Images are stored as bytes; replay writes them to a fresh temp file (the worker deletes it)."""
+        if self.mode == "replay":
+            entry = self.load("figma_image", key)
+            await asyncio.sleep(self.delay(entry))
+            if entry.get("blob") is None:
+                return None
+            fd, temp_path = tempfile.mkstemp(suffix=".png")
+            with os.fdopen(fd, "wb") as f:
+                f.write(entry["blob"])
+            return temp_path
+        start = time.perf_counter()
+        image_path = await call()
+        if self.mode == "record":
+            blob = Path(image_path).read_bytes() if image_path else None
+            self.save("figma_image", key, request, image_path, (time.perf_counter() - start) * 1000, blob=blob)
+        return image_path
+
+
+    async def acall_images(self, file_key: str, node_ids: List[str], on_image: Optional[Callable], call: Callable) -> Dict[str, Optional[bytes]]:
+        """
+        Batched frame images (render + concurrent downloads), stored per node like
+        acall_image. Replay serves every node concurrently with its own latency.
+        """
+        def node_request(node_id: str) -> Dict[str, Any]:
+            return {"file_key": file_key, "node_id": node_id}
+
+        if self.mode == "replay":
+            async def replay(node_id: str) -> Optional[bytes]:
+                entry = self.load("figma_image", request_key(node_request(node_id)))
+                await asyncio.sleep(self.delay(entry))
+                if on_image:
+                    on_image(node_id, entry.get("blob"))
+                return entry.get("blob")
+
+            return dict(zip(node_ids, await asyncio.gather(*(replay(node_id) for node_id in node_ids))))
+
+        start = time.perf_counter()
+        images = await call()
+        if self.mode == "record":
+            latency_ms = (time.perf_counter() - start) * 1000
+            for node_id, data in images.items():
+                request = node_request(node_id)
+                self.save("figma_image", request_key(request), request, None, latency_ms, blob=data)
+        return images
+
+
+def install(cassette: Cassette) -> Callable[[], None]:
+    """
+    Patch the worker's external calls to go through `cassette`.
+    Returns a function that restores the originals.
+    """
+    from mcp_core.tools import figma
+    from mcp_core.utils import gitlab_automation
+    from mcp_core.services.llm_coder import LLMCoder
+    from mcp_core.services.node_loader import NodeLoader
+    from mcp_core.services.figma_stream import FrameSpool, spool_document
+
+    originals = [
+        (figma, "fetch_figma_pattern", figma.fetch_figma_pattern),
+        (figma, "stream_file_frames", figma.stream_file_frames),
+        (figma, "download_node_image_to_temp", figma.download_node_image_to_temp),
+        (figma, "fetch_frame_images", figma.fetch_frame_images),
+        (gitlab_automation, "create_merge_request", gitlab_automation.create_merge_request),
+        (LLMCoder, "generate_component", LLMCoder.generate_component),
+        (LLMCoder, "agenerate_component", LLMCoder.agenerate_component),
+        (LLMCoder, "fix_code", LLMCoder.fix_code),
+        (LLMCoder, "afix_code", LLMCoder.afix_code),
+        (NodeLoader, "prime", NodeLoader.prime),
+    ]
+    real = {name: func for _, name, func in originals}
+
+    async def fetch_figma_pattern(ctx, args):
+        request = {"file_key": args["file_key"], "node_ids": sorted(args.get("node_ids", [])), "depth": args.get("depth", 4)}
+        return await cassette.acall("figma_fetch", request_key(request), request,
+                                    lambda: real["fetch_figma_pattern"](ctx, args))
+
+    async def stream_file_frames(ctx, file_key, depth=4, fingerprint=None):
+        # Stored like fetch_figma_pattern's whole-file response, so either call can replay the other's recording
+        request = {"file_key": file_key, "node_ids": [], "depth": depth}
+
+        async def call():
+            spool = await real["stream_file_frames"](ctx, file_key, depth)
+            try:
+                frames = [spool[i] for i in range(len(spool))]
+            finally:
+                spool.close()
+            document = {"id": "0:0", "type": "DOCUMENT", "children": [{"id": "0:1", "type": "CANVAS", "children": frames}]}
+            return {"file_key": file_key, "name": spool.meta.get("name"), "last_modified": spool.meta.get("lastModified"),
+                    "version": spool.meta.get("version"), "nodes": [document],
+                    "tokens": {"colors": {}, "components": {}, "styles": {}}}
+
+        response = await cassette.acall("figma_fetch", request_key(request), request, call)
+        spool = FrameSpool(fingerprint)
+        spool.meta = {"name": response.get("name"), "lastModified": response.get("last_modified"), "version": response.get("version")}
+        for node in response.get("nodes", []):
+            spool_document(node, spool)
+        return spool
+
+    async def download_node_image_to_temp(ctx, file_key, node_id):
+        request = {"file_key": file_key, "node_id": node_id}
+        return await cassette.acall_image(request_key(request), request,
+                                          lambda: real["download_node_image_to_temp"](ctx, file_key, node_id))
+
+    async def fetch_frame_images(ctx, file_key, node_ids, on_image=None):
+        return await cassette.acall_images(file_key, node_ids, on_image,
+                                           lambda: real["fetch_frame_images"](ctx, file_key, node_ids, on_image=on_image))
+
+    def create_merge_request(file_path, content, file_name, figma_file_key, max_retries=3, repo_path=None):
+        request = {"file_path": file_path, "figma_file_key": figma_file_key,
+                   "content_sha1": hashlib.sha1(content.encode("utf-8")).hexdigest()}
+        return cassette.call("merge_request", request_key(request), request,
+                             lambda: real["create_merge_request"](file_path, content, file_name, figma_file_key, max_retries, repo_path))
+
+    # Prompt context (RAG examples, tailwind config) is left out of the key on purpose:
+    # it changes with the local checkout, the design being converted does not.
+    def generation_request(figma_data):
+        return {"frame_sha1": request_key(figma_data), "name": figma_data.get("name")}
+
+    def generate_component(self, figma_data, *args, **kwargs):
+        request = generation_request(figma_data)
+        return cassette.call("generate", request_key(request), request,
+                             lambda: real["generate_component"](self, figma_data, *args, **kwargs))
+
+    async def agenerate_component(self, figma_data, *args, **kwargs):
+        request = generation_request(figma_data)
+        return await cassette.acall("generate", request_key(request), request,
+                                    lambda: real["agenerate_component"](self, figma_data, *args, **kwargs))
+
+    def fix_request(code, error_log):
+        return {"code_sha1": request_key(code), "error_sha1": request_key(error_log)}
+
+    def fix_code(self, code, error_log):
+        request = fix_request(code, error_log)
+        return cassette.call("fix", request_key(request), request, lambda: real["fix_code"](self, code, error_log))
+
+    async def afix_code(self, code, error_log, *args, **kwargs):
+        request = fix_request(code, error_log)
+        return await cassette.acall("fix", request_key(request), request,
+                                    lambda: real["afix_code"](self, code, error_log, *args, **kwargs))
+
+    def prime(self, file_key, depth, node_ids):
+        if cassette.mode != "replay":
+            real["prime"](self, file_key, depth, node_ids)
+
+    replacements = {
+        "fetch_figma_pattern": fetch_figma_pattern,
+        "stream_file_frames": stream_file_frames,
+        "download_node_image_to_temp": download_node_image_to_temp,
+        "fetch_frame_images": fetch_frame_images,
+        "create_merge_request": create_merge_request,
+        "generate_component": generate_component,
+        "agenerate_component": agenerate_component,
+        "fix_code": fix_code,
+        "afix_code": afix_code,
+        "prime": prime,
+    }
+    for owner, name, _ in originals:
+        setattr(owner, name, replacements[name])
+    logger.info(f"📼 Cassette {cassette.mode} mode: {cassette.directory}")
+
+    def uninstall():
+        for owner, name, func in originals:
+            setattr(owner, name, func)
+
+    return uninstall
+
+
+def install_from_env() -> Optional[Callable[[], None]]:
+    """
+    CASSETTE_MODE=record|replay enables the cassette (default off). Also read:
+    CASSETTE_DIR, CASSETTE_LATENCY_SCALE (x recorded latency), CASSETTE_LATENCY_MS
+    (fixed latency per call) and CASSETTE_LOOSE=1.
+    """
+    mode = os.getenv("CASSETTE_MODE", "off").lower()
+    if mode == "off":
+        return None
+    latency_ms = os.getenv("CASSETTE_LATENCY_MS")
+    cassette = Cassette(
+        directory=Path(os.getenv("CASSETTE_DIR", str(CASSETTE_DIR))),
+        mode=mode,
+        latency_scale=float(os.getenv("CASSETTE_LATENCY_SCALE", "1")),
+        latency_ms=float(latency_ms) if latency_ms else None,
+        loose=os.getenv("CASSETTE_LOOSE", "").lower() in ("1", "true", "yes")
+    )
+    return install(cassette)
@@ -0,0 +1,202 @@
+"""
+figma_client.py - One pooled HTTP client for every Figma API call
+
+Before this, fetch_figma_pattern, get_file_meta, fetch_node_image_url and
+download_node_image_to_temp each opened and closed their own
+httpx.AsyncClient, so every call paid TCP + TLS setup (3-4 fresh connections
+per frame). FigmaClient keeps one keep-alive connection pool (HTTP/2 when the
+optional `h2` package is installed) with shared timeouts, connection limits and
+one retry policy:
+
+- 429: wait Retry-After (or exponential backoff), capped at 60s
+- 502/503/504 and connection errors: exponential backoff
+- anything else is returned to the caller as-is
+
+With a RateLimiter attached (ToolContext does this), every API call first takes
+a token from its endpoint's bucket, and a 429 pauses that bucket for all
+processes, not just this retry loop.
+
+It is owned by ToolContext (`ctx.figma`); figma.py falls back to a module-level
+instance when called without a context.
+"""
+import os
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+
+import httpx
+
+from .rate_limiter import RateLimiter, figma_bucket
+
+logger = logging.getLogger(__name__)
+
+FIGMA_API_BASE = os.getenv("FIGMA_API_BASE", "https://api.figma.com")
+FIGMA_TIMEOUT = float(os.getenv("FIGMA_TIMEOUT", "15"))
+FIGMA_CONNECT_TIMEOUT = float(os.getenv("FIGMA_CONNECT_TIMEOUT", "5"))
+FIGMA_MAX_CONNECTIONS = int(os.getenv("FIGMA_MAX_CONNECTIONS", "20"))
+FIGMA_MAX_KEEPALIVE = int(os.getenv("FIGMA_MAX_KEEPALIVE", "10"))
+FIGMA_MAX_RETRIES = int(os.getenv("FIGMA_MAX_RETRIES", "3"))
+MAX_RETRY_AFTER = 60
+RETRY_STATUSES = {502, 503, 504}
+
+
+def http2_available() -> bool:
+    """httpx only speaks HTTP/2 with the optional `h2` package installed."""
+    if os.getenv("FIGMA_HTTP2", "1").lower() in ("0", "false", "no"):
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class FigmaClient:
+    def __init__(self, base_url: str = FIGMA_API_BASE, token: Optional[str] = None, timeout: float = FIGMA_TIMEOUT,
+                 max_connections: int = FIGMA_MAX_CONNECTIONS, max_keepalive: int = FIGMA_MAX_KEEPALIVE,
+                 max_retries: int = FIGMA_MAX_RETRIES, base_delay: float = 2, http2: Optional[bool] = None,
+                 transport: Optional[httpx.AsyncBaseTransport] = None, limiter: Optional[RateLimiter] = None):
+        self.base_url = base_url.rstrip("/")
+        self._token = token
+        self.timeout = httpx.Timeout(timeout, connect=min(timeout, FIGMA_CONNECT_TIMEOUT))
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive,
+                                   keepalive_expiry=60)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.http2 = http2_available() if http2 is None else http2
+        # Tests and benchmarks inject httpx.MockTransport or a stub server here
+        self._transport = transport
+        # Shared cross-process token buckets; None sends requests unthrottled
+        self.limiter = limiter
+        self._client: Optional[httpx.AsyncClient] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @property
+    def token(self) -> Optional[str]:
+        # Read on every call so a token set after startup (or patched in tests) is picked up
+        return self._token or os.getenv("FIGMA_ACCESS_TOKEN")
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """The pooled client, bound to the running event loop."""
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client.is_closed or self._loop is not loop:
+            # A client from another (finished) loop cannot be reused: its connections belong to that loop
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=self.timeout,
+                limits=self.limits,
+                http2=self.http2,
+                transport=self._transport
+            )
+            self._loop = loop
+        return self._client
+
+    async def _acquire(self, url: str):
+        bucket = figma_bucket(url)
+        if self.limiter is not None and bucket:
+            await self.limiter.acquire(bucket)
+
+    async def _rate_limited(self, url: str, delay: float) -> bool:
+        """Pause the endpoint's shared bucket after a 429. True if the next _acquire() will do the waiting."""
+        bucket = figma_bucket(url)
+        if self.limiter is not None and bucket:
+            return await self.limiter.pause(bucket, delay)
+        return False
+
+    def _retry_delay(self, attempt: int, response: Optional[httpx.Response] = None) -> float:
+        header = response.headers.get("Retry-After") if response is not None else None
+        if header and header.isdigit():
+            return min(int(header), MAX_RETRY_AFTER)
+        return min(self.base_delay * (2 ** attempt), MAX_RETRY_AFTER)
+
+    async def request(self, method: str, url: str, authenticated: bool = True,
+                      headers: Optional[Dict[str, str]] = None, **kwargs) -> httpx.Response:
+        """
+        Send a request through the pool with the shared retry policy. `url` is an API
+        path ("/v1/files/...") or an absolute URL (rendered images live on S3, and
+        get no Figma token). Raises httpx.RequestError if the connection keeps failing.
+        """
+        request_headers = dict(headers or {})
+        if authenticated and self.token:
+            request_headers["X-Figma-Token"] = self.token
+
+        attempts = max(1, self.max_retries)
+        for attempt in range(attempts):
+            last_attempt = attempt == attempts - 1
+            await self._acquire(url)
+            try:
+                response = await self.client.request(method, url, headers=request_headers, **kwargs)
+            except httpx.RequestError as e:
+                if last_attempt:
+                    raise
+                delay = self._retry_delay(attempt)
+                logger.warning(f"[Figma] {type(e).__name__} on {url}, retrying in {delay:.0f}s")
+                await asyncio.sleep(delay)
+                continue
+
+            if response.status_code == 429 or response.status_code in RETRY_STATUSES:
+                delay = self._retry_delay(attempt, response)
+                paused = response.status_code == 429 and await self._rate_limited(url, delay)
+                if last_attempt:
+                    return response
+                label = "Rate Limit" if response.status_code == 429 else f"HTTP {response.status_code}"
+                logger.warning(f"[Figma {label}] Attempt {attempt + 1} failed. Sleeping {delay:.0f}s...")
+                if not paused:
+                    await asyncio.sleep(delay)
+                continue
+            return response
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+    @asynccontextmanager
+    async def stream(self, url: str, authenticated: bool = True,
+                     headers: Optional[Dict[str, str]] = None) -> AsyncIterator[httpx.Response]:
+        """
+        GET with the body left unread (resp.aiter_bytes()), for documents too large
+        to hold in memory. Same retry policy as request(); retries happen before any
+        of the body is consumed.
+        """
+        request_headers = dict(headers or {})
+        if authenticated and self.token:
+            request_headers["X-Figma-Token"] = self.token
+
+        attempts = max(1, self.max_retries)
+        for attempt in range(attempts):
+            last_attempt = attempt == attempts - 1
+            await self._acquire(url)
+            try:
+                response = await self.client.send(self.client.build_request("GET", url, headers=request_headers), stream=True)
+            except httpx.RequestError as e:
+                if last_attempt:
+                    raise
+                delay = self._retry_delay(attempt)
+                logger.warning(f"[Figma] {type(e).__name__} on {url}, retrying in {delay:.0f}s")
+                await asyncio.sleep(delay)
+                continue
+
+            if response.status_code == 429 or response.status_code in RETRY_STATUSES:
+                delay = self._retry_delay(attempt, response)
+                paused = response.status_code == 429 and await self._rate_limited(url, delay)
+                if not last_attempt:
+                    await response.aclose()
+                    logger.warning(f"[Figma HTTP {response.status_code}] Attempt {attempt + 1} failed. Sleeping {delay:.0f}s...")
+                    if not paused:
+                        await asyncio.sleep(delay)
+                    continue
+            try:
+                yield response
+            finally:
+                await response.aclose()
+            return
+
+    async def aclose(self):
+        if self._client is not None and not self._client.is_closed:
+            try:
+                await self._client.aclose()
+            except RuntimeError:
+                # Created on an event loop that is already closed
+                pass
+        self._client = None
@@ -0,0 +1,143 @@
+"""
+figma_stream.py - Whole-file syncs without holding the whole Figma document
+
+`/v1/files/{key}?depth=5` can be tens of MB of JSON, and `resp.json()` keeps
+all of it (plus the parsed tree, several times larger) alive while the worker
+only needs the FRAME children of each page. With the optional `ijson` package
+installed, the response body is parsed incrementally as it arrives: one
+top-level frame is built at a time and written to a FrameSpool (a temp file,
+one JSON line per frame), everything else is discarded. The worker then reads
+frames back one at a time, so its memory stays bounded by the frames being
+processed rather than by the file size.
+
+Without ijson the body is parsed in one go and the frames are spooled
+afterwards, so the document tree is released before frame processing starts.
+
+FIGMA_STREAM_FRAMES=auto (default: stream when ijson is installed), 1 or 0.
+"""
+import os
+import json
+import tempfile
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+import httpx
+
+STREAM_FRAMES = os.getenv("FIGMA_STREAM_FRAMES", "auto").lower()
+
+# ijson prefixes of a /v1/files response: document -> pages (CANVAS) -> top-level nodes
+FRAME_PREFIX = "document.children.item.children.item"
+META_FIELDS = ("name", "lastModified", "version")
+
+
+def ijson_available() -> bool:
+    try:
+        import ijson  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def streaming_enabled() -> bool:
+    if STREAM_FRAMES in ("0", "false", "no", "off"):
+        return False
+    if STREAM_FRAMES in ("1", "true", "yes", "on"):
+        return True
+    return ijson_available()
+
+
+class FrameSpool:
+    """
+    Top-level frames of a document, parked in a temp file. Indexable like a list;
+    each access reads (and parses) only that frame. `entries` keeps what the
+    worker needs up front: id, name and an optional fingerprint per frame.
+    """
+
+    def __init__(self, fingerprint: Optional[Callable[[dict], str]] = None):
+        self._file = tempfile.TemporaryFile()
+        self._offsets: List[int] = []
+        self._lock = threading.Lock()
+        self._fingerprint = fingerprint
+        self.entries: List[Dict[str, Any]] = []
+        self.meta: Dict[str, Any] = {}
+        self.bytes = 0
+
+    def add(self, frame: dict):
+        line = json.dumps(frame, separators=(",", ":")).encode("utf-8") + b"\n"
+        with self._lock:
+            self._file.seek(0, os.SEEK_END)
+            self._offsets.append(self._file.tell())
+            self._file.write(line)
+        self.bytes += len(line)
+        entry = {"id": frame.get("id"), "name": frame.get("name")}
+        if self._fingerprint:
+            entry["fingerprint"] = self._fingerprint(frame)
+        self.entries.append(entry)
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def __getitem__(self, index: int) -> dict:
+        with self._lock:
+            self._file.seek(self._offsets[index])
+            return json.loads(self._file.readline())
+
+    def close(self):
+        self._file.close()
+
+
+def spool_document(document: dict, spool: FrameSpool):
+    """Spool the FRAME children of every page of an already parsed document."""
+    for page in document.get("children", []):
+        if page.get("type") == "CANVAS":
+            for child in page.get("children", []):
+                if child.get("type") == "FRAME":
+                    spool.add(child)
+
+
+class _BodyReader:
+    """Adapts an httpx byte stream to the `await read(n)` interface ijson's async parser expects."""
+
+    def __init__(self, response: httpx.Response):
+        self._chunks = response.aiter_bytes()
+        self._buffer = b""
+
+    async def read(self, size: int = -1) -> bytes:
+        # ijson probes with read(0) to learn whether the stream gives bytes or str
+        if size == 0:
+            return b""
+        while not self._buffer:
+            try:
+                self._buffer = await self._chunks.__anext__()
+            except StopAsyncIteration:
+                return b""
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+async def spool_file_response(response: httpx.Response, spool: FrameSpool, stream: bool = True):
+    """Fill `spool` (frames + name/version/lastModified) from a /v1/files response."""
+    if not (stream and ijson_available()):
+        data = json.loads(await response.aread())
+        spool.meta = {field: data.get(field) for field in META_FIELDS}
+        spool_document(data.get("document") or {}, spool)
+        return
+
+    import ijson
+    builder = None
+    async for prefix, event, value in ijson.parse_async(_BodyReader(response), use_float=True):
+        if builder is None:
+            if prefix == FRAME_PREFIX and event == "start_map":
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+            elif prefix in META_FIELDS and event in ("string", "number"):
+                spool.meta[prefix] = value
+            continue
+        builder.event(event, value)
+        if prefix == FRAME_PREFIX and event == "end_map":
+            node = builder.value
+            builder = None
+            if node.get("type") == "FRAME":
+                spool.add(node)
@@ -0,0 +1,46 @@
+"""
+frame_fingerprints.py - Last successful generation per Figma frame
+
+The worker hashes every frame subtree before generating code for it. If the
+hash matches the one recorded after the last successful run (and the output
+still exists), the frame is skipped: no image download, no Gemini call, no MR.
+"""
+import logging
+from pathlib import Path
+from typing import Dict, Any, Optional
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = Path(__file__).parent.parent.parent / "events.db"
+
+
+class FrameFingerprintStore:
+    def __init__(self, db_path: Path = DB_PATH):
+        self.db_path = db_path
+
+    async def get(self, file_key: str, node_id: str) -> Optional[Dict[str, Any]]:
+        """Fingerprint and output path recorded for a frame, or None if it was never generated."""
+        async with aiosqlite.connect(self.db_path) as db:
+            cursor = await db.execute("""
+                SELECT fingerprint, output_path, updated_at FROM frame_fingerprints
+                WHERE file_key = ? AND node_id = ?
+            """, (file_key, node_id))
+            row = await cursor.fetchone()
+        if not row:
+            return None
+        return {"fingerprint": row[0], "output_path": row[1], "updated_at": row[2]}
+
+    async def record(self, file_key: str, node_id: str, fingerprint: str, output_path: Optional[str]):
+        """Remember the fingerprint of a frame after its code was generated successfully."""
+        async with aiosqlite.connect(self.db_path) as db:
+            await db.execute("""
+                INSERT INTO frame_fingerprints (file_key, node_id, fingerprint, output_path, updated_at)
+                VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(file_key, node_id) DO UPDATE SET
+                    fingerprint = excluded.fingerprint,
+                    output_path = excluded.output_path,
+                    updated_at = excluded.updated_at
+            """, (file_key, node_id, fingerprint, output_path))
+            await db.commit()
@@ -0,0 +1,126 @@
+"""
+image_prep.py - Shrink rendered frame images before they go into a vision prompt
+
+Figma renders frames at their full size, so a large page becomes a multi-MB
+PNG that slows down both the upload and the model. prepare_image() decodes the
+image once (with the optional Pillow package), scales it down so its longest
+edge is at most VISION_MAX_EDGE pixels, and can re-encode it as JPEG or WebP
+(VISION_IMAGE_FORMAT, at VISION_IMAGE_QUALITY). Everything stays in memory.
+
+An image that is already small enough, and already in the wanted format, is
+passed through untouched. If the re-encoded image would be larger than the
+original, the original is kept. Without Pillow every image is passed through
+as-is.
+
+VISION_IMAGE_FORMAT: png (default, lossless; only resized images are
+re-encoded), jpeg or webp.
+"""
+import io
+import os
+import logging
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+VISION_MAX_EDGE = int(os.getenv("VISION_MAX_EDGE", "1568"))
+VISION_IMAGE_FORMAT = os.getenv("VISION_IMAGE_FORMAT", "png").lower()
+VISION_IMAGE_QUALITY = int(os.getenv("VISION_IMAGE_QUALITY", "85"))
+
+MIME_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp", "gif": "image/gif"}
+# Pillow format name -> our format name
+PIL_FORMATS = {"PNG": "png", "JPEG": "jpeg", "WEBP": "webp", "GIF": "gif"}
+
+_warned_no_pillow = False
+
+
+@dataclass
+class PreparedImage:
+    data: bytes
+    mime_type: str
+    original_bytes: int
+    original_size: Optional[Tuple[int, int]] = None
+    size: Optional[Tuple[int, int]] = None
+    # "resized", "converted", "unchanged" or "skipped" (Pillow not installed / undecodable)
+    outcome: str = "unchanged"
+
+    def describe(self) -> str:
+        """One line for logs and span details, e.g. "2880x1800 -> 1568x980 image/jpeg"."""
+        if not self.original_size:
+            return self.mime_type
+        before = "x".join(map(str, self.original_size))
+        after = "x".join(map(str, self.size or self.original_size))
+        return f"{before} -> {after} {self.mime_type}"
+
+
+def pillow_available() -> bool:
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def sniff_format(data: bytes) -> str:
+    """Image format from the file signature (png when unknown, as Figma renders PNG by default)."""
+    if data[:3] == b"\xff\xd8\xff":
+        return "jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    return "png"
+
+
+def prepare_image(data: bytes, max_edge: int = VISION_MAX_EDGE, target_format: str = VISION_IMAGE_FORMAT,
+                  quality: int = VISION_IMAGE_QUALITY) -> PreparedImage:
+    """
+    Downscale / re-encode `data` for a vision prompt. CPU-bound: async callers
+    should run it with asyncio.to_thread.
+    """
+    source_format = sniff_format(data)
+    passthrough = PreparedImage(data, MIME_TYPES[source_format], len(data), outcome="skipped")
+    if not pillow_available():
+        global _warned_no_pillow
+        if not _warned_no_pillow:
+            _warned_no_pillow = True
+            logger.warning("Pillow not installed: vision images are sent at full size (pip install Pillow)")
+        return passthrough
+
+    from PIL import Image
+    try:
+        image = Image.open(io.BytesIO(data))
+        original_size = image.size
+        source_format = PIL_FORMATS.get(image.format, source_format)
+        target = target_format if target_format in ("jpeg", "webp") else source_format
+        needs_resize = max_edge > 0 and max(original_size) > max_edge
+        if not needs_resize and target == source_format:
+            return PreparedImage(data, MIME_TYPES[source_format], len(data), original_size, original_size)
+
+        image.load()
+        if needs_resize:
+            image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        if target == "jpeg" and image.mode != "RGB":
+            # JPEG has no alpha: flatten onto white, as the frame would look on a page
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            rgba = image.convert("RGBA")
+            background.paste(rgba, mask=rgba.getchannel("A"))
+            image = background
+        elif target == "png" and image.mode == "P":
+            image = image.convert("RGBA")
+
+        out = io.BytesIO()
+        if target in ("jpeg", "webp"):
+            image.save(out, format=target.upper(), quality=quality, optimize=True)
+        else:
+            target = "png"
+            image.save(out, format="PNG", optimize=True)
+    except Exception as e:
+        logger.warning(f"Image preprocessing failed, sending the original: {e}")
+        return passthrough
+
+    prepared = out.getvalue()
+    if not needs_resize and len(prepared) >= len(data):
+        return PreparedImage(data, MIME_TYPES[source_format], len(data), original_size, original_size)
+    return PreparedImage(prepared, MIME_TYPES[target], len(data), original_size, image.size,
+                         "resized" if needs_resize else "converted")
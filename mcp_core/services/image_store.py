@@ -0,0 +1,88 @@
+"""
+image_store.py - In-memory rendered frame images, keyed by (file_key, version, node_id)
+
+The worker renders the images of every frame on a page with one /v1/images
+call and downloads them concurrently (figma.prefetch_frame_images). Each image
+is a future in this store, so a frame that needs its image before the download
+has finished simply waits for it, and every later frame finds it ready.
+
+A rendered image of a given file version never changes, so entries stay valid
+until they are pushed out: the total size of finished images is capped
+(FIGMA_IMAGE_CACHE_MAX_MB) and the least recently used ones are dropped first.
+"""
+import os
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+IMAGE_CACHE_MAX_BYTES = int(float(os.getenv("FIGMA_IMAGE_CACHE_MAX_MB", "64")) * 1024 * 1024)
+
+ImageKey = Tuple[str, str, str]
+
+
+class FrameImageStore:
+    def __init__(self, max_bytes: int = IMAGE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[ImageKey, asyncio.Future]" = OrderedDict()
+        self._sizes: Dict[ImageKey, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def bytes(self) -> int:
+        return sum(self._sizes.values())
+
+    def get(self, file_key: str, version: str, node_id: str) -> Optional[asyncio.Future]:
+        """The (possibly still downloading) image of a node, or None if it was never requested."""
+        key = (file_key, str(version), node_id)
+        future = self._entries.get(key)
+        if future is None or future.get_loop() is not asyncio.get_running_loop():
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return future
+
+    def reserve(self, file_key: str, version: str, node_ids: List[str]) -> Dict[str, asyncio.Future]:
+        """Futures for the ids that are not stored yet; the caller must resolve them (bytes or None)."""
+        loop = asyncio.get_running_loop()
+        reserved = {}
+        for node_id in node_ids:
+            key = (file_key, str(version), node_id)
+            existing = self._entries.get(key)
+            if existing is not None and existing.get_loop() is loop:
+                continue
+            future = loop.create_future()
+            future.add_done_callback(lambda done, key=key: self._finished(key, done))
+            self._entries[key] = future
+            reserved[node_id] = future
+        return reserved
+
+    def _finished(self, key: ImageKey, future: asyncio.Future):
+        if self._entries.get(key) is not future:
+            return
+        data = None if future.cancelled() or future.exception() else future.result()
+        if data is None:
+            # Failed renders are not cached: the next request tries again
+            del self._entries[key]
+            return
+        self._sizes[key] = len(data)
+        self._evict()
+
+    def _evict(self):
+        total = self.bytes
+        for key in list(self._entries):
+            if total <= self.max_bytes:
+                break
+            if key in self._sizes:
+                total -= self._sizes.pop(key)
+                del self._entries[key]
+                self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._sizes.clear()
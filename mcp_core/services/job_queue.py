@@ -0,0 +1,519 @@
+"""
+job_queue.py - Lease-based job queue over the events table
+
+Several worker processes can share one events.db:
+- claim_batch() atomically moves pending rows to 'processing' and stamps them
+  with leased_by / lease_expires_at (UPDATE ... RETURNING inside BEGIN IMMEDIATE)
+- heartbeat() extends every lease held by this worker while it is alive;
+  renew() extends one lease and tells whether it is still held, so a job
+  reaped while earlier jobs of the batch ran is not started twice
+- reap_expired() puts rows whose lease ran out (crashed worker), or that have
+  been processing for longer than processing_timeout (hung worker), back to
+  'pending'. Every claim counts as an attempt; a row that gets stuck again
+  after max_attempts is moved to 'dead_letter' instead of being retried forever
+- recover_orphans() runs at worker startup: leases held by dead processes on
+  this host are reaped immediately instead of waiting for them to expire
+- complete() finishes a row, but only if this worker still holds the lease
+- release() hands claimed jobs that were never started back to 'pending'
+- fail() records a failed run: the row goes back to 'pending' with an
+  exponential backoff on due_at, or to 'dead_letter' once it has used up
+  max_attempts
+
+Every accepted delivery id is recorded in webhook_deliveries. A coalesced row
+only keeps the id of its latest delivery, so a late Figma retry of an earlier
+delivery would otherwise coalesce in again with a stale payload.
+
+Debounce is durable: every upsert pushes due_at to last_seen + window, and
+only rows whose due_at has passed can be claimed. A burst of edits to one node
+therefore collapses into a single row that becomes due once the designer
+stops, and the schedule survives worker restarts.
+
+Scheduling: every event is in a lane - 'targeted' (!sync comments), 'webhook'
+(Figma FILE_UPDATE) or 'poll' (synthesized by the worker's Figma poller).
+claim_batch() orders due rows by weighted fair queuing: inside a lane, files
+take turns (the n-th row of a file ranks behind the first row of every other
+file), and lane ranks are divided by LANE_WEIGHTS, so a !sync is claimed ahead
+of bulk work without starving it. lane_depths() reports the backlog per lane.
+"""
+import os
+import json
+import asyncio
+import time
+import socket
+import logging
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Any, Iterable, List, Optional
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = Path(__file__).parent.parent.parent / "events.db"
+DEFAULT_LEASE_SECONDS = float(os.getenv("WORKER_LEASE_SECONDS", "120"))
+# Quiet period after the last edit before a file/node is processed
+DEBOUNCE_WINDOW = float(os.getenv("DEBOUNCE_WINDOW", "30"))
+# An explicit !sync comment only waits long enough to absorb double-posts
+TARGETED_DEBOUNCE_WINDOW = float(os.getenv("TARGETED_DEBOUNCE_WINDOW", "2"))
+# Claims before a repeatedly failing or stuck event is parked as 'dead_letter'
+MAX_ATTEMPTS = int(os.getenv("WORKER_MAX_ATTEMPTS", "3"))
+# Delay before a failed event is retried, doubled per attempt up to RETRY_BACKOFF_MAX
+RETRY_BACKOFF = float(os.getenv("WORKER_RETRY_BACKOFF", "60"))
+RETRY_BACKOFF_MAX = float(os.getenv("WORKER_RETRY_BACKOFF_MAX", "1800"))
+# A row processing for longer than this is considered stuck even if its lease is still renewed
+PROCESSING_TIMEOUT = float(os.getenv("WORKER_PROCESSING_TIMEOUT", "1800"))
+
+# Delivery ids older than this are forgotten (Figma stops retrying long before)
+DELIVERY_RETENTION = float(os.getenv("WEBHOOK_DELIVERY_RETENTION_DAYS", "7")) * 86400
+
+# Lanes in priority order, and their share of claims (e.g. LANE_WEIGHTS="targeted=8,webhook=3,poll=1")
+LANES = ("targeted", "webhook", "poll")
+
+
+def parse_lane_weights(value: str) -> Dict[str, float]:
+    weights = {"targeted": 8.0, "webhook": 3.0, "poll": 1.0}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        lane, _, weight = item.partition("=")
+        if lane.strip() in weights and float(weight) > 0:
+            weights[lane.strip()] = float(weight)
+    return weights
+
+
+LANE_WEIGHTS = parse_lane_weights(os.getenv("LANE_WEIGHTS", ""))
+
+# Insert a new pending event, or coalesce it into the pending row for the same
+# (file_key, node_id), pushing its due_at back. Duplicate event_ids (Figma
+# retries) return no row. A coalesced row keeps the higher-priority lane, and a
+# targeted row is not pushed back by bulk updates landing on the same node; it
+# also keeps its TARGETED_SYNC type and !sync payload (comment metadata).
+UPSERT_EVENT_SQL = """
+    INSERT INTO events (event_id, event_type, file_key, file_name, node_id, timestamp, payload, due_at, lane)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(event_id) DO NOTHING
+    ON CONFLICT(file_key, IFNULL(node_id, '')) WHERE status = 'pending' DO UPDATE SET
+        event_id = excluded.event_id,
+        event_type = CASE WHEN events.lane = 'targeted' AND excluded.lane != 'targeted' THEN events.event_type ELSE excluded.event_type END,
+        file_name = excluded.file_name,
+        timestamp = excluded.timestamp,
+        payload = CASE WHEN events.lane = 'targeted' AND excluded.lane != 'targeted' THEN events.payload ELSE excluded.payload END,
+        due_at = CASE WHEN events.lane = 'targeted' THEN MIN(events.due_at, excluded.due_at) ELSE excluded.due_at END,
+        lane = CASE
+            WHEN 'targeted' IN (events.lane, excluded.lane) THEN 'targeted'
+            WHEN 'webhook' IN (events.lane, excluded.lane) THEN 'webhook'
+            ELSE 'poll'
+        END,
+        revision = events.revision + 1
+    RETURNING id
+"""
+
+DELIVERIES_SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS webhook_deliveries (
+        event_id TEXT PRIMARY KEY,
+        received_at REAL NOT NULL
+    )
+"""
+
+RECORD_DELIVERY_SQL = """
+    INSERT INTO webhook_deliveries (event_id, received_at) VALUES (?, ?)
+    ON CONFLICT(event_id) DO NOTHING
+"""
+
+# A failed run is retried after a backoff, or dead-lettered after max_attempts claims.
+# If a newer event for the same node is already pending, it covers the retry.
+FAIL_EVENT_SQL = """
+    UPDATE events
+    SET status = CASE
+            WHEN attempts >= ? THEN 'dead_letter'
+            WHEN EXISTS (
+                SELECT 1 FROM events AS other
+                WHERE other.status = 'pending'
+                  AND other.file_key = events.file_key
+                  AND IFNULL(other.node_id, '') = IFNULL(events.node_id, '')
+            ) THEN 'superseded'
+            ELSE 'pending'
+        END,
+        due_at = ? + MIN(? * (1 << MAX(attempts - 1, 0)), ?),
+        completed_at = CASE WHEN attempts >= ? THEN ? ELSE completed_at END,
+        error_log = ?,
+        leased_by = NULL,
+        lease_expires_at = NULL
+    WHERE id = ? AND leased_by = ? AND status = 'processing'
+    RETURNING status, due_at
+"""
+
+JOB_COLUMNS = "id, event_id, event_type, file_key, file_name, node_id, timestamp, payload, revision, attempts, lane"
+
+# Weighted fair order over due rows. file_rank: position of a row within its file
+# (files take turns inside a lane); lane_rank: position within the lane in that
+# round-robin order; dividing by the lane weight interleaves the lanes.
+FAIR_CLAIM_ORDER_SQL = """
+    SELECT id FROM (
+        SELECT id, lane, due_at, ROW_NUMBER() OVER (
+            PARTITION BY lane ORDER BY file_rank, due_at, id
+        ) AS lane_rank
+        FROM (
+            SELECT id, lane, due_at, ROW_NUMBER() OVER (
+                PARTITION BY lane, file_key ORDER BY due_at, id
+            ) AS file_rank
+            FROM events
+            WHERE status = 'pending' AND due_at <= ?
+        )
+    )
+    ORDER BY lane_rank / (CASE lane WHEN 'targeted' THEN ? WHEN 'webhook' THEN ? ELSE ? END),
+             CASE lane WHEN 'targeted' THEN 0 WHEN 'webhook' THEN 1 ELSE 2 END,
+             due_at, id
+    LIMIT ?
+"""
+
+
+def event_lane(event: Dict[str, Any]) -> str:
+    if event.get("event_type") == "TARGETED_SYNC":
+        return "targeted"
+    if event.get("source") == "poll":
+        return "poll"
+    return "webhook"
+
+
+def debounce_window(event_type: Optional[str]) -> float:
+    return TARGETED_DEBOUNCE_WINDOW if event_type == "TARGETED_SYNC" else DEBOUNCE_WINDOW
+
+
+def build_event_row(event: Dict[str, Any]) -> tuple:
+    """Convert an event dict into the column tuple used by UPSERT_EVENT_SQL."""
+    event_type = event.get("event_type", "FILE_UPDATE")
+    webhook_id = event.get("webhook_id", "unknown")
+    timestamp = event.get("timestamp", datetime.now(timezone.utc).isoformat())
+    # Figma re-delivers with the same webhook_id + timestamp, so this pair is our dedupe key
+    unique_event_id = f"{webhook_id}_{timestamp}"
+
+    return (
+        unique_event_id,
+        event_type,
+        event.get("file_key"),
+        event.get("file_name"),
+        event.get("node_id"),
+        timestamp,
+        json.dumps(event),
+        time.time() + debounce_window(event_type),
+        event_lane(event)
+    )
+
+
+async def upsert_event(db: aiosqlite.Connection, row: tuple) -> int:
+    """
+    Record the delivery and insert (or coalesce) its event, inside the caller's
+    transaction. Returns the row id, or -1 for a delivery that was seen before.
+    """
+    cursor = await db.execute(RECORD_DELIVERY_SQL, (row[0], time.time()))
+    if cursor.rowcount == 0:
+        return -1
+    cursor = await db.execute(UPSERT_EVENT_SQL, row)
+    returned = await cursor.fetchall()
+    return returned[0][0] if returned else -1
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def is_dead_local_worker(worker_id: Optional[str]) -> bool:
+    """True if `worker_id` belongs to a process on this host that no longer exists."""
+    host, _, pid = (worker_id or "").rpartition(":")
+    if host != socket.gethostname() or not pid.isdigit() or int(pid) == os.getpid():
+        return False
+    if os.name == "nt":
+        # os.kill(pid, 0) would terminate the process on Windows; leave it to lease expiry
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        return False
+    return False
+
+
+class JobQueue:
+    def __init__(self, db_path: Path = DB_PATH, worker_id: Optional[str] = None, lease_seconds: float = DEFAULT_LEASE_SECONDS,
+                 max_attempts: int = MAX_ATTEMPTS, processing_timeout: float = PROCESSING_TIMEOUT,
+                 retry_backoff: float = RETRY_BACKOFF):
+        self.db_path = db_path
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.processing_timeout = processing_timeout
+        self.retry_backoff = retry_backoff
+        self._conn: Optional[aiosqlite.Connection] = None
+        # The connection is shared by the tick loop, heartbeat and poll tasks;
+        # statements from one must not land inside another's transaction
+        self._lock = asyncio.Lock()
+
+    async def _db(self) -> aiosqlite.Connection:
+        # One long-lived connection in autocommit mode; write transactions are explicit
+        if self._conn is None:
+            self._conn = await aiosqlite.connect(self.db_path, isolation_level=None)
+            await self._conn.execute("PRAGMA journal_mode=WAL")
+            await self._conn.execute("PRAGMA busy_timeout=5000")
+            await self._conn.execute(DELIVERIES_SCHEMA_SQL)
+        return self._conn
+
+    async def close(self):
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+    async def _write(self, sql: str, params: tuple = ()) -> List[tuple]:
+        """Run one write statement inside BEGIN IMMEDIATE and return any RETURNING rows."""
+        async with self._lock:
+            db = await self._db()
+            await db.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = await db.execute(sql, params)
+                rows = await cursor.fetchall()
+                await db.execute("COMMIT")
+                return rows
+            except Exception:
+                await db.execute("ROLLBACK")
+                raise
+
+    @staticmethod
+    def _row_to_job(row: tuple) -> Dict[str, Any]:
+        return {
+            "id": row[0],
+            "event_id": row[1],
+            "event_type": row[2],
+            "file_key": row[3],
+            "file_name": row[4],
+            "node_id": row[5],
+            "timestamp": row[6],
+            "payload": json.loads(row[7]) if row[7] else {},
+            "revision": row[8],
+            "attempts": row[9],
+            "lane": row[10]
+        }
+
+    async def enqueue(self, event: Dict[str, Any]) -> int:
+        """Add (or coalesce) a pending event. Returns the row id, or -1 for a duplicate."""
+        async with self._lock:
+            db = await self._db()
+            await db.execute("BEGIN IMMEDIATE")
+            try:
+                row_id = await upsert_event(db, build_event_row(event))
+                await db.execute("COMMIT")
+                return row_id
+            except Exception:
+                await db.execute("ROLLBACK")
+                raise
+
+    async def claim_batch(self, limit: int = 1) -> List[Dict[str, Any]]:
+        """
+        Atomically lease up to `limit` pending events whose debounce window has passed,
+        picked in weighted fair order. Returned highest-priority lane first.
+        """
+        now = time.time()
+        weights = (LANE_WEIGHTS["targeted"], LANE_WEIGHTS["webhook"], LANE_WEIGHTS["poll"])
+        rows = await self._write(f"""
+            UPDATE events
+            SET status = 'processing', leased_by = ?, lease_expires_at = ?, started_at = ?, attempts = attempts + 1
+            WHERE id IN ({FAIR_CLAIM_ORDER_SQL})
+            RETURNING {JOB_COLUMNS}
+        """, (self.worker_id, now + self.lease_seconds, datetime.now(timezone.utc).isoformat(), now, *weights, limit))
+        jobs = [self._row_to_job(row) for row in rows]
+        # RETURNING order is unspecified
+        jobs.sort(key=lambda job: (LANES.index(job["lane"]) if job["lane"] in LANES else len(LANES), job["id"]))
+        return jobs
+
+    async def lane_depths(self) -> Dict[str, Dict[str, Any]]:
+        """Backlog per lane (see queue_depths)."""
+        async with self._lock:
+            return await queue_depths(await self._db())
+
+    async def next_due_at(self) -> Optional[float]:
+        """Earliest due_at among pending events (epoch seconds), or None if the queue is empty."""
+        async with self._lock:
+            db = await self._db()
+            cursor = await db.execute("SELECT MIN(due_at) FROM events WHERE status = 'pending'")
+            row = await cursor.fetchone()
+            return row[0] if row else None
+
+    async def heartbeat(self) -> int:
+        """Extend every lease held by this worker. Returns the number of leases renewed."""
+        async with self._lock:
+            db = await self._db()
+            cursor = await db.execute("""
+                UPDATE events SET lease_expires_at = ?
+                WHERE leased_by = ? AND status = 'processing'
+            """, (time.time() + self.lease_seconds, self.worker_id))
+            return cursor.rowcount
+
+    async def renew(self, event_id: int) -> bool:
+        """Extend the lease of one event. False if this worker no longer holds it."""
+        async with self._lock:
+            db = await self._db()
+            cursor = await db.execute("""
+                UPDATE events SET lease_expires_at = ?
+                WHERE id = ? AND leased_by = ? AND status = 'processing'
+            """, (time.time() + self.lease_seconds, event_id, self.worker_id))
+            return cursor.rowcount > 0
+
+    async def release(self, event_ids: Iterable[int]) -> int:
+        """
+        Give claimed events that were never started back to the queue, without using up
+        an attempt. Superseded if a newer event for the node is already pending.
+        """
+        event_ids = list(event_ids)
+        if not event_ids:
+            return 0
+        rows = await self._write(f"""
+            UPDATE events
+            SET status = CASE WHEN EXISTS (
+                    SELECT 1 FROM events AS other
+                    WHERE other.status = 'pending'
+                      AND other.file_key = events.file_key
+                      AND IFNULL(other.node_id, '') = IFNULL(events.node_id, '')
+                ) THEN 'superseded' ELSE 'pending' END,
+                attempts = MAX(attempts - 1, 0),
+                leased_by = NULL,
+                lease_expires_at = NULL
+            WHERE id IN ({", ".join("?" * len(event_ids))}) AND leased_by = ? AND status = 'processing'
+            RETURNING id
+        """, (*event_ids, self.worker_id))
+        return len(rows)
+
+    async def complete(self, event_id: int, status: str = "processed", error: Optional[str] = None) -> bool:
+        """Finish a leased event. Returns False if the lease was lost (reaped and re-claimed)."""
+        async with self._lock:
+            db = await self._db()
+            cursor = await db.execute("""
+                UPDATE events
+                SET status = ?, completed_at = ?, error_log = ?, leased_by = NULL, lease_expires_at = NULL
+                WHERE id = ? AND leased_by = ? AND status = 'processing'
+            """, (status, datetime.now(timezone.utc).isoformat(), error, event_id, self.worker_id))
+            return cursor.rowcount > 0
+
+    async def fail(self, event_id: int, error: str) -> Optional[str]:
+        """
+        Record a failed run of a leased event. Returns its new status: 'pending' (retried
+        after the backoff), 'superseded' (a newer pending event covers it) or 'dead_letter'
+        (max_attempts used up); None if the lease was lost.
+        """
+        now = time.time()
+        rows = await self._write(FAIL_EVENT_SQL, (
+            self.max_attempts, now, self.retry_backoff, RETRY_BACKOFF_MAX,
+            self.max_attempts, datetime.now(timezone.utc).isoformat(), error, event_id, self.worker_id
+        ))
+        if not rows:
+            return None
+        status, due_at = rows[0]
+        if status == "dead_letter":
+            logger.error(f"Event {event_id} failed {self.max_attempts} times, moved to dead_letter: {error}")
+        elif status == "pending":
+            logger.warning(f"Event {event_id} failed, retrying in {due_at - now:.0f}s: {error}")
+        return status
+
+    async def reap_expired(self, dead_workers: Iterable[str] = ()) -> int:
+        """
+        Recover stuck events: lease expired, processing for longer than processing_timeout,
+        or leased by one of `dead_workers`. They go back to 'pending', or to 'dead_letter'
+        once they have been claimed max_attempts times. Returns the number re-queued.
+        """
+        now = time.time()
+        # started_at is an ISO-8601 UTC string, so it compares correctly as text
+        started_cutoff = datetime.fromtimestamp(now - self.processing_timeout, timezone.utc).isoformat()
+        dead_workers = list(dead_workers)
+        dead_marks = ", ".join("?" * len(dead_workers))
+
+        def stuck(table: str) -> str:
+            condition = f"({table}.lease_expires_at < ? OR {table}.started_at < ?"
+            if dead_workers:
+                condition += f" OR {table}.leased_by IN ({dead_marks})"
+            return condition + ")"
+
+        stuck_params = (now, started_cutoff, *dead_workers)
+
+        async with self._lock:
+            db = await self._db()
+            await db.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = await db.execute(f"""
+                    UPDATE events
+                    SET status = 'dead_letter', completed_at = ?, leased_by = NULL, lease_expires_at = NULL,
+                        error_log = 'Stuck in processing after ' || attempts || ' attempts (last worker: ' || IFNULL(leased_by, '?') || ')'
+                    WHERE status = 'processing' AND attempts >= ? AND {stuck("events")}
+                """, (datetime.now(timezone.utc).isoformat(), self.max_attempts, *stuck_params))
+                dead_lettered = cursor.rowcount
+                # Only one pending row may exist per (file, node): if a newer pending row or a
+                # newer stuck sibling exists, the stale one is superseded instead of re-queued
+                await db.execute(f"""
+                    UPDATE events
+                    SET status = 'superseded', leased_by = NULL, lease_expires_at = NULL
+                    WHERE status = 'processing' AND {stuck("events")}
+                      AND EXISTS (
+                          SELECT 1 FROM events AS other
+                          WHERE other.file_key = events.file_key
+                            AND IFNULL(other.node_id, '') = IFNULL(events.node_id, '')
+                            AND (
+                                other.status = 'pending'
+                                OR (other.status = 'processing' AND {stuck("other")} AND other.id > events.id)
+                            )
+                      )
+                """, (*stuck_params, *stuck_params))
+                cursor = await db.execute(f"""
+                    UPDATE events
+                    SET status = 'pending', leased_by = NULL, lease_expires_at = NULL
+                    WHERE status = 'processing' AND {stuck("events")}
+                """, stuck_params)
+                requeued = cursor.rowcount
+                await db.execute("COMMIT")
+            except Exception:
+                await db.execute("ROLLBACK")
+                raise
+
+        if dead_lettered:
+            logger.error(f"Moved {dead_lettered} events to dead_letter after {self.max_attempts} attempts")
+        if requeued:
+            logger.warning(f"Re-queued {requeued} stuck events")
+        return requeued
+
+    async def recover_orphans(self) -> int:
+        """
+        Startup recovery: reap events leased by workers on this host that are no longer
+        running (e.g. the previous run of this worker), plus anything else that is stuck.
+        Also forgets webhook delivery ids older than DELIVERY_RETENTION.
+        """
+        async with self._lock:
+            db = await self._db()
+            cursor = await db.execute("SELECT DISTINCT leased_by FROM events WHERE status = 'processing'")
+            owners = [row[0] for row in await cursor.fetchall()]
+            await db.execute("DELETE FROM webhook_deliveries WHERE received_at < ?", (time.time() - DELIVERY_RETENTION,))
+        dead_workers = [owner for owner in owners if is_dead_local_worker(owner)]
+        if dead_workers:
+            logger.warning(f"Recovering events leased by dead workers: {dead_workers}")
+        return await self.reap_expired(dead_workers)
+
+
+async def queue_depths(db: aiosqlite.Connection) -> Dict[str, Dict[str, Any]]:
+    """
+    Per lane: pending rows, how many of them are due, rows being processed,
+    and how long the oldest due row has been waiting (seconds).
+    """
+    now = time.time()
+    cursor = await db.execute("""
+        SELECT lane,
+               SUM(status = 'pending'),
+               SUM(status = 'pending' AND due_at <= ?),
+               SUM(status = 'processing'),
+               MIN(CASE WHEN status = 'pending' AND due_at <= ? THEN due_at END)
+        FROM events
+        WHERE status IN ('pending', 'processing')
+        GROUP BY lane
+    """, (now, now))
+    depths = {lane: {"pending": 0, "due": 0, "processing": 0, "oldest_due_seconds": None} for lane in LANES}
+    for lane, pending, due, processing, oldest_due in await cursor.fetchall():
+        depths[lane] = {
+            "pending": pending or 0,
+            "due": due or 0,
+            "processing": processing or 0,
+            "oldest_due_seconds": round(now - oldest_due, 1) if oldest_due is not None else None
+        }
+    return depths
@@ -1,19 +1,44 @@
 import os
+import re
 import json
+import asyncio
 import logging
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 import google.generativeai as genai
 from pathlib import Path
 
+from .image_prep import prepare_image
+from .rate_limiter import RateLimiter
+
 # Initialize a logger to track what this file is doing (for debugging)
 logger = logging.getLogger("llm_coder")
 
+# Upper bound (seconds) for a single Gemini call made through the async methods
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "120"))
+# How long a Gemini 429 pauses the shared "gemini" bucket when the error carries no retry delay
+GEMINI_RATE_LIMIT_PAUSE = float(os.getenv("GEMINI_RATE_LIMIT_PAUSE", "30"))
+MAX_GEMINI_PAUSE = 300
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """google.api_core's ResourceExhausted (HTTP 429 / RESOURCE_EXHAUSTED)."""
+    return getattr(error, "code", None) == 429 or str(error).startswith("429")
+
+
+def gemini_retry_after(error: Exception) -> float:
+    """The server's suggested delay ("Please retry in 23.4s" / "retry_delay { seconds: 23 }"), else the default."""
+    match = re.search(r"retry in ([\d.]+)s|retry_delay\s*\{\s*seconds:\s*(\d+)", str(error))
+    if match:
+        return min(float(match.group(1) or match.group(2)), MAX_GEMINI_PAUSE)
+    return GEMINI_RATE_LIMIT_PAUSE
+
+
 class LLMCoder:
     """
     This class is the 'Brain' of the operation. 
     It communicates with Google Gemini (AI) to generate, route, and fix code.
     """
-    def __init__(self):
+    def __init__(self, rate_limiter: Optional[RateLimiter] = None):
         # 1. SETUP GEMINI API
         # We look for the GEMINI_API_KEY in the environment variables (.env file).
         # Without this key, we cannot talk to the Google AI.
@@ -28,6 +53,9 @@ class LLMCoder:
         # We are using 'gemini-flash-latest' because it is fast and cost-effective.
         self.model_name = "gemini-flash-latest"
         self.model = genai.GenerativeModel(self.model_name)
+        self.timeout = LLM_TIMEOUT
+        # Shared "gemini" token bucket (ToolContext.rate_limiter); None calls Gemini unthrottled
+        self.rate_limiter = rate_limiter
         
         # 3. LOAD PROJECT SETTINGS
         # We read the 'mcp_config.json' file to understand the project's style (React, Tailwind, etc.)
@@ -79,24 +107,27 @@ class LLMCoder:
         # Fallback default if config fails to load
         return "PROJECT CONFIGURATION: React (JS/TS), Tailwind CSS, Lucide Icons."
 
-    def generate_component(self, figma_data: Dict[str, Any], context_files: str = "", rag_context: str = "", image_path: str = None) -> Dict[str, str]:
-        """
-        MAIN FUNCTION: Generates React code from Figma data.
+    @staticmethod
+    def _load_image_blob(image_path: str) -> Dict[str, Any]:
+        """Reads an image file into the inline blob format the Gemini API expects (downscaled, see image_prep)."""
+        with open(image_path, "rb") as f:
+            image = prepare_image(f.read())
         
-        Args:
-            figma_data: The JSON data from Figma (node name, properties, etc.)
-            context_files: Content of existing files (to match style)
-            rag_context: Extra context found by searching the repo
-            image_path: Path to the screenshot image (if available)
-            
-        Returns:
-            A dictionary with 'file_name' and 'code'.
+        return {
+            "mime_type": image.mime_type,
+            "data": image.data
+        }
+
+    def _build_generation_contents(self, figma_data: Dict[str, Any], context_files: str, rag_context: str, image_path: Optional[str],
+                                   image_data: Optional[bytes] = None, image_mime_type: str = "image/png") -> list:
+        """
+        Builds the prompt (and optional screenshot) for generate_component / agenerate_component.
+        The screenshot is either in memory (`image_data`, already prepared, of type `image_mime_type`)
+        or a file (`image_path`).
         """
-        node_name = figma_data.get("name", "Component")
-        
         # --- SCENARIO 1: IMAGE + DATA (VISION MODE) ---
         # If we have a screenshot, we show it to the AI for better results.
-        if image_path and os.path.exists(image_path):
+        if image_data or (image_path and os.path.exists(image_path)):
             logger.info("   👁️ Activating Hybrid Vision + Data Mode...")
             
             # The PROMPT tells the AI exactly what to do.
@@ -154,20 +185,11 @@ Output ONLY the JSON. No markdown.
             contents = [prompt_text]
             
             try:
-                # Prepare the image for the Gemini API
-                mime_type = "image/png"
-                if image_path.lower().endswith(".jpg") or image_path.lower().endswith(".jpeg"):
-                    mime_type = "image/jpeg"
-                
-                with open(image_path, "rb") as f:
-                    image_data = f.read()
-                
-                image_blob = {
-                    "mime_type": mime_type,
-                    "data": image_data
-                }
                 # Attach image to the prompt
-                contents.append(image_blob)
+                if image_data:
+                    contents.append({"mime_type": image_mime_type, "data": image_data})
+                else:
+                    contents.append(self._load_image_blob(image_path))
             except Exception as e:
                 logger.warning(f"Failed to load image for generation: {e}")
 
@@ -219,47 +241,121 @@ Output ONLY the JSON. No markdown.
             """
             contents = [prompt_text]
 
+        return contents
+
+    @staticmethod
+    def _parse_generation_response(response) -> Dict[str, str]:
+        """
+        Validates Gemini's reply and extracts the {'file_name', 'code'} JSON object.
+        """
+        # Check if Gemini refused to answer (safety filters)
+        if not response.candidates or not response.candidates[0].content.parts:
+            finish_reason = response.candidates[0].finish_reason if response.candidates else "UNKNOWN"
+            logger.error(f"Gemini returned empty response (finish_reason: {finish_reason})")
+            raise ValueError(f"Gemini blocked or returned empty response. Finish reason: {finish_reason}")
+        
+        # Parse the JSON response
+        result = json.loads(response.text)
+        
+        # Verify we got both expected fields
+        if "code" not in result or "file_name" not in result:
+            raise ValueError("Gemini response missing 'code' or 'file_name' keys")
+            
+        return result
+
+    def _generate(self, contents, **kwargs):
+        """Blocking Gemini call, throttled by the shared "gemini" bucket."""
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire_sync("gemini")
+        try:
+            return self.model.generate_content(contents, **kwargs)
+        except Exception as e:
+            if self.rate_limiter is not None and is_rate_limit_error(e):
+                self.rate_limiter.pause_sync("gemini", gemini_retry_after(e))
+            raise
+
+    async def _agenerate(self, contents, timeout: Optional[float] = None, **kwargs):
+        """
+        Non-blocking Gemini call. Uses the SDK's async API so the worker's event loop keeps
+        running (polling, lease heartbeats, other frames) while the model thinks.
+        The call is cancelled if it exceeds `timeout` seconds (default: LLM_TIMEOUT).
+        Waiting for a "gemini" token does not count against the timeout; a 429 pauses
+        the bucket for every process before the error is raised.
+        """
+        timeout = timeout or self.timeout
+        if self.rate_limiter is not None:
+            await self.rate_limiter.acquire("gemini")
+        try:
+            return await asyncio.wait_for(
+                self.model.generate_content_async(contents, request_options={"timeout": timeout}, **kwargs),
+                timeout=timeout
+            )
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"Gemini call timed out after {timeout:.0f}s")
+        except Exception as e:
+            if self.rate_limiter is not None and is_rate_limit_error(e):
+                await self.rate_limiter.pause("gemini", gemini_retry_after(e))
+            raise
+
+    def generate_component(self, figma_data: Dict[str, Any], context_files: str = "", rag_context: str = "", image_path: str = None,
+                           image_data: Optional[bytes] = None, image_mime_type: str = "image/png") -> Dict[str, str]:
+        """
+        MAIN FUNCTION: Generates React code from Figma data.
+        
+        Args:
+            figma_data: The JSON data from Figma (node name, properties, etc.)
+            context_files: Content of existing files (to match style)
+            rag_context: Extra context found by searching the repo
+            image_path: Path to the screenshot image (if available)
+            image_data: The screenshot as bytes (used instead of image_path)
+            image_mime_type: Type of image_data ("image/png", "image/jpeg", "image/webp")
+            
+        Returns:
+            A dictionary with 'file_name' and 'code'.
+        """
+        node_name = figma_data.get("name", "Component")
+        contents = self._build_generation_contents(figma_data, context_files, rag_context, image_path, image_data, image_mime_type)
+
         # Call the Gemini API
         try:
             logger.info(f"🧠 Asking Gemini to generate code for {node_name}...")
             
             # Request specific JSON response format
-            response = self.model.generate_content(
+            response = self._generate(
                 contents,
                 generation_config={"response_mime_type": "application/json"}
             )
-            
-            # Check if Gemini refused to answer (safety filters)
-            if not response.candidates or not response.candidates[0].content.parts:
-                finish_reason = response.candidates[0].finish_reason if response.candidates else "UNKNOWN"
-                logger.error(f"Gemini returned empty response (finish_reason: {finish_reason})")
-                raise ValueError(f"Gemini blocked or returned empty response. Finish reason: {finish_reason}")
-            
-            # Parse the JSON response
-            result = json.loads(response.text)
-            
-            # Verify we got both expected fields
-            if "code" not in result or "file_name" not in result:
-                raise ValueError("Gemini response missing 'code' or 'file_name' keys")
-                
-            return result
+            return self._parse_generation_response(response)
             
         except Exception as e:
             logger.error(f"Gemini Generation Failed: {e}")
             raise e
 
-    def find_matching_file(self, figma_name: str, figma_text_content: str, repo_file_list: list, image_path: str = None) -> str:
+    async def agenerate_component(self, figma_data: Dict[str, Any], context_files: str = "", rag_context: str = "", image_path: str = None,
+                                  image_data: Optional[bytes] = None, timeout: Optional[float] = None,
+                                  image_mime_type: str = "image/png") -> Dict[str, str]:
         """
-        ROUTING FUNCTION: Decides WHERE to save the code.
-        Instead of creating new files blindly, it checks if a relevant file already exists.
-        
-        Args:
-            figma_name: Name of the layer in Figma (e.g. "Header")
-            repo_file_list: List of all files currently in the project
-        
-        Returns:
-            The path where the file should be saved (e.g., "src/components/Header.jsx")
+        Async version of generate_component. Awaits Gemini without blocking the event loop.
+        Raises TimeoutError if the call takes longer than `timeout` (default: LLM_TIMEOUT).
         """
+        node_name = figma_data.get("name", "Component")
+        contents = self._build_generation_contents(figma_data, context_files, rag_context, image_path, image_data, image_mime_type)
+
+        try:
+            logger.info(f"🧠 Asking Gemini to generate code for {node_name}...")
+            response = await self._agenerate(
+                contents,
+                timeout=timeout,
+                generation_config={"response_mime_type": "application/json"}
+            )
+            return self._parse_generation_response(response)
+            
+        except Exception as e:
+            logger.error(f"Gemini Generation Failed: {e}")
+            raise e
+
+    def _build_routing_contents(self, figma_name: str, figma_text_content: str, repo_file_list: list, image_path: Optional[str]) -> list:
+        """Builds the prompt (and optional screenshot) for find_matching_file / aroute."""
         prompt_text = f"""
         You are a Project Architect.
         
@@ -282,54 +378,76 @@ Output ONLY the JSON. No markdown.
         # Attach image if available to help identify the component
         if image_path and os.path.exists(image_path):
             try:
-                mime_type = "image/png"
-                if image_path.lower().endswith(".jpg") or image_path.lower().endswith(".jpeg"):
-                    mime_type = "image/jpeg"
-                
-                with open(image_path, "rb") as f:
-                    image_data = f.read()
-                
-                contents.append({
-                    "mime_type": mime_type,
-                    "data": image_data
-                })
+                contents.append(self._load_image_blob(image_path))
                 logger.info("   👁️ Vision Activated: Image attached to prompt.")
             except Exception as e:
                 logger.warning(f"Failed to load image for vision: {e}")
         
+        return contents
+
+    @staticmethod
+    def _parse_routing_response(response) -> str:
+        result = json.loads(response.text)
+        
+        matched_path = result.get("matched_path")
+        reason = result.get("reason")
+        
+        logger.info(f"🎯 AI Router Decision: {matched_path} (Reason: {reason})")
+        return matched_path
+
+    @staticmethod
+    def _fallback_route(figma_name: str) -> str:
+        # Fallback if AI fails: Just make a new file in a default folder
+        safe_name = figma_name.replace(" ", "")
+        return f"FigmaDesign/{safe_name}.jsx"
+
+    def find_matching_file(self, figma_name: str, figma_text_content: str, repo_file_list: list, image_path: str = None) -> str:
+        """
+        ROUTING FUNCTION: Decides WHERE to save the code.
+        Instead of creating new files blindly, it checks if a relevant file already exists.
+        
+        Args:
+            figma_name: Name of the layer in Figma (e.g. "Header")
+            repo_file_list: List of all files currently in the project
+        
+        Returns:
+            The path where the file should be saved (e.g., "src/components/Header.jsx")
+        """
+        contents = self._build_routing_contents(figma_name, figma_text_content, repo_file_list, image_path)
+        
         try:
             logger.info(f"🧠 Asking Gemini to route '{figma_name}'...")
             
-            response = self.model.generate_content(
+            response = self._generate(
                 contents,
                 generation_config={"response_mime_type": "application/json"}
             )
-            result = json.loads(response.text)
-            
-            matched_path = result.get("matched_path")
-            reason = result.get("reason")
-            
-            logger.info(f"🎯 AI Router Decision: {matched_path} (Reason: {reason})")
-            return matched_path
+            return self._parse_routing_response(response)
             
         except Exception as e:
-            # Fallback if AI fails: Just make a new file in a default folder
             logger.error(f"Router Failed: {e}")
-            safe_name = figma_name.replace(" ", "")
-            return f"FigmaDesign/{safe_name}.jsx"
+            return self._fallback_route(figma_name)
 
-    def fix_code(self, code: str, error_log: str) -> str:
-        """
-        DEBUGGING FUNCTION: Fixes code if it fails to compile.
+    async def aroute(self, figma_name: str, figma_text_content: str, repo_file_list: list, image_path: str = None, timeout: Optional[float] = None) -> str:
+        """Async version of find_matching_file. Falls back to a new FigmaDesign/ path on error or timeout."""
+        contents = self._build_routing_contents(figma_name, figma_text_content, repo_file_list, image_path)
         
-        Args:
-            code: The original broken code.
-            error_log: The error message from the compiler.
+        try:
+            logger.info(f"🧠 Asking Gemini to route '{figma_name}'...")
+            response = await self._agenerate(
+                contents,
+                timeout=timeout,
+                generation_config={"response_mime_type": "application/json"}
+            )
+            return self._parse_routing_response(response)
             
-        Returns:
-            Corrected code.
-        """
-        prompt = f"""
+        except Exception as e:
+            logger.error(f"Router Failed: {e}")
+            return self._fallback_route(figma_name)
+
+    @staticmethod
+    def _build_fix_prompt(code: str, error_log: str) -> str:
+        return f"""
         CRITICAL ERROR: The code you generated failed to compile.
         
         THE CODE:
@@ -344,12 +462,37 @@ Output ONLY the JSON. No markdown.
         Fix the syntax error described above. Return ONLY the corrected code.
         Do not explain. Just fix it.
         """
+
+    @staticmethod
+    def _strip_code_fences(text: str) -> str:
+        # Clean up potential markdown formatting from the response
+        return text.replace("```tsx", "").replace("```typescript", "").replace("```", "").strip()
+
+    def fix_code(self, code: str, error_log: str) -> str:
+        """
+        DEBUGGING FUNCTION: Fixes code if it fails to compile.
         
+        Args:
+            code: The original broken code.
+            error_log: The error message from the compiler.
+            
+        Returns:
+            Corrected code.
+        """
+        try:
+            logger.info("   🚑 Asking Gemini to fix the code...")
+            response = self._generate(self._build_fix_prompt(code, error_log))
+            return self._strip_code_fences(response.text)
+        except Exception as e:
+            logger.error(f"Fix failed: {e}")
+            return code
+
+    async def afix_code(self, code: str, error_log: str, timeout: Optional[float] = None) -> str:
+        """Async version of fix_code. Returns the original code on error or timeout."""
         try:
             logger.info("   🚑 Asking Gemini to fix the code...")
-            response = self.model.generate_content(prompt)
-            # Clean up potential markdown formatting from the response
-            return response.text.replace("```tsx", "").replace("```typescript", "").replace("```", "").strip()
+            response = await self._agenerate(self._build_fix_prompt(code, error_log), timeout=timeout)
+            return self._strip_code_fences(response.text)
         except Exception as e:
             logger.error(f"Fix failed: {e}")
             return code
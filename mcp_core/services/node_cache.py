@@ -0,0 +1,169 @@
+"""
+node_cache.py - Versioned on-disk cache of Figma node responses
+
+The same file version is fetched again and again: by the poller, by webhook
+events, by scripts/direct_run.py and by the IDE assistant through the MCP
+`fetch_figma_pattern` tool. A Figma version is immutable, so the normalized
+result of a fetch can be kept keyed by (file_key, version, node_ids, depth) and
+served without touching the network. A new version is simply a new key; old
+versions age out of the LRU.
+
+Entries are zlib-compressed JSON in a small SQLite file of their own
+(figma_cache.db, safe to delete at any time). The total compressed size is
+capped (FIGMA_NODE_CACHE_MAX_MB); when a write goes over the cap the least
+recently used entries are dropped.
+"""
+import os
+import json
+import time
+import zlib
+import hashlib
+import logging
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+NODE_CACHE_PATH = Path(os.getenv("FIGMA_NODE_CACHE_PATH", str(Path(__file__).parent.parent.parent / "figma_cache.db")))
+NODE_CACHE_MAX_BYTES = int(float(os.getenv("FIGMA_NODE_CACHE_MAX_MB", "256")) * 1024 * 1024)
+NODE_CACHE_ENABLED = os.getenv("FIGMA_NODE_CACHE", "1").lower() not in ("0", "false", "no")
+
+SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS figma_node_cache (
+        cache_key TEXT PRIMARY KEY,
+        file_key TEXT NOT NULL,
+        version TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        data BLOB NOT NULL,
+        hit_count INTEGER NOT NULL DEFAULT 0,
+        created_at REAL NOT NULL,
+        last_used_at REAL NOT NULL
+    )
+"""
+
+# Keep the most recently used entries whose running total fits the cap, drop the rest
+EVICT_SQL = """
+    DELETE FROM figma_node_cache WHERE cache_key IN (
+        SELECT cache_key FROM (
+            SELECT cache_key, SUM(size) OVER (ORDER BY last_used_at DESC, cache_key) AS running
+            FROM figma_node_cache
+        ) WHERE running > ?
+    )
+"""
+
+
+def cache_key(file_key: str, version: str, node_ids: List[str], depth: int) -> str:
+    """Node order does not change the response, so ids are sorted before hashing."""
+    payload = json.dumps([file_key, str(version), sorted(node_ids or []), depth], separators=(",", ":"))
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+class FigmaNodeCache:
+    def __init__(self, db_path: Path = NODE_CACHE_PATH, max_bytes: int = NODE_CACHE_MAX_BYTES,
+                 enabled: bool = NODE_CACHE_ENABLED):
+        self.db_path = Path(db_path)
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        # Counters for this process; hit_count per entry survives restarts
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._schema_ready = False
+
+    async def _connect(self) -> aiosqlite.Connection:
+        db = await aiosqlite.connect(self.db_path)
+        if not self._schema_ready:
+            await db.execute(SCHEMA_SQL)
+            await db.commit()
+            self._schema_ready = True
+        return db
+
+    async def get(self, file_key: str, version: Optional[str], node_ids: List[str], depth: int) -> Optional[Dict[str, Any]]:
+        """The cached fetch result for this exact version, or None."""
+        if not self.enabled or not version:
+            return None
+        key = cache_key(file_key, version, node_ids, depth)
+        try:
+            db = await self._connect()
+            try:
+                cursor = await db.execute("SELECT data FROM figma_node_cache WHERE cache_key = ?", (key,))
+                row = await cursor.fetchone()
+                if row:
+                    await db.execute("""
+                        UPDATE figma_node_cache SET last_used_at = ?, hit_count = hit_count + 1
+                        WHERE cache_key = ?
+                    """, (time.time(), key))
+                    await db.commit()
+            finally:
+                await db.close()
+        except Exception as e:
+            # A broken cache must never break a fetch
+            logger.warning(f"Figma node cache read failed: {e}")
+            row = None
+
+        if not row:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(zlib.decompress(row[0]))
+
+    async def put(self, file_key: str, version: Optional[str], node_ids: List[str], depth: int, result: Dict[str, Any]):
+        """Store a successful fetch result, then trim the cache back under max_bytes."""
+        if not self.enabled or not version:
+            return
+        data = zlib.compress(json.dumps(result, separators=(",", ":")).encode("utf-8"), 6)
+        if len(data) > self.max_bytes:
+            logger.info(f"Figma node cache: {file_key} v{version} ({len(data)} bytes) is larger than the cache, not stored")
+            return
+        now = time.time()
+        try:
+            db = await self._connect()
+            try:
+                await db.execute("""
+                    INSERT INTO figma_node_cache (cache_key, file_key, version, size, data, created_at, last_used_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(cache_key) DO UPDATE SET
+                        size = excluded.size,
+                        data = excluded.data,
+                        last_used_at = excluded.last_used_at
+                """, (cache_key(file_key, version, node_ids, depth), file_key, str(version), len(data), data, now, now))
+                cursor = await db.execute(EVICT_SQL, (self.max_bytes,))
+                await db.commit()
+            finally:
+                await db.close()
+        except Exception as e:
+            logger.warning(f"Figma node cache write failed: {e}")
+            return
+        self.stores += 1
+        if cursor.rowcount > 0:
+            self.evictions += cursor.rowcount
+            logger.debug(f"Figma node cache: evicted {cursor.rowcount} least recently used entries")
+
+    async def stats(self) -> Dict[str, Any]:
+        """Process counters plus what is on disk (entries, compressed bytes, lifetime hits)."""
+        lookups = self.hits + self.misses
+        stats = {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "max_bytes": self.max_bytes,
+            "entries": 0,
+            "bytes": 0,
+            "lifetime_hits": 0
+        }
+        if self.db_path.exists():
+            db = await self._connect()
+            try:
+                cursor = await db.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(hit_count), 0) FROM figma_node_cache"
+                )
+                stats["entries"], stats["bytes"], stats["lifetime_hits"] = await cursor.fetchone()
+            finally:
+                await db.close()
+        return stats
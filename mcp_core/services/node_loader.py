@@ -0,0 +1,139 @@
+"""
+node_loader.py - Coalesce single-node Figma fetches into batched /nodes calls
+
+Targeted syncs for several nodes of the same file usually come due together,
+and each one used to become its own `/v1/files/{key}/nodes?ids=<one id>`
+request. NodeLoader is a small dataloader: node ids requested for the same
+(file_key, depth) within a short window (FIGMA_NODE_BATCH_WINDOW_MS) are sent
+as one `ids=a,b,c` request, and the response is handed back to every caller.
+Ids are split over several requests when the URL would get longer than
+FIGMA_NODE_BATCH_MAX_URL characters.
+
+`prime()` starts loads ahead of time and keeps the results until `clear()`.
+The worker uses it to fetch every targeted node of a claimed batch at once,
+even though it processes the events one after another.
+"""
+import os
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+from urllib.parse import quote
+
+logger = logging.getLogger(__name__)
+
+NODE_BATCH_WINDOW = float(os.getenv("FIGMA_NODE_BATCH_WINDOW_MS", "20")) / 1000
+NODE_BATCH_MAX_URL = int(os.getenv("FIGMA_NODE_BATCH_MAX_URL", "4000"))
+
+FetchBatch = Callable[[str, List[str], int], Awaitable[Dict[str, Any]]]
+
+
+def nodes_url(file_key: str, node_ids: List[str], depth: int) -> str:
+    return f"/v1/files/{file_key}/nodes?ids={','.join(node_ids)}&depth={depth}"
+
+
+def chunk_node_ids(file_key: str, node_ids: List[str], depth: int, max_url_chars: int = NODE_BATCH_MAX_URL) -> List[List[str]]:
+    """Split ids so every /nodes URL stays under max_url_chars."""
+    return chunk_ids(node_ids, max_url_chars - len(nodes_url(file_key, [], depth)))
+
+
+def chunk_ids(node_ids: List[str], budget: int) -> List[List[str]]:
+    """Split ids into comma-joined lists of at most `budget` characters (sized as if ':' were percent-encoded)."""
+    chunks, current, used = [], [], 0
+    for node_id in node_ids:
+        size = len(quote(node_id, safe=""))
+        if current and used + 1 + size > budget:
+            chunks.append(current)
+            current, used = [], 0
+        used += size + (1 if current else 0)
+        current.append(node_id)
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _mark_retrieved(future: asyncio.Future):
+    # Primed loads may never be awaited; don't let asyncio log their errors as "never retrieved"
+    if not future.cancelled():
+        future.exception()
+
+
+class NodeLoader:
+    def __init__(self, fetch_batch: FetchBatch, window: float = NODE_BATCH_WINDOW, max_url_chars: int = NODE_BATCH_MAX_URL):
+        self._fetch_batch = fetch_batch
+        self.window = window
+        self.max_url_chars = max_url_chars
+        # (file_key, depth) -> {node_id: future} waiting for the window to close
+        self._pending: Dict[Tuple[str, int], Dict[str, asyncio.Future]] = {}
+        # Primed loads, kept until clear()
+        self._primed: Dict[Tuple[str, int, str], asyncio.Future] = {}
+        self._tasks = set()
+        self.requests = 0
+        self.node_loads = 0
+
+    def _enqueue(self, file_key: str, depth: int, node_id: str) -> asyncio.Future:
+        primed = self._primed.get((file_key, depth, node_id))
+        if primed is not None:
+            return primed
+        key = (file_key, depth)
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = {}
+            asyncio.get_running_loop().call_later(self.window, self._dispatch, key)
+        if node_id not in batch:
+            future = asyncio.get_running_loop().create_future()
+            future.add_done_callback(_mark_retrieved)
+            batch[node_id] = future
+            self.node_loads += 1
+        return batch[node_id]
+
+    def _dispatch(self, key: Tuple[str, int]):
+        batch = self._pending.pop(key, None)
+        if not batch:
+            return
+        file_key, depth = key
+        for chunk in chunk_node_ids(file_key, list(batch), depth, self.max_url_chars):
+            task = asyncio.create_task(self._run(file_key, depth, {node_id: batch[node_id] for node_id in chunk}))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, file_key: str, depth: int, futures: Dict[str, asyncio.Future]):
+        self.requests += 1
+        if len(futures) > 1:
+            logger.debug(f"[Figma] {len(futures)} node requests for {file_key} coalesced into one /nodes call")
+        try:
+            data = await self._fetch_batch(file_key, list(futures), depth)
+        except Exception as e:
+            for future in futures.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future in futures.values():
+            if not future.done():
+                future.set_result(data)
+
+    async def load(self, file_key: str, depth: int, node_id: str) -> Dict[str, Any]:
+        """The /nodes response (possibly shared with other callers) that contains node_id."""
+        # shield: one caller giving up must not cancel the load for the others
+        return await asyncio.shield(self._enqueue(file_key, depth, node_id))
+
+    async def load_many(self, file_key: str, depth: int, node_ids: List[str]) -> Dict[str, Any]:
+        """One /nodes-shaped response for node_ids, merged from however many batches served them."""
+        responses = await asyncio.gather(*(self.load(file_key, depth, node_id) for node_id in node_ids))
+        merged: Dict[str, Any] = {}
+        for data in {id(data): data for data in responses}.values():
+            for field, value in data.items():
+                if isinstance(value, dict) and isinstance(merged.get(field), dict):
+                    merged[field] = {**merged[field], **value}
+                else:
+                    merged.setdefault(field, value)
+        nodes = merged.get("nodes") or {}
+        merged["nodes"] = {node_id: nodes[node_id] for node_id in node_ids if node_id in nodes}
+        return merged
+
+    def prime(self, file_key: str, depth: int, node_ids: List[str]):
+        """Start loading node_ids now; load() calls for them return these results until clear()."""
+        for node_id in node_ids:
+            self._primed[(file_key, depth, node_id)] = self._enqueue(file_key, depth, node_id)
+
+    def clear(self):
+        self._primed.clear()
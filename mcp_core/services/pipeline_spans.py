@@ -0,0 +1,101 @@
+"""
+pipeline_spans.py - Per-stage timing spans for the automation pipeline
+
+Usage:
+    with span("generate", prompt_chars=len(prompt)) as s:
+        code = await coder.agenerate_component(...)
+        s.bytes_out = len(code)
+
+Spans are buffered in memory (no I/O on the hot path) and written to the
+`pipeline_spans` table by `await span_recorder.flush()`, which the worker calls
+once per event. The event / frame a span belongs to comes from context
+variables, so concurrent frames (asyncio tasks) are attributed correctly.
+
+Read them back with scripts/pipeline_report.py.
+"""
+import time
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Iterator, List, Optional
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = Path(__file__).parent.parent.parent / "events.db"
+
+# Set by the worker for the event / frame currently being processed
+current_event_id: ContextVar[Optional[int]] = ContextVar("current_event_id", default=None)
+current_frame_id: ContextVar[Optional[str]] = ContextVar("current_frame_id", default=None)
+
+INSERT_SPAN_SQL = """
+    INSERT INTO pipeline_spans (event_id, frame_id, stage, started_at, duration_ms, bytes_in, bytes_out, prompt_chars, outcome, detail)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+class Span:
+    """Mutable fields of a running span; set them inside the `with` block."""
+
+    def __init__(self, stage: str, bytes_in: Optional[int] = None, bytes_out: Optional[int] = None,
+                 prompt_chars: Optional[int] = None, outcome: str = "ok", detail: Optional[str] = None):
+        self.stage = stage
+        self.bytes_in = bytes_in
+        self.bytes_out = bytes_out
+        self.prompt_chars = prompt_chars
+        self.outcome = outcome
+        self.detail = detail
+
+
+class SpanRecorder:
+    def __init__(self, db_path: Path = DB_PATH):
+        self.db_path = db_path
+        self._pending: List[tuple] = []
+
+    @contextmanager
+    def span(self, stage: str, **fields) -> Iterator[Span]:
+        """Time a block. An exception escaping the block marks the span 'error' (or 'cancelled')."""
+        current = Span(stage, **fields)
+        started_at = time.time()
+        start = time.perf_counter()
+        try:
+            yield current
+        except BaseException as e:
+            if current.outcome == "ok":
+                current.outcome = "error" if isinstance(e, Exception) else "cancelled"
+                current.detail = current.detail or f"{type(e).__name__}: {e}"[:500]
+            raise
+        finally:
+            self._pending.append((
+                current_event_id.get(),
+                current_frame_id.get(),
+                current.stage,
+                started_at,
+                (time.perf_counter() - start) * 1000,
+                current.bytes_in,
+                current.bytes_out,
+                current.prompt_chars,
+                current.outcome,
+                current.detail
+            ))
+
+    async def flush(self) -> int:
+        """Write buffered spans to the database. Returns the number written."""
+        rows, self._pending = self._pending, []
+        if not rows:
+            return 0
+        try:
+            async with aiosqlite.connect(self.db_path) as db:
+                await db.executemany(INSERT_SPAN_SQL, rows)
+                await db.commit()
+        except Exception as e:
+            # Timing data must never break the pipeline
+            logger.warning(f"Failed to persist {len(rows)} pipeline spans: {e}")
+            return 0
+        return len(rows)
+
+
+span_recorder = SpanRecorder()
+span = span_recorder.span
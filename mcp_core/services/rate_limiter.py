@@ -0,0 +1,232 @@
+"""
+rate_limiter.py - One token bucket per API endpoint, shared by every process
+
+Rate limits used to be handled per call: FigmaClient retried a 429 after
+Retry-After, and nothing else. With several workers, the MCP server and
+scripts running at once, they all spent the same Figma/Gemini quota without
+knowing about each other, hit 429 together and retried together.
+
+RateLimiter keeps a token bucket per endpoint ("files", "nodes", "images",
+"gemini") in a small SQLite file (rate_limit.db, safe to delete). Every
+acquire is one short `BEGIN IMMEDIATE` transaction, so the buckets are shared
+by all processes on the machine:
+
+- a bucket refills at its per-minute budget, up to `burst` tokens
+- a call takes a token, or sleeps until the next one is due
+- a 429 pauses the bucket for Retry-After seconds, for every process
+
+Budgets are "per_minute:burst", e.g. RATE_LIMIT_NODES="60:10".
+RATE_LIMIT=0 turns limiting off. If the database cannot be used, calls go
+through unlimited rather than failing.
+"""
+import os
+import time
+import random
+import asyncio
+import logging
+import sqlite3
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_PATH = Path(os.getenv("RATE_LIMIT_PATH", str(Path(__file__).parent.parent.parent / "rate_limit.db")))
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT", "1").lower() not in ("0", "false", "no")
+# Longest single sleep while waiting, so a pause lifted early (or a new budget) is noticed
+MAX_WAIT_STEP = 5.0
+
+SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS rate_buckets (
+        name TEXT PRIMARY KEY,
+        tokens REAL NOT NULL,
+        updated_at REAL NOT NULL,
+        paused_until REAL NOT NULL DEFAULT 0
+    )
+"""
+
+
+@dataclass(frozen=True)
+class Budget:
+    per_minute: float
+    burst: float
+
+    @property
+    def rate(self) -> float:
+        return self.per_minute / 60
+
+
+def parse_budget(spec: str) -> Budget:
+    """"60" or "60:10" -> Budget(per_minute=60, burst=10); burst defaults to per_minute / 6."""
+    per_minute, _, burst = spec.partition(":")
+    per_minute = float(per_minute)
+    return Budget(per_minute, float(burst) if burst else max(1.0, per_minute / 6))
+
+
+DEFAULT_BUDGETS: Dict[str, Budget] = {
+    name: parse_budget(os.getenv(f"RATE_LIMIT_{name.upper()}", spec))
+    for name, spec in (("files", "20:5"), ("nodes", "60:10"), ("images", "30:6"), ("gemini", "60:10"))
+}
+
+
+def figma_bucket(url: str) -> Optional[str]:
+    """Bucket of a Figma API path; None for absolute URLs (rendered images on S3) and other endpoints."""
+    if not url.startswith("/"):
+        return None
+    path = url.split("?", 1)[0]
+    if path.startswith("/v1/images/"):
+        return "images"
+    if path.startswith("/v1/files/"):
+        return "nodes" if path.endswith("/nodes") else "files"
+    return None
+
+
+class RateLimiter:
+    def __init__(self, db_path: Path = RATE_LIMIT_PATH, budgets: Optional[Dict[str, Budget]] = None,
+                 enabled: bool = RATE_LIMIT_ENABLED):
+        self.db_path = Path(db_path)
+        self.budgets = dict(DEFAULT_BUDGETS if budgets is None else budgets)
+        self.enabled = enabled
+        # Counters for this process
+        self.acquired = 0
+        self.waited = 0.0
+        self.pauses = 0
+        self._schema_ready = False
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+        if not self._schema_ready:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(SCHEMA_SQL)
+            self._schema_ready = True
+        return conn
+
+    def _take(self, name: str, budget: Budget) -> float:
+        """Take a token if one is available; otherwise the seconds until one is (nothing is taken)."""
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            row = conn.execute("SELECT tokens, updated_at, paused_until FROM rate_buckets WHERE name = ?",
+                               (name,)).fetchone()
+            tokens, updated_at, paused_until = row if row else (budget.burst, now, 0.0)
+            if paused_until > now:
+                conn.execute("ROLLBACK")
+                return paused_until - now
+            tokens = min(budget.burst, tokens + max(0.0, now - updated_at) * budget.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0.0
+            else:
+                wait = (1 - tokens) / budget.rate
+            conn.execute("""
+                INSERT INTO rate_buckets (name, tokens, updated_at, paused_until) VALUES (?, ?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at
+            """, (name, tokens, now, paused_until))
+            conn.execute("COMMIT")
+            return wait
+        finally:
+            conn.close()
+
+    def _pause(self, name: str, seconds: float):
+        conn = self._connect()
+        try:
+            until = time.time() + seconds
+            # The bucket restarts empty after the pause, instead of with a burst that would trip the limit again
+            conn.execute("""
+                INSERT INTO rate_buckets (name, tokens, updated_at, paused_until) VALUES (?, 0, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET
+                    tokens = 0,
+                    paused_until = MAX(paused_until, excluded.paused_until),
+                    updated_at = MAX(paused_until, excluded.paused_until)
+            """, (name, until, until))
+        finally:
+            conn.close()
+
+    def _next_wait(self, name: str) -> Optional[float]:
+        """Seconds to sleep before trying again, 0 once a token was taken, None if `name` is not limited."""
+        budget = self.budgets.get(name)
+        if not self.enabled or budget is None or budget.per_minute <= 0:
+            return None
+        try:
+            return self._take(name, budget)
+        except sqlite3.Error as e:
+            # A broken limiter must never block an API call
+            logger.warning(f"Rate limiter unavailable ({e}), '{name}' call not limited")
+            return None
+
+    def _waited(self, name: str, waited: float):
+        self.acquired += 1
+        self.waited += waited
+        if waited >= 1:
+            logger.info(f"[RateLimit] waited {waited:.1f}s for a '{name}' token")
+
+    async def acquire(self, name: str) -> float:
+        """Wait for a token of bucket `name`. Returns the seconds spent waiting."""
+        waited = 0.0
+        while True:
+            wait = await asyncio.to_thread(self._next_wait, name)
+            if not wait:
+                break
+            # Jitter so processes waiting on the same bucket don't retry in lockstep
+            step = min(wait, MAX_WAIT_STEP) + random.uniform(0, 0.05)
+            await asyncio.sleep(step)
+            waited += step
+        self._waited(name, waited)
+        return waited
+
+    def acquire_sync(self, name: str) -> float:
+        """Blocking acquire(), for the synchronous LLMCoder methods."""
+        waited = 0.0
+        while True:
+            wait = self._next_wait(name)
+            if not wait:
+                break
+            step = min(wait, MAX_WAIT_STEP) + random.uniform(0, 0.05)
+            time.sleep(step)
+            waited += step
+        self._waited(name, waited)
+        return waited
+
+    def pause_sync(self, name: str, seconds: float) -> bool:
+        """Stop handing out `name` tokens to every process for `seconds` (after a 429). False if not paused."""
+        budget = self.budgets.get(name)
+        if not self.enabled or budget is None or budget.per_minute <= 0 or seconds <= 0:
+            return False
+        try:
+            self._pause(name, seconds)
+        except sqlite3.Error as e:
+            logger.warning(f"Rate limiter unavailable ({e}), '{name}' not paused")
+            return False
+        self.pauses += 1
+        logger.warning(f"[RateLimit] '{name}' paused for {seconds:.0f}s in all processes")
+        return True
+
+    async def pause(self, name: str, seconds: float) -> bool:
+        return await asyncio.to_thread(self.pause_sync, name, seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        """Process counters plus the current state of every bucket on disk."""
+        stats: Dict[str, Any] = {
+            "enabled": self.enabled,
+            "acquired": self.acquired,
+            "waited_s": round(self.waited, 2),
+            "pauses": self.pauses,
+            "buckets": {}
+        }
+        if self.db_path.exists():
+            conn = self._connect()
+            try:
+                now = time.time()
+                for name, tokens, updated_at, paused_until in conn.execute("SELECT * FROM rate_buckets"):
+                    budget = self.budgets.get(name)
+                    if budget:
+                        tokens = min(budget.burst, tokens + max(0.0, now - updated_at) * budget.rate)
+                    stats["buckets"][name] = {
+                        "tokens": round(tokens, 2),
+                        "per_minute": budget.per_minute if budget else None,
+                        "paused_for_s": round(max(0.0, paused_until - now), 1)
+                    }
+            finally:
+                conn.close()
+        return stats
@@ -9,19 +9,35 @@ This module provides:
 import os
 import asyncio
 import logging
+import weakref
 import httpx
-from typing import Dict, Any, List
+from typing import Callable, Dict, Any, List, Optional
 from ..context import ToolContext
+from ..services.figma_client import FigmaClient
+from ..services.node_cache import FigmaNodeCache
+from ..services.node_loader import NodeLoader, NODE_BATCH_MAX_URL, chunk_ids, nodes_url
+from ..services.image_store import FrameImageStore
+from ..services.figma_stream import FrameSpool, spool_file_response, streaming_enabled
 
 logger = logging.getLogger(__name__)
 
+# Rendered frame images downloaded at the same time (per prefetch)
+IMAGE_DOWNLOAD_CONCURRENCY = int(os.getenv("FIGMA_IMAGE_CONCURRENCY", "6"))
+
 
 # ============================================================
 # FIGMA API FUNCTIONS
 # ============================================================
 
 async def fetch_figma_pattern(ctx: ToolContext, args: Dict[str, Any]) -> Dict[str, Any]:
-    """Fetch design nodes from Figma using httpx for true async I/O."""
+    """
+    Fetch design nodes from Figma through the pooled FigmaClient.
+
+    When the caller knows the file version (`version` arg: from the poller, or
+    the `version` of an earlier result) a cached result for that version is
+    returned without any request. Every successful fetch is cached under the
+    version Figma reports in the response.
+    """
     file_key = args["file_key"]
     node_ids = args.get("node_ids", [])
     depth = args.get("depth", 4)
@@ -30,122 +46,230 @@ async def fetch_figma_pattern(ctx: ToolContext, args: Dict[str, Any]) -> Dict[st
     if not token:
         raise ValueError("FIGMA_ACCESS_TOKEN environment variable is not set")
     
-    headers = {"X-Figma-Token": token}
-    max_retries = 3
-    base_delay = 2
+    node_cache = get_node_cache(ctx)
+    cached = await node_cache.get(file_key, args.get("version"), node_ids, depth)
+    if cached is not None:
+        return {**cached, "cached": True}
     
-    async with httpx.AsyncClient() as client:
-        for attempt in range(max_retries):
-            try:
-                # Use /nodes if specific IDs are provided, otherwise /files
-                if node_ids:
-                    ids_str = ",".join(node_ids)
-                    url = f"https://api.figma.com/v1/files/{file_key}/nodes?ids={ids_str}&depth={depth}"
-                else:
-                    url = f"https://api.figma.com/v1/files/{file_key}?depth={depth}"
-                    
-                resp = await client.get(url, headers=headers, timeout=15)
-                
-                if resp.status_code == 429:
-                    if attempt < max_retries - 1:
-                        header_val = resp.headers.get('Retry-After')
-                        if header_val:
-                            retry_after = int(header_val)
-                        else:
-                            retry_after = base_delay * (2 ** attempt)
-                        
-                        # Cap at 60s
-                        retry_after = min(retry_after, 60)
-                        
-                        logger.warning(f"[Figma Rate Limit] Attempt {attempt+1} failed. Sleeping {retry_after}s...")
-                        await asyncio.sleep(retry_after)
-                        continue
-                    else:
-                        raise RuntimeError("Figma API rate limit exceeded.")
-                
+    try:
+        # Use /nodes if specific IDs are provided, otherwise /files
+        if node_ids:
+            # Batched with other /nodes requests for this file that arrive at the same time
+            data = await get_node_loader(ctx).load_many(file_key, depth, node_ids)
+        else:
+            data = await _get_json(get_client(ctx), f"/v1/files/{file_key}?depth={depth}")
+        
+        # Normalize results
+        if node_ids:
+            # /nodes endpoint structure (unknown ids come back as null)
+            nodes_data = data.get("nodes", {})
+            nodes = [v["document"] for v in nodes_data.values() if v and "document" in v]
+            file_name = data.get("name", "Unknown File")
+            last_modified = data.get("lastModified")
+        else:
+            # /files endpoint structure
+            nodes = [data["document"]]
+            file_name = data.get("name", "Unknown File")
+            last_modified = data.get("lastModified")
+            
+        tokens = {
+            "colors": {},
+            "components": data.get("components", {}),
+            "styles": data.get("styles", {})
+        }
+        
+        result = {
+            "file_key": file_key,
+            "name": file_name,
+            "last_modified": last_modified,
+            "version": data.get("version"),
+            "nodes": nodes,
+            "tokens": tokens
+        }
+        # Keyed by the version actually returned, so a change racing this fetch can't be cached under an older version
+        await node_cache.put(file_key, result["version"], node_ids, depth, result)
+        return result
+        
+    except httpx.RequestError as e:
+        logger.error(f"Figma API connection error: {e}")
+        return {
+            "success": False,
+            "error": f"Figma API connection error: {str(e)}",
+            "status_code": 0
+        }
+    except httpx.HTTPStatusError as e:
+        logger.error(f"Figma API status error: {e}")
+        return {
+            "success": False,
+            "error": f"Figma API error: {e.response.text}",
+            "status_code": e.response.status_code
+        }
+    except Exception as e:
+        logger.error(f"Figma processing error: {e}")
+        return {
+            "success": False,
+            "error": f"Figma API processing error: {str(e)}",
+            "status_code": 500
+        }
+
+async def stream_file_frames(ctx: ToolContext, file_key: str, depth: int = 4,
+                             fingerprint: Optional[Callable[[dict], str]] = None) -> FrameSpool:
+    """
+    Top-level frames of a whole file, for syncs of large documents. The response
+    is parsed as it streams in (when ijson is installed) and frames land in a
+    FrameSpool on disk; the caller must close() it. Raises on HTTP errors.
+    """
+    if not os.getenv("FIGMA_ACCESS_TOKEN"):
+        raise ValueError("FIGMA_ACCESS_TOKEN environment variable is not set")
+
+    spool = FrameSpool(fingerprint)
+    try:
+        async with get_client(ctx).stream(f"/v1/files/{file_key}?depth={depth}") as resp:
+            if resp.status_code == 429:
+                raise RuntimeError("Figma API rate limit exceeded.")
+            if resp.status_code != 200:
+                await resp.aread()
                 resp.raise_for_status()
-                data = resp.json()
-                
-                # Normalize results
-                if node_ids:
-                    # /nodes endpoint structure
-                    nodes_data = data.get("nodes", {})
-                    nodes = [v["document"] for v in nodes_data.values() if "document" in v]
-                    file_name = data.get("name", "Unknown File")
-                    last_modified = data.get("lastModified")
-                else:
-                    # /files endpoint structure
-                    nodes = [data["document"]]
-                    file_name = data.get("name", "Unknown File")
-                    last_modified = data.get("lastModified")
-                    
-                tokens = {
-                    "colors": {},
-                    "components": data.get("components", {}),
-                    "styles": data.get("styles", {})
-                }
-                
-                return {
-                    "file_key": file_key,
-                    "name": file_name,
-                    "last_modified": last_modified,
-                    "nodes": nodes,
-                    "tokens": tokens
-                }
-                
-            except httpx.RequestError as e:
-                logger.error(f"Figma API connection error: {e}")
-                if attempt < max_retries - 1:
-                    await asyncio.sleep(base_delay * (attempt + 1))
-                    continue
-                return {
-                    "success": False,
-                    "error": f"Figma API connection error: {str(e)}",
-                    "status_code": 0
-                }
-            except httpx.HTTPStatusError as e:
-                logger.error(f"Figma API status error: {e}")
-                return {
-                    "success": False,
-                    "error": f"Figma API error: {e.response.text}",
-                    "status_code": e.response.status_code
-                }
-            except Exception as e:
-                logger.error(f"Figma processing error: {e}")
-                return {
-                    "success": False,
-                    "error": f"Figma API processing error: {str(e)}",
-                    "status_code": 500
-                }
-                
-    return {
-        "success": False,
-        "error": "Failed to fetch Figma design after multiple attempts",
-        "status_code": 408
-    }
+            await spool_file_response(resp, spool, stream=streaming_enabled())
+    except BaseException:
+        spool.close()
+        raise
+    logger.info(f"📥 Streamed {len(spool)} frames of {file_key} ({spool.bytes / 1024:.0f} KB spooled)")
+    return spool
+
+
+# Used when a function is called without a ToolContext (scripts, tests)
+_default_client: Optional[FigmaClient] = None
+_default_node_cache: Optional[FigmaNodeCache] = None
+_default_image_store: Optional[FrameImageStore] = None
+# Background prefetch tasks (kept referenced until they finish)
+_prefetch_tasks = set()
+# One /nodes coalescer per pooled client
+_node_loaders: "weakref.WeakKeyDictionary[FigmaClient, NodeLoader]" = weakref.WeakKeyDictionary()
+
+# Conditional-request cache: file_key -> {"etag", "last_modified", "meta"}
+_meta_cache: Dict[str, Dict[str, Any]] = {}
+# File name / thumbnail: file_key -> {"version", "info"}. Refetched only when the versions endpoint
+# reports a new latest version (a rename or new thumbnail is not seen before that)
+_file_info_cache: Dict[str, Dict[str, Any]] = {}
+
+
+def get_client(ctx: Optional[ToolContext]) -> FigmaClient:
+    """The context's pooled Figma client, or a shared module-level one."""
+    global _default_client
+    client = getattr(ctx, "figma", None)
+    if client is not None:
+        return client
+    if _default_client is None:
+        _default_client = FigmaClient()
+    return _default_client
+
+
+def get_node_cache(ctx: Optional[ToolContext]) -> FigmaNodeCache:
+    """The context's node cache, or a shared module-level one."""
+    global _default_node_cache
+    cache = getattr(ctx, "node_cache", None)
+    if isinstance(cache, FigmaNodeCache):
+        return cache
+    if _default_node_cache is None:
+        _default_node_cache = FigmaNodeCache()
+    return _default_node_cache
+
+
+def get_image_store(ctx: Optional[ToolContext]) -> FrameImageStore:
+    """The context's rendered-image store, or a shared module-level one."""
+    global _default_image_store
+    store = getattr(ctx, "frame_images", None)
+    if isinstance(store, FrameImageStore):
+        return store
+    if _default_image_store is None:
+        _default_image_store = FrameImageStore()
+    return _default_image_store
+
+
+def get_node_loader(ctx: Optional[ToolContext]) -> NodeLoader:
+    """The request coalescer for the context's Figma client."""
+    client = get_client(ctx)
+    loader = _node_loaders.get(client)
+    if loader is None:
+        client_ref = weakref.ref(client)
+        loader = NodeLoader(lambda file_key, node_ids, depth: _get_json(client_ref(), nodes_url(file_key, node_ids, depth)))
+        _node_loaders[client] = loader
+    return loader
+
+
+async def _get_json(client: FigmaClient, url: str) -> Dict[str, Any]:
+    # 429 / 5xx / connection errors are retried inside the client
+    resp = await client.get(url)
+    
+    if resp.status_code == 429:
+        raise RuntimeError("Figma API rate limit exceeded.")
+    
+    resp.raise_for_status()
+    return resp.json()
+
+
+async def _get_file_info(client: FigmaClient, file_key: str, version: Optional[str]) -> Dict[str, Any]:
+    """Name and thumbnail of a file (one depth=1 request per file version per process)."""
+    cached = _file_info_cache.get(file_key)
+    if cached and version and cached["version"] == version:
+        return cached["info"]
+
+    resp = await client.get(f"/v1/files/{file_key}?depth=1")
+    if resp.status_code != 200:
+        return {}
+    data = resp.json()
+    info = {"name": data.get("name"), "thumbnailUrl": data.get("thumbnailUrl")}
+    _file_info_cache[file_key] = {"version": version, "info": info}
+    return info
+
 
 async def get_file_meta(ctx: ToolContext, file_key: str) -> Dict[str, Any]:
-    """Fetch file metadata (version/lastModified) to detect changes."""
+    """
+    Fetch file metadata (version/lastModified) to detect changes.
+
+    Uses the versions endpoint (latest entry only) instead of downloading the
+    document skeleton, and revalidates with If-None-Match / If-Modified-Since.
+    A 304 returns the cached metadata with `not_modified: True`.
+    """
     token = os.getenv("FIGMA_ACCESS_TOKEN")
     if not token:
         return {}
         
-    headers = {"X-Figma-Token": token}
-    url = f"https://api.figma.com/v1/files/{file_key}?depth=1"
+    url = f"/v1/files/{file_key}/versions?page_size=1"
     
-    async with httpx.AsyncClient() as client:
-        try:
-            resp = await client.get(url, headers=headers)
-            if resp.status_code == 200:
-                data = resp.json()
-                return {
-                    "name": data.get("name"),
-                    "lastModified": data.get("lastModified"),
-                    "version": data.get("version"),
-                    "thumbnailUrl": data.get("thumbnailUrl")
-                }
-        except Exception as e:
-            logger.error(f"Figma version check failed: {e}")
+    cached = _meta_cache.get(file_key)
+    request_headers = {}
+    if cached:
+        if cached.get("etag"):
+            request_headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            request_headers["If-Modified-Since"] = cached["last_modified"]
+
+    client = get_client(ctx)
+    try:
+        resp = await client.get(url, headers=request_headers)
+        if resp.status_code == 304 and cached:
+            return {**cached["meta"], "not_modified": True}
+        if resp.status_code == 200:
+            versions = resp.json().get("versions") or []
+            latest = versions[0] if versions else {}
+            info = await _get_file_info(client, file_key, latest.get("id"))
+            meta = {
+                "name": info.get("name"),
+                "lastModified": latest.get("created_at"),
+                "version": latest.get("id"),
+                "thumbnailUrl": info.get("thumbnailUrl")
+            }
+            _meta_cache[file_key] = {
+                "etag": resp.headers.get("ETag"),
+                "last_modified": resp.headers.get("Last-Modified"),
+                "meta": meta
+            }
+            return meta
+        logger.warning(f"Figma version check returned {resp.status_code} for {file_key}")
+    except Exception as e:
+        logger.error(f"Figma version check failed: {e}")
             
     return {}
 
@@ -154,34 +278,124 @@ async def get_file_meta(ctx: ToolContext, file_key: str) -> Dict[str, Any]:
 # IMAGE DOWNLOAD FUNCTIONS (For Vision-Enhanced Processing)
 # ============================================================
 
-async def fetch_node_image_url(ctx: ToolContext, file_key: str, node_id: str) -> str:
+def images_url(file_key: str, node_ids: List[str]) -> str:
+    return f"/v1/images/{file_key}?ids={','.join(node_ids)}&format=png"
+
+
+async def fetch_node_image_urls(ctx: ToolContext, file_key: str, node_ids: List[str]) -> Dict[str, Optional[str]]:
     """
-    Fetches the rendered image URL for a specific node from Figma.
-    Used for Vision-Enhanced Routing.
+    Renders many nodes with one /v1/images call (split only if the URL gets too long).
+    Returns node_id -> image URL; ids Figma could not render map to None or are missing.
     """
-    import httpx
-    
     token = os.getenv("FIGMA_ACCESS_TOKEN")
-    if not token:
-        return None
-        
-    headers = {"X-Figma-Token": token}
-    url = f"https://api.figma.com/v1/images/{file_key}?ids={node_id}&format=png"
-    
-    async with httpx.AsyncClient() as client:
+    if not token or not node_ids:
+        return {}
+
+    async def render(chunk: List[str]) -> Dict[str, Optional[str]]:
         try:
-            resp = await client.get(url, headers=headers)
+            resp = await get_client(ctx).get(images_url(file_key, chunk))
             if resp.status_code != 200:
-                logger.warning(f"Failed to fetch image URL: {resp.status_code}")
-                return None
-                
-            data = resp.json()
-            images = data.get("images", {})
-            return images.get(node_id)
-            
+                logger.warning(f"Failed to fetch image URLs: {resp.status_code}")
+                return {}
+            return resp.json().get("images") or {}
         except Exception as e:
-            logger.error(f"Error fetching node image URL: {e}")
+            logger.error(f"Error fetching node image URLs: {e}")
+            return {}
+
+    chunks = chunk_ids(node_ids, NODE_BATCH_MAX_URL - len(images_url(file_key, [])))
+    urls: Dict[str, Optional[str]] = {}
+    for images in await asyncio.gather(*(render(chunk) for chunk in chunks)):
+        urls.update(images)
+    return urls
+
+
+async def fetch_node_image_url(ctx: ToolContext, file_key: str, node_id: str) -> str:
+    """
+    Fetches the rendered image URL for a specific node from Figma.
+    Used for Vision-Enhanced Routing.
+    """
+    return (await fetch_node_image_urls(ctx, file_key, [node_id])).get(node_id)
+
+
+async def download_rendered_image(ctx: ToolContext, img_url: str) -> Optional[bytes]:
+    """Downloads a rendered image into memory. Returns the bytes or None."""
+    try:
+        # Rendered images are served from S3: same pool, but no Figma token
+        resp = await get_client(ctx).get(img_url, authenticated=False)
+        if resp.status_code != 200:
             return None
+        return resp.content
+    except Exception as e:
+        logger.error(f"Failed to download rendered image: {e}")
+        return None
+
+
+async def fetch_frame_images(ctx: ToolContext, file_key: str, node_ids: List[str],
+                             on_image: Optional[Callable[[str, Optional[bytes]], None]] = None) -> Dict[str, Optional[bytes]]:
+    """
+    Images of many frames: one render call, then concurrent downloads (at most
+    IMAGE_DOWNLOAD_CONCURRENCY at a time). `on_image(node_id, data)` is called as
+    each image finishes, so callers can use the first images before the last arrive.
+    """
+    urls = await fetch_node_image_urls(ctx, file_key, node_ids)
+    semaphore = asyncio.Semaphore(max(1, IMAGE_DOWNLOAD_CONCURRENCY))
+
+    async def download(node_id: str) -> Optional[bytes]:
+        data = None
+        if urls.get(node_id):
+            async with semaphore:
+                data = await download_rendered_image(ctx, urls[node_id])
+        if on_image:
+            on_image(node_id, data)
+        return data
+
+    results = await asyncio.gather(*(download(node_id) for node_id in node_ids))
+    return dict(zip(node_ids, results))
+
+
+def prefetch_frame_images(ctx: ToolContext, file_key: str, version: Optional[str], node_ids: List[str]) -> Dict[str, asyncio.Future]:
+    """
+    Starts rendering + downloading the images of node_ids in the background and
+    returns a future (bytes or None) per id. With a known version the images are
+    kept in the context's FrameImageStore, so ids already stored (or downloading)
+    are not fetched again. Without a version nothing is stored: only the returned
+    futures see the result, so a later get_frame_image fetches the image again.
+    """
+    store = get_image_store(ctx)
+    loop = asyncio.get_running_loop()
+    if version:
+        futures = {node_id: store.get(file_key, version, node_id) for node_id in node_ids}
+        missing = [node_id for node_id, future in futures.items() if future is None]
+        futures.update(store.reserve(file_key, version, missing))
+    else:
+        missing = list(node_ids)
+        futures = {node_id: loop.create_future() for node_id in node_ids}
+    if not missing:
+        return futures
+
+    def resolve(node_id: str, data: Optional[bytes]):
+        if not futures[node_id].done():
+            futures[node_id].set_result(data)
+
+    async def run():
+        try:
+            await fetch_frame_images(ctx, file_key, missing, on_image=resolve)
+        finally:
+            # Anything not resolved (crash, cancellation) resolves to "no image"
+            for node_id in missing:
+                resolve(node_id, None)
+
+    task = loop.create_task(run())
+    _prefetch_tasks.add(task)
+    task.add_done_callback(_prefetch_tasks.discard)
+    return futures
+
+
+async def get_frame_image(ctx: ToolContext, file_key: str, version: Optional[str], node_id: str) -> Optional[bytes]:
+    """Rendered PNG of one frame: from the store / a running prefetch, or fetched now."""
+    future = prefetch_frame_images(ctx, file_key, version, [node_id])[node_id]
+    # shield: a cancelled frame must not cancel the download other frames may share
+    return await asyncio.shield(future)
 
 
 async def download_node_image_to_temp(ctx: ToolContext, file_key: str, node_id: str) -> str:
@@ -189,7 +403,6 @@ async def download_node_image_to_temp(ctx: ToolContext, file_key: str, node_id:
     Fetches URL and downloads image to a temp file. Returns path or None.
     """
     import tempfile
-    import httpx
     import aiofiles
     
     img_url = await fetch_node_image_url(ctx, file_key, node_id)
@@ -197,19 +410,17 @@ async def download_node_image_to_temp(ctx: ToolContext, file_key: str, node_id:
         return None
         
     try:
+        data = await download_rendered_image(ctx, img_url)
+        if data is None:
+            return None
+        
         # Create temp file
         tf = tempfile.NamedTemporaryFile(delete=False, suffix=".png")
         tf.close()
         temp_path = tf.name
-        
-        async with httpx.AsyncClient() as client:
-            resp = await client.get(img_url)
-            if resp.status_code == 200:
-                async with aiofiles.open(temp_path, "wb") as f:
-                    await f.write(resp.content)
-                return temp_path
-                
-        return None
+        async with aiofiles.open(temp_path, "wb") as f:
+            await f.write(data)
+        return temp_path
     except Exception as e:
         logger.error(f"Failed to download temp image: {e}")
         return None
@@ -232,7 +443,7 @@ async def list_pending_events(ctx: ToolContext, args: Dict[str, Any]) -> Dict[st
     
     async with aiosqlite.connect(db_path) as conn:
         cursor = await conn.execute("""
-            SELECT id, event_id, event_type, file_key, file_name, node_id, timestamp, created_at
+            SELECT id, event_id, event_type, file_key, file_name, node_id, timestamp, created_at, revision
             FROM events
             WHERE status = 'pending'
             ORDER BY created_at DESC
@@ -250,7 +461,8 @@ async def list_pending_events(ctx: ToolContext, args: Dict[str, Any]) -> Dict[st
                 "file_name": row[4],
                 "node_id": row[5],
                 "timestamp": row[6],
-                "created_at": row[7]
+                "created_at": row[7],
+                "revision": row[8]
             })
         
         return {"events": events, "count": len(events)}
@@ -0,0 +1,56 @@
+"""
+atomic_write.py - Write a file exactly once, atomically
+
+The content goes to a hidden temp file in the same directory (same
+filesystem), is fsynced, and is then os.replace()d over the target. Watchers
+such as the Vite dev server see one complete file appear, never a truncated
+or half-written one. If the target already has identical content, nothing is
+written at all.
+
+mkstemp creates the temp file as 0600; it is given the target's permissions
+(or the usual 0666 & ~umask of a new file) before the replace, so a generated
+file stays readable by the dev server, nginx, other users, etc.
+"""
+import os
+import stat
+import tempfile
+from pathlib import Path
+from typing import Union
+
+# Read once: os.umask() can only be queried by setting it, which is not thread-safe
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def write_text_atomic(path: Union[str, Path], content: str, encoding: str = "utf-8") -> bool:
+    """Atomically replace `path` with `content`. Returns False if the file was already identical."""
+    path = Path(path)
+    data = content.encode(encoding)
+    try:
+        if path.read_bytes() == data:
+            return False
+    except OSError:
+        pass
+
+    try:
+        mode = stat.S_IMODE(path.stat().st_mode)
+    except OSError:
+        mode = 0o666 & ~_UMASK
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        # By path, not os.fchmod: that one is missing on Windows before Python 3.13
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+    return True
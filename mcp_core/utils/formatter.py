@@ -0,0 +1,234 @@
+"""
+formatter.py - Prettier formatting for generated code
+
+The worker used to spawn `npx prettier --write` on a temp file for every frame
+(1-3s of npx resolution + Node startup each time). Instead, a single Node
+sidecar (prettier_daemon.js) is started per worker and project root. It takes
+code over stdin and returns formatted code; frames that are ready at the same
+time are sent to it as one batch.
+
+If the daemon cannot start (no Node, Prettier not installed next to the
+project), format_code() falls back to `npx prettier --stdin-filepath`.
+"""
+import os
+import json
+import shutil
+import asyncio
+import logging
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DAEMON_SCRIPT = Path(__file__).parent / "prettier_daemon.js"
+FORMAT_TIMEOUT = float(os.getenv("PRETTIER_TIMEOUT", "10"))
+STARTUP_TIMEOUT = 10
+# Extra time a caller waits for its result beyond one daemon round trip (queueing behind other batches)
+RESULT_MARGIN = 5
+# Formatted components can be large; the default 64KB StreamReader line limit is not enough
+STREAM_LIMIT = 16 * 1024 * 1024
+
+
+class FormatterUnavailable(RuntimeError):
+    """The Prettier daemon is not running and could not be started."""
+
+
+class PrettierDaemon:
+    def __init__(self, project_root: str, batch_max: int = 16, batch_window_ms: float = 10, timeout: float = FORMAT_TIMEOUT):
+        self.project_root = project_root
+        self.batch_max = batch_max
+        self.batch_window = batch_window_ms / 1000
+        self.timeout = timeout
+        self.version: Optional[str] = None
+        # Set once startup fails (e.g. Prettier not installed) so we don't respawn Node per frame
+        self.unavailable: Optional[str] = None
+        self._process: Optional[asyncio.subprocess.Process] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._start_lock: Optional[asyncio.Lock] = None
+        self._next_id = 0
+
+    async def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # New event loop (tests, benchmarks): the old process/task belong to a dead loop
+            self._loop = loop
+            self._process = None
+            self._queue = asyncio.Queue()
+            self._task = None
+            self._start_lock = asyncio.Lock()
+
+        async with self._start_lock:
+            if self.unavailable:
+                raise FormatterUnavailable(self.unavailable)
+            if self._process is None or self._process.returncode is not None:
+                try:
+                    await self._spawn()
+                except FormatterUnavailable as e:
+                    self._fail_queued(e)
+                    raise
+            if self._task is None or self._task.done():
+                self._task = asyncio.create_task(self._run())
+
+    async def _spawn(self):
+        node = shutil.which("node")
+        if not node:
+            self.unavailable = "node executable not found"
+            raise FormatterUnavailable(self.unavailable)
+
+        self._process = await asyncio.create_subprocess_exec(
+            node, str(DAEMON_SCRIPT),
+            cwd=self.project_root,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+            limit=STREAM_LIMIT
+        )
+        try:
+            line = await asyncio.wait_for(self._process.stdout.readline(), STARTUP_TIMEOUT)
+            hello = json.loads(line) if line else {"ready": False, "error": "daemon exited during startup"}
+        except (asyncio.TimeoutError, ValueError) as e:
+            hello = {"ready": False, "error": f"bad startup handshake: {e}"}
+
+        if not hello.get("ready"):
+            await self._kill()
+            self.unavailable = hello.get("error", "daemon failed to start")
+            raise FormatterUnavailable(self.unavailable)
+
+        self.version = hello.get("version")
+        logger.info(f"🎨 Prettier daemon started (prettier {self.version}, pid {self._process.pid})")
+
+    def _fail_queued(self, error: Exception):
+        # Requests queued for a daemon that is gone must not wait forever
+        while not self._queue.empty():
+            _, _, future = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(error)
+
+    async def _kill(self):
+        process, self._process = self._process, None
+        if process and process.returncode is None:
+            process.kill()
+            await process.wait()
+
+    async def format(self, code: str, filepath: str) -> str:
+        """Format one file's code. `filepath` (relative to the project) picks the parser and config."""
+        await self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((code, filepath, future))
+        try:
+            return await asyncio.wait_for(future, self.timeout + self.batch_window + RESULT_MARGIN)
+        except asyncio.TimeoutError:
+            raise FormatterUnavailable(f"no result from prettier daemon after {self.timeout + RESULT_MARGIN:.0f}s")
+
+    async def _next_batch(self) -> List[Tuple[str, str, asyncio.Future]]:
+        batch = [await self._queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.batch_window
+        while len(batch) < self.batch_max:
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                results = await self._send(batch)
+            except Exception as e:
+                # Daemon hung or died: fail this batch (callers fall back) and respawn on next use
+                logger.warning(f"Prettier daemon error, restarting on next use: {e}")
+                await self._kill()
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(FormatterUnavailable(str(e)))
+                # Nothing reads the queue after this task ends; requests already in it must fall back too
+                self._fail_queued(FormatterUnavailable(str(e)))
+                return
+
+            for (_, _, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if "code" in result:
+                    future.set_result(result["code"])
+                else:
+                    future.set_exception(ValueError(result.get("error", "prettier failed")))
+
+    async def _send(self, batch) -> List[Dict[str, str]]:
+        self._next_id += 1
+        request = {"id": self._next_id, "items": [{"code": code, "filepath": filepath} for code, filepath, _ in batch]}
+        self._process.stdin.write((json.dumps(request) + "\n").encode("utf-8"))
+        await self._process.stdin.drain()
+
+        line = await asyncio.wait_for(self._process.stdout.readline(), self.timeout)
+        if not line:
+            raise RuntimeError("prettier daemon exited")
+        response = json.loads(line)
+        if response.get("id") != self._next_id or len(response.get("results", [])) != len(batch):
+            raise RuntimeError(f"unexpected daemon response: {response.get('error') or response.get('id')}")
+        return response["results"]
+
+    async def close(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+        if self._process and self._process.returncode is None:
+            self._process.stdin.close()
+            try:
+                await asyncio.wait_for(self._process.wait(), 2)
+            except asyncio.TimeoutError:
+                await self._kill()
+        self._process = None
+
+
+async def format_with_npx(code: str, filepath: str, project_root: str, timeout: float = FORMAT_TIMEOUT) -> str:
+    """Fallback: one `npx prettier --stdin-filepath` process per call (no temp file)."""
+    npx = shutil.which("npx") or "npx"
+    process = await asyncio.create_subprocess_exec(
+        npx, "prettier", "--stdin-filepath", filepath,
+        cwd=project_root,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(code.encode("utf-8")), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise RuntimeError(f"npx prettier timed out after {timeout:.0f}s")
+    if process.returncode != 0:
+        raise RuntimeError(stderr.decode("utf-8", "replace").strip() or f"npx prettier exited with {process.returncode}")
+    return stdout.decode("utf-8")
+
+
+# One daemon per project root, shared by every frame in the worker
+_daemons: Dict[str, PrettierDaemon] = {}
+
+
+def get_daemon(project_root: str) -> PrettierDaemon:
+    key = os.path.abspath(project_root)
+    if key not in _daemons:
+        _daemons[key] = PrettierDaemon(key)
+    return _daemons[key]
+
+
+async def format_code(code: str, filepath: str, project_root: str) -> str:
+    """
+    Format code with Prettier. Uses the shared daemon; falls back to npx only
+    if the daemon is unavailable. Raises on formatting errors.
+    """
+    try:
+        return await get_daemon(project_root).format(code, filepath)
+    except FormatterUnavailable as e:
+        logger.debug(f"Prettier daemon unavailable ({e}), using npx")
+        return await format_with_npx(code, filepath, project_root)
+
+
+async def close_all():
+    for daemon in _daemons.values():
+        await daemon.close()
@@ -0,0 +1,361 @@
+"""
+jsx_syntax.py - Fast, in-process syntax check for generated JSX/TSX
+
+Not a full JavaScript parser: a mode-aware scanner that understands just
+enough of the language to catch what LLM output actually gets wrong, in a few
+milliseconds and without Node:
+
+- unbalanced or mismatched (), [], {}
+- unterminated strings, template literals, comments and regexes
+- JSX tags that are never closed, closed with the wrong name, or contain
+  stray `}` / `>` in their text
+- leftover markdown code fences
+
+Errors carry 1-based line/column plus a code frame, in a format that can be
+fed straight to LLMCoder.fix_code.
+"""
+import re
+from typing import List, Optional, Tuple
+
+# Identifiers may use any Unicode letter (`café`, `名前`) and `\u0061` / `\u{61}` escapes
+_UNICODE_ESCAPE = r"\\u(?:[0-9a-fA-F]{4}|\{[0-9a-fA-F]+\})"
+_ID_START = rf"(?:[^\W\d]|\$|{_UNICODE_ESCAPE})"
+_ID_PART = rf"(?:[\w$\u200c\u200d]|{_UNICODE_ESCAPE})"
+IDENT_START = re.compile(_ID_START)
+IDENT = re.compile(rf"{_ID_PART}*")
+NUMBER = re.compile(r"(?:0[xXoObB][0-9a-fA-F_]+|(?:\d[\d_]*\.?[\d_]*|\.\d[\d_]*)(?:[eE][+-]?\d+)?)n?")
+JSX_NAME = re.compile(rf"{_ID_START}(?:{_ID_PART}|-)*(?:[.:]{_ID_START}(?:{_ID_PART}|-)*)*")
+JSX_ATTR_NAME = re.compile(rf"{_ID_START}(?:{_ID_PART}|-)*(?::{_ID_START}(?:{_ID_PART}|-)*)?")
+# `<T>(` of a generic function type, e.g. `type Fn = <T>(x: T) => T`
+TYPE_PARAMETER = re.compile(rf"<\s*{_ID_START}{_ID_PART}*\s*>\s*\(")
+
+# After these words an expression starts, so `/` is a regex and `<` starts JSX
+EXPRESSION_KEYWORDS = {
+    "return", "typeof", "instanceof", "in", "of", "new", "delete", "void", "throw",
+    "case", "do", "else", "yield", "await", "default", "extends"
+}
+CLOSERS = {")": "(", "]": "[", "}": "{"}
+
+
+class JSXSyntaxError(Exception):
+    def __init__(self, message: str, line: int, col: int):
+        super().__init__(message)
+        self.message = message
+        self.line = line
+        self.col = col
+
+
+class _Scanner:
+    def __init__(self, source: str, typescript: bool = False):
+        self.src = source
+        self.n = len(source)
+        self.typescript = typescript
+        self.i = 0
+
+    # --- helpers -------------------------------------------------------------
+
+    def position(self, index: int) -> Tuple[int, int]:
+        line = self.src.count("\n", 0, index) + 1
+        col = index - (self.src.rfind("\n", 0, index) + 1) + 1
+        return line, col
+
+    def error(self, message: str, index: Optional[int] = None):
+        line, col = self.position(self.i if index is None else index)
+        raise JSXSyntaxError(message, line, col)
+
+    def peek(self, offset: int = 0) -> str:
+        j = self.i + offset
+        return self.src[j] if j < self.n else ""
+
+    def skip_whitespace_and_comments(self):
+        while self.i < self.n:
+            c = self.src[self.i]
+            if c in " \t\r\n\ufeff":
+                self.i += 1
+            elif self.src.startswith("//", self.i):
+                end = self.src.find("\n", self.i)
+                self.i = self.n if end == -1 else end
+            elif self.src.startswith("/*", self.i):
+                end = self.src.find("*/", self.i + 2)
+                if end == -1:
+                    self.error("Unterminated comment")
+                self.i = end + 2
+            else:
+                return
+
+    # --- JavaScript ----------------------------------------------------------
+
+    def scan_js(self, until: Optional[str] = None):
+        """
+        Scan JS until EOF, or until an unmatched `until` closer (the `}` of a
+        `${...}` or a JSX expression container), which is consumed.
+        """
+        stack: List[Tuple[str, int]] = []
+        expr_allowed = True
+        while True:
+            self.skip_whitespace_and_comments()
+            if self.i >= self.n:
+                if stack:
+                    opener, index = stack[-1]
+                    self.error(f"Unclosed '{opener}'", index)
+                if until:
+                    self.error(f"Expected '{until}' before end of file")
+                return
+
+            c = self.src[self.i]
+            start = self.i
+
+            if self.src.startswith("```", self.i):
+                self.error("Markdown code fence in source")
+            elif c in "([{":
+                stack.append((c, start))
+                self.i += 1
+                expr_allowed = True
+            elif c in ")]}":
+                if not stack:
+                    if c == until:
+                        self.i += 1
+                        return
+                    self.error(f"Unexpected '{c}'")
+                opener, index = stack.pop()
+                if CLOSERS[c] != opener:
+                    line, col = self.position(index)
+                    self.error(f"Unexpected '{c}', expected closer for '{opener}' opened at {line}:{col}")
+                self.i += 1
+                # `}` usually ends a block, after which a new statement (or JSX) may start
+                expr_allowed = c == "}"
+            elif c in "'\"":
+                self.scan_string(c)
+                expr_allowed = False
+            elif c == "`":
+                self.scan_template()
+                expr_allowed = False
+            elif c == "/" and expr_allowed:
+                self.scan_regex()
+                expr_allowed = False
+            elif c == "<" and expr_allowed and self.looks_like_jsx():
+                self.scan_jsx_element()
+                expr_allowed = False
+            elif IDENT_START.match(self.src, self.i):
+                self.i = IDENT.match(self.src, self.i).end()
+                expr_allowed = self.src[start:self.i] in EXPRESSION_KEYWORDS
+            elif c.isdigit() or (c == "." and self.peek(1).isdigit()):
+                self.i = NUMBER.match(self.src, self.i).end() or self.i + 1
+                expr_allowed = False
+            else:
+                # Operators / punctuation: an expression may follow, except after ++ / --
+                if self.src.startswith(("++", "--"), self.i):
+                    self.i += 2
+                    expr_allowed = False
+                else:
+                    self.i += 1
+                    expr_allowed = True
+
+    def scan_string(self, quote: str):
+        start = self.i
+        self.i += 1
+        while self.i < self.n:
+            c = self.src[self.i]
+            if c == "\\":
+                self.i += 2
+            elif c == quote:
+                self.i += 1
+                return
+            elif c == "\n":
+                self.error("Unterminated string literal", start)
+            else:
+                self.i += 1
+        self.error("Unterminated string literal", start)
+
+    def scan_template(self):
+        start = self.i
+        self.i += 1
+        while self.i < self.n:
+            c = self.src[self.i]
+            if c == "\\":
+                self.i += 2
+            elif c == "`":
+                self.i += 1
+                return
+            elif self.src.startswith("${", self.i):
+                self.i += 2
+                self.scan_js(until="}")
+            else:
+                self.i += 1
+        self.error("Unterminated template literal", start)
+
+    def scan_regex(self):
+        start = self.i
+        self.i += 1
+        in_class = False
+        while self.i < self.n:
+            c = self.src[self.i]
+            if c == "\\":
+                self.i += 2
+                continue
+            if c == "\n":
+                break
+            if c == "[":
+                in_class = True
+            elif c == "]":
+                in_class = False
+            elif c == "/" and not in_class:
+                self.i += 1
+                self.i = IDENT.match(self.src, self.i).end()  # flags
+                return
+            self.i += 1
+        self.error("Unterminated regular expression", start)
+
+    # --- JSX -----------------------------------------------------------------
+
+    def looks_like_jsx(self) -> bool:
+        nxt = self.peek(1)
+        if nxt == ">":
+            return True  # fragment
+        if not IDENT_START.match(self.src, self.i + 1):
+            return False
+        if self.typescript:
+            # `<T,>(x: T) => ...` / `<T extends U>` are generic arrow functions, not JSX
+            match = JSX_NAME.match(self.src, self.i + 1)
+            rest = self.src[match.end():match.end() + 9].lstrip()
+            if rest.startswith(",") or rest.startswith("extends "):
+                return False
+            if self.looks_like_function_type():
+                return False
+        return True
+
+    def looks_like_function_type(self) -> bool:
+        """
+        `<T>(x: T) => T` right after `=` or `:` (a type alias or an annotation) is a
+        generic function type, not an element: TypeScript never parses JSX in types.
+        """
+        before = self.src[:self.i].rstrip()
+        if not before or before[-1] not in "=:" or before[-2:] in ("==", "!=", "<=", ">="):
+            return False
+        match = TYPE_PARAMETER.match(self.src, self.i)
+        if not match:
+            return False
+        # The parameter list must be followed by `=>`; `<b>(note)</b>` is still JSX
+        depth, j = 0, match.end() - 1
+        while j < self.n:
+            if self.src[j] == "(":
+                depth += 1
+            elif self.src[j] == ")":
+                depth -= 1
+                if depth == 0:
+                    return self.src[j + 1:].lstrip().startswith("=>")
+            j += 1
+        return False
+
+    def read_jsx_name(self) -> str:
+        match = JSX_NAME.match(self.src, self.i)
+        if not match:
+            self.error("Expected JSX tag name")
+        self.i = match.end()
+        return match.group()
+
+    def scan_jsx_element(self):
+        """Scan one element (or fragment) starting at `<`, including its children and closing tag."""
+        open_index = self.i
+        self.i += 1
+        self.skip_whitespace_and_comments()
+
+        if self.peek() == ">":
+            name = ""
+            self.i += 1
+        else:
+            name = self.read_jsx_name()
+            if self.scan_jsx_attributes():
+                return  # self-closing
+
+        label = f"<{name}>"
+        while True:
+            if self.i >= self.n:
+                line, col = self.position(open_index)
+                self.error(f"Unterminated JSX contents: {label} opened at {line}:{col} is never closed", open_index)
+            c = self.src[self.i]
+            if c == "{":
+                self.i += 1
+                self.scan_js(until="}")
+            elif c == "<":
+                if self.src.startswith("</", self.i):
+                    close_index = self.i
+                    self.i += 2
+                    self.skip_whitespace_and_comments()
+                    closing = "" if self.peek() == ">" else self.read_jsx_name()
+                    self.skip_whitespace_and_comments()
+                    if self.peek() != ">":
+                        self.error("Expected '>' to end closing tag")
+                    self.i += 1
+                    if closing != name:
+                        line, col = self.position(open_index)
+                        self.error(f"Expected corresponding JSX closing tag for {label} (opened at {line}:{col}), found </{closing}>", close_index)
+                    return
+                self.scan_jsx_element()
+            elif c in "}>":
+                self.error(f"Unexpected token '{c}' in JSX text. Did you mean `{{'{c}'}}`?")
+            else:
+                self.i += 1
+
+    def scan_jsx_attributes(self) -> bool:
+        """Scan attributes up to `>` or `/>`. Returns True for a self-closing tag."""
+        while True:
+            self.skip_whitespace_and_comments()
+            if self.i >= self.n:
+                self.error("Unterminated JSX tag")
+            c = self.src[self.i]
+            if c == ">":
+                self.i += 1
+                return False
+            if self.src.startswith("/>", self.i):
+                self.i += 2
+                return True
+            if c == "{":
+                # spread attribute {...props}
+                self.i += 1
+                self.scan_js(until="}")
+                continue
+            match = JSX_ATTR_NAME.match(self.src, self.i)
+            if not match:
+                self.error(f"Unexpected token '{c}' in JSX tag")
+            self.i = match.end()
+            self.skip_whitespace_and_comments()
+            if self.peek() != "=":
+                continue
+            self.i += 1
+            self.skip_whitespace_and_comments()
+            c = self.peek()
+            if c in "'\"":
+                # JSX attribute strings may span lines and have no escapes
+                end = self.src.find(c, self.i + 1)
+                if end == -1:
+                    self.error("Unterminated JSX attribute string")
+                self.i = end + 1
+            elif c == "{":
+                self.i += 1
+                self.scan_js(until="}")
+            elif c == "<":
+                self.scan_jsx_element()
+            else:
+                self.error("JSX attribute value must be a string, an {expression} or an element")
+
+
+def check_jsx_syntax(source: str, typescript: bool = False) -> Optional[JSXSyntaxError]:
+    """Return the first syntax error in `source`, or None if it looks well-formed."""
+    try:
+        _Scanner(source, typescript=typescript).scan_js()
+    except JSXSyntaxError as e:
+        return e
+    return None
+
+
+def format_syntax_error(error: JSXSyntaxError, source: str, file_name: str = "component.jsx") -> str:
+    """tsc-style one-liner plus a code frame, e.g. for LLMCoder.fix_code."""
+    lines = source.splitlines()
+    frame = []
+    for number in range(max(1, error.line - 1), min(len(lines), error.line + 1) + 1):
+        marker = ">" if number == error.line else " "
+        frame.append(f"{marker} {number:>4} | {lines[number - 1]}")
+        if number == error.line:
+            frame.append(f"  {'':>4} | {' ' * (error.col - 1)}^")
+    return f"{file_name}({error.line},{error.col}): SyntaxError: {error.message}\n" + "\n".join(frame)
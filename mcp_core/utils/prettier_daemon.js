@@ -0,0 +1,73 @@
+#!/usr/bin/env node
+/*
+ * prettier_daemon.js - Long-lived Prettier formatter for the automation worker
+ *
+ * Started once per worker by mcp_core/utils/formatter.py, so Node startup and
+ * npx resolution are paid once instead of per frame. Nothing touches disk:
+ * code comes in as a string and goes back as a string.
+ *
+ * Protocol (one JSON object per line on stdin/stdout):
+ *   startup  -> {"ready": true, "version": "3.3.3"}  or  {"ready": false, "error": "..."}
+ *   request  <- {"id": 1, "items": [{"code": "...", "filepath": "src/Card.jsx"}, ...]}
+ *   response -> {"id": 1, "results": [{"code": "..."} or {"error": "..."}, ...]}
+ *
+ * Prettier is resolved from the project (cwd) first, then next to this file,
+ * then from the global NODE_PATH. The project's .prettierrc is honoured.
+ */
+const path = require("path");
+const readline = require("readline");
+
+function loadPrettier() {
+  for (const base of [process.cwd(), __dirname]) {
+    try {
+      return require(require.resolve("prettier", { paths: [base] }));
+    } catch (e) {
+      // try the next location
+    }
+  }
+  return require("prettier");
+}
+
+function send(message) {
+  process.stdout.write(JSON.stringify(message) + "\n");
+}
+
+let prettier;
+try {
+  prettier = loadPrettier();
+} catch (e) {
+  send({ ready: false, error: `prettier not found: ${e.message}` });
+  process.exit(1);
+}
+
+async function formatItem(item) {
+  try {
+    const filepath = path.resolve(process.cwd(), item.filepath || "component.jsx");
+    const config = (await prettier.resolveConfig(filepath)) || {};
+    // format() is sync in Prettier 2 and async in Prettier 3; await handles both
+    const code = await prettier.format(item.code, { ...config, filepath });
+    return { code };
+  } catch (e) {
+    return { error: e.message };
+  }
+}
+
+const rl = readline.createInterface({ input: process.stdin, terminal: false });
+
+rl.on("line", async (line) => {
+  if (!line.trim()) return;
+  let request;
+  try {
+    request = JSON.parse(line);
+  } catch (e) {
+    send({ id: null, error: `bad request: ${e.message}` });
+    return;
+  }
+  const results = await Promise.all((request.items || []).map(formatItem));
+  send({ id: request.id, results });
+});
+
+// Worker went away (stdin closed): exit instead of lingering as an orphan
+rl.on("close", () => process.exit(0));
+
+send({ ready: true, version: prettier.version });
@@ -1,20 +1,47 @@
 import subprocess
 import os
+import re
+import json
+import shutil
+import asyncio
+import hashlib
 import logging
+import tempfile
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from .jsx_syntax import check_jsx_syntax, format_syntax_error
 
 logger = logging.getLogger(__name__)
 
+def check_syntax(source: str, file_name: str) -> Tuple[bool, str]:
+    """In-process JSX/TSX syntax check. Errors come back tsc-style with a code frame."""
+    error = check_jsx_syntax(source, typescript=file_name.endswith(TYPECHECKED_EXTENSIONS))
+    if error:
+        return False, format_syntax_error(error, source, file_name)
+    return True, "✅ Syntax OK"
+
+
 def validate_code(file_path: str, cwd: str = None) -> tuple[bool, str]:
     """
     Runs a syntax check on the generated file.
+    All files: fast in-process JSX/TSX syntax check first (milliseconds)
     For .jsx files: Skip TypeScript validation (prototyping mode)
     For .tsx files: Use TypeScript Compiler (tsc)
     Returns: (is_valid, error_message)
     """
-    # Skip validation for JSX files (prototyping mode)
+    try:
+        with open(file_path, "r", encoding="utf-8") as f:
+            is_valid, message = check_syntax(f.read(), os.path.basename(file_path))
+        if not is_valid:
+            return False, message
+    except OSError as e:
+        return False, f"Validation System Error: {str(e)}"
+
+    # Skip type checking for JSX files (prototyping mode)
     if file_path.endswith('.jsx') or file_path.endswith('.js'):
         logger.info("   ✅ JSX file detected - skipping TypeScript validation (prototyping mode)")
-        return True, "✅ JSX validation skipped (prototyping mode)"
+        return True, "✅ JSX syntax OK (type check skipped, prototyping mode)"
     
     try:
         # TypeScript validation for .tsx files
@@ -45,3 +72,231 @@ def validate_code(file_path: str, cwd: str = None) -> tuple[bool, str]:
 
     except Exception as e:
         return False, f"Validation System Error: {str(e)}"
+
+
+# ============================================================
+# BATCHED, INCREMENTAL TYPE CHECKING
+# ============================================================
+#
+# validate_code() above pays a cold `npx tsc` per file. TypeCheckService keeps
+# one tsc project per worker: frames that finish generation close together are
+# checked in a single program, and `--incremental` (.tsbuildinfo) lets tsc
+# reuse React/MUI type information between batches.
+#
+# Sources never touch the project root. They are written under a private
+# scratch dir that mirrors their project paths, and `rootDirs` merges that
+# dir with the project so relative imports ('./Button') and node_modules
+# resolve as if the file were already in place.
+
+TSC_DIAGNOSTIC = re.compile(r"^(?P<path>.+?)\((?P<line>\d+),(?P<col>\d+)\): (?P<kind>error|warning) (?P<code>TS\d+): (?P<message>.*)$")
+TYPECHECK_BATCH_WINDOW_MS = float(os.getenv("TYPECHECK_BATCH_WINDOW_MS", "200"))
+TYPECHECK_TIMEOUT = float(os.getenv("TYPECHECK_TIMEOUT", "120"))
+TYPECHECKED_EXTENSIONS = (".ts", ".tsx")
+
+
+def scratch_root() -> Path:
+    """
+    Where validation scratch files live: TYPECHECK_SCRATCH_DIR if set, else
+    tmpfs (/dev/shm) when available, else the system temp dir. Never the project root.
+    """
+    configured = os.getenv("TYPECHECK_SCRATCH_DIR")
+    if configured:
+        return Path(configured)
+    shm = Path("/dev/shm")
+    if shm.is_dir() and os.access(shm, os.W_OK):
+        return shm
+    return Path(tempfile.gettempdir())
+
+
+class TypeCheckService:
+    def __init__(self, project_root: str, batch_window_ms: float = TYPECHECK_BATCH_WINDOW_MS, batch_max: int = 32,
+                 cache_dir: Optional[Path] = None, timeout: float = TYPECHECK_TIMEOUT):
+        self.project_root = os.path.abspath(project_root)
+        self.batch_window = batch_window_ms / 1000
+        self.batch_max = batch_max
+        self.timeout = timeout
+        # Per project and per process, so concurrent workers never share a scratch dir
+        project_hash = hashlib.sha1(self.project_root.encode("utf-8")).hexdigest()[:12]
+        self.cache_dir = Path(cache_dir or scratch_root() / "mcp_typecheck" / f"{project_hash}-{os.getpid()}")
+        self.scratch_dir = self.cache_dir / "root"
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._lock = asyncio.Lock()
+            self._task = None
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def check(self, source: str, rel_path: str) -> Tuple[bool, str]:
+        """Type-check one file (path relative to the project). Batched with other concurrent calls."""
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((rel_path, source, future))
+        return await future
+
+    async def _next_batch(self) -> list:
+        batch = [await self._queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.batch_window
+        while len(batch) < self.batch_max:
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            # One scratch file per project path: a second frame targeting the same path waits for the next program
+            files, deferred = {}, []
+            for item in batch:
+                if item[0] in files:
+                    deferred.append(item)
+                else:
+                    files[item[0]] = item
+            for item in deferred:
+                self._queue.put_nowait(item)
+
+            try:
+                results = await self.check_batch({rel_path: source for rel_path, source, _ in files.values()})
+            except Exception as e:
+                results = {rel_path: (False, f"Validation System Error: {e}") for rel_path in files}
+
+            for rel_path, (_, _, future) in files.items():
+                if not future.done():
+                    future.set_result(results[rel_path])
+
+    async def check_batch(self, files: Dict[str, str]) -> Dict[str, Tuple[bool, str]]:
+        """
+        Type-check several files in one tsc program.
+        `files` maps project-relative path -> source. Returns path -> (is_valid, diagnostics).
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            scratch_files = self._write_scratch(files)
+            self._write_tsconfig(list(scratch_files))
+            returncode, output = await self._run_tsc()
+        return self._map_diagnostics(scratch_files, returncode, output)
+
+    def _write_scratch(self, files: Dict[str, str]) -> Dict[str, str]:
+        shutil.rmtree(self.scratch_dir, ignore_errors=True)
+        self.scratch_dir.mkdir(parents=True, exist_ok=True)
+        scratch_files = {}
+        for rel_path, source in files.items():
+            # Keep the project layout, but never let a path escape the scratch dir
+            parts = [part for part in Path(rel_path.replace("\\", "/")).parts if part not in ("..", ".", "/") and not part.endswith(":")]
+            target = self.scratch_dir.joinpath(*parts)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            target.write_text(source, encoding="utf-8")
+            scratch_files[os.path.normcase(str(target))] = rel_path
+        return scratch_files
+
+    def _write_tsconfig(self, scratch_paths: list):
+        node_modules = os.path.join(self.project_root, "node_modules")
+        config = {
+            "compilerOptions": {
+                "noEmit": True,
+                "incremental": True,
+                "tsBuildInfoFile": str(self.cache_dir / ".tsbuildinfo"),
+                "skipLibCheck": True,
+                "jsx": "react-jsx",
+                "target": "esnext",
+                "module": "esnext",
+                "moduleResolution": "node",
+                "esModuleInterop": True,
+                "allowSyntheticDefaultImports": True,
+                "rootDirs": [str(self.scratch_dir), self.project_root],
+                "baseUrl": self.project_root,
+                "paths": {"*": ["node_modules/*", "node_modules/@types/*"]},
+                "typeRoots": [os.path.join(node_modules, "@types")]
+            },
+            "files": scratch_paths
+        }
+        with open(self.cache_dir / "tsconfig.json", "w", encoding="utf-8") as f:
+            json.dump(config, f, indent=2)
+
+    def _tsc_command(self) -> list:
+        local_tsc = os.path.join(self.project_root, "node_modules", ".bin", "tsc.cmd" if os.name == "nt" else "tsc")
+        if os.path.exists(local_tsc):
+            return [local_tsc]
+        if shutil.which("tsc"):
+            return [shutil.which("tsc")]
+        return [shutil.which("npx") or "npx", "tsc"]
+
+    async def _run_tsc(self) -> Tuple[int, str]:
+        process = await asyncio.create_subprocess_exec(
+            *self._tsc_command(), "-p", str(self.cache_dir / "tsconfig.json"), "--pretty", "false",
+            cwd=str(self.cache_dir),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT
+        )
+        try:
+            stdout, _ = await asyncio.wait_for(process.communicate(), self.timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise RuntimeError(f"tsc timed out after {self.timeout:.0f}s")
+        return process.returncode, stdout.decode("utf-8", "replace")
+
+    def _map_diagnostics(self, scratch_files: Dict[str, str], returncode: int, output: str) -> Dict[str, Tuple[bool, str]]:
+        per_file = {rel_path: [] for rel_path in scratch_files.values()}
+        unattributed = []
+        current = None
+        for line in output.splitlines():
+            match = TSC_DIAGNOSTIC.match(line)
+            if match:
+                path = os.path.normcase(os.path.normpath(os.path.join(str(self.cache_dir), match["path"])))
+                current = scratch_files.get(path)
+                target = per_file[current] if current else unattributed
+                # Report against the project path the LLM knows, not our scratch path
+                target.append(f"{current or match['path']}({match['line']},{match['col']}): {match['kind']} {match['code']}: {match['message']}")
+            elif line.strip():
+                # Continuation lines belong to the previous diagnostic
+                (per_file[current] if current else unattributed).append(line)
+
+        results = {}
+        for rel_path, diagnostics in per_file.items():
+            if diagnostics:
+                results[rel_path] = (False, "\n".join(diagnostics))
+            elif returncode != 0 and unattributed and not any(per_file.values()):
+                # tsc failed without blaming any of our files (bad config, missing tsc): fail them all
+                results[rel_path] = (False, "\n".join(unattributed))
+            else:
+                results[rel_path] = (True, "✅ Code compiled successfully.")
+        return results
+
+
+_type_checkers: Dict[str, TypeCheckService] = {}
+
+
+def get_type_checker(project_root: str) -> TypeCheckService:
+    key = os.path.abspath(project_root)
+    if key not in _type_checkers:
+        _type_checkers[key] = TypeCheckService(key)
+    return _type_checkers[key]
+
+
+async def check_code(source: str, rel_path: str, project_root: str) -> Tuple[bool, str]:
+    """
+    Async, in-memory counterpart of validate_code(). Every file gets the fast
+    syntax check; only syntactically valid .ts/.tsx go on to the shared batched
+    type checker, while .jsx/.js keep the prototyping-mode type-check skip.
+    """
+    is_valid, message = check_syntax(source, rel_path)
+    if not is_valid:
+        return False, message
+    if not rel_path.endswith(TYPECHECKED_EXTENSIONS):
+        logger.info("   ✅ JSX syntax OK - skipping TypeScript validation (prototyping mode)")
+        return True, "✅ JSX syntax OK (type check skipped, prototyping mode)"
+    return await get_type_checker(project_root).check(source, rel_path)
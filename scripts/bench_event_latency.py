@@ -0,0 +1,149 @@
+"""
+End-to-end latency benchmark: webhook POST -> worker picks the event up.
+
+Starts the real webhook server (uvicorn, in-process) against a throwaway
+events.db, then runs a consumer that mirrors the worker's main loop:
+  - poll:   sleep FALLBACK_POLL_INTERVAL between DB checks (old behaviour)
+  - stream: EventStreamListener wakes the loop on /events/stream notices
+
+"Pipeline start" is the moment the consumer has read the pending row and
+marked it 'processing', i.e. where process_tick hands off to process_pipeline.
+
+Usage:
+    python scripts/bench_event_latency.py --events 20
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import socket
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+import aiosqlite
+import httpx
+import uvicorn
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import webhook_server
+import automation_worker
+from automation_worker import EventStreamListener
+from scripts.init_db import init_db
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def consume(mode: str, db_path: Path, stream_url: str, picked: dict, stop: asyncio.Event):
+    """Worker-shaped loop: check pending rows, mark them, then wait for more work."""
+    listener = None
+    listener_task = None
+    if mode == "stream":
+        listener = EventStreamListener(stream_url)
+        listener_task = asyncio.create_task(listener.run())
+
+    try:
+        async with aiosqlite.connect(db_path) as db:
+            while not stop.is_set():
+                cursor = await db.execute("SELECT id FROM events WHERE status = 'pending'")
+                rows = await cursor.fetchall()
+                now = time.perf_counter()
+                for (event_id,) in rows:
+                    picked.setdefault(event_id, now)
+                if rows:
+                    await db.executemany("UPDATE events SET status = 'processing' WHERE id = ?", rows)
+                    await db.commit()
+
+                if listener:
+                    await listener.wait(listener.poll_interval())
+                else:
+                    await asyncio.sleep(automation_worker.FALLBACK_POLL_INTERVAL)
+    finally:
+        if listener_task:
+            listener_task.cancel()
+
+
+async def bench(mode: str, events: int, workdir: Path) -> list:
+    db_path = workdir / f"events_{mode}.db"
+    init_db(db_path)
+    webhook_server.event_writer = webhook_server.EventWriter(
+        db_path, on_commit=webhook_server.event_broadcaster.publish
+    )
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(webhook_server.app, host="127.0.0.1", port=port, log_level="warning"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    base_url = f"http://127.0.0.1:{port}"
+    picked, posted = {}, {}
+    stop = asyncio.Event()
+    consumer = asyncio.create_task(consume(mode, db_path, f"{base_url}/events/stream", picked, stop))
+    await asyncio.sleep(0.5)  # let the stream subscribe
+
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        for i in range(events):
+            # Spread posts out so each lands at a random point of the poll cycle
+            await asyncio.sleep(random.uniform(0.2, 1.5))
+            payload = {
+                "event_type": "FILE_UPDATE",
+                "file_key": "benchFileKey",
+                "file_name": "Bench File",
+                "node_id": f"1:{i}",
+                "webhook_id": str(uuid.uuid4()),
+                "timestamp": str(time.time()),
+            }
+            start = time.perf_counter()
+            resp = await client.post("/figma-webhook", content=json.dumps(payload))
+            posted[resp.json()["event_id"]] = start
+
+    deadline = time.perf_counter() + automation_worker.FALLBACK_POLL_INTERVAL + 2
+    while len(picked) < len(posted) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+
+    stop.set()
+    consumer.cancel()
+    server.should_exit = True
+    await server_task
+    await webhook_server.event_writer.close()
+
+    return [(picked[event_id] - start) * 1000 for event_id, start in posted.items() if event_id in picked]
+
+
+def summarize(label: str, latencies: list):
+    latencies = sorted(latencies)
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    print(f"  {label:<7} n={len(latencies):<4} mean={statistics.mean(latencies):8.1f}ms "
+          f"p50={statistics.median(latencies):8.1f}ms p95={p95:8.1f}ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark webhook-to-worker latency")
+    parser.add_argument("--events", type=int, default=20)
+    args = parser.parse_args()
+
+    logging.getLogger("figma-webhook").setLevel(logging.WARNING)
+    logging.getLogger("AutomationWorker").setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    os.environ.pop("FIGMA_FILE_KEY", None)
+
+    print(f"Measuring POST -> pickup latency over {args.events} events")
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        summarize("poll", await bench("poll", args.events, workdir))
+        summarize("stream", await bench("stream", args.events, workdir))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,149 @@
+"""
+Per-frame Figma latency: one client per call (old) vs the pooled FigmaClient.
+
+Starts a local stub of the Figma API (plain HTTP/1.1 with keep-alive). Every
+new connection is held for --handshake-ms before it is served, standing in for
+the TCP + TLS round trips a real connection to api.figma.com / S3 costs. Each
+"frame" makes the calls the worker makes per frame:
+
+    GET /v1/files/{key}/nodes   (design)
+    GET /v1/images/{key}        (render URL)
+    GET <render URL>            (PNG download)
+    GET /v1/files/{key}/versions (change poll)
+
+Usage:
+    python scripts/bench_figma_client.py --frames 50 --handshake-ms 60
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from mcp_core.services.figma_client import FigmaClient
+from scripts.pipeline_report import percentile
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\0" * 20000
+
+
+class StubFigma:
+    """Minimal keep-alive HTTP/1.1 server answering the four Figma calls above."""
+
+    def __init__(self, handshake_ms: float, server_ms: float):
+        self.handshake = handshake_ms / 1000
+        self.server_time = server_ms / 1000
+        self.connections = 0
+        self.requests = 0
+        self.port = None
+
+    def respond(self, path: str) -> tuple:
+        if path.startswith("/render/"):
+            return "image/png", PNG
+        if "/versions" in path:
+            body = {"versions": [{"id": "1", "created_at": "2024-01-01T00:00:00Z"}]}
+        elif path.startswith("/v1/images/"):
+            body = {"images": {"1:2": f"http://127.0.0.1:{self.port}/render/1-2.png"}}
+        else:
+            body = {"name": "Stub", "nodes": {"1:2": {"document": {"id": "1:2", "type": "FRAME", "children": []}}}}
+        return "application/json", json.dumps(body).encode()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        await asyncio.sleep(self.handshake)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                while (await reader.readline()) not in (b"\r\n", b""):
+                    pass
+                self.requests += 1
+                await asyncio.sleep(self.server_time)
+                content_type, body = self.respond(request_line.split()[1].decode())
+                writer.write(
+                    f"HTTP/1.1 200 OK\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                    f"Connection: keep-alive\r\n\r\n".encode() + body
+                )
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = server.sockets[0].getsockname()[1]
+        return server
+
+
+async def frame_calls(get, file_key: str = "stubKey"):
+    await get(f"/v1/files/{file_key}/nodes?ids=1:2&depth=5")
+    resp = await get(f"/v1/images/{file_key}?ids=1:2&format=png")
+    await get(resp.json()["images"]["1:2"])
+    await get(f"/v1/files/{file_key}/versions?page_size=1")
+
+
+async def run_unpooled(base_url: str, frames: int) -> list:
+    """The old behaviour: every call opens (and closes) its own AsyncClient."""
+    async def get(url):
+        async with httpx.AsyncClient(base_url=base_url) as client:
+            return await client.get(url)
+
+    timings = []
+    for _ in range(frames):
+        start = time.perf_counter()
+        await frame_calls(get)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+async def run_pooled(base_url: str, frames: int) -> list:
+    client = FigmaClient(base_url=base_url, token="stub-token")
+    timings = []
+    try:
+        for _ in range(frames):
+            start = time.perf_counter()
+            await frame_calls(client.get)
+            timings.append((time.perf_counter() - start) * 1000)
+    finally:
+        await client.aclose()
+    return timings
+
+
+def summarize(label: str, timings: list, stub: StubFigma):
+    values = sorted(timings)
+    print(f"  {label:<9} mean={statistics.mean(values):7.1f}ms  p50={percentile(values, 50):7.1f}ms  "
+          f"p95={percentile(values, 95):7.1f}ms  connections={stub.connections}  requests={stub.requests}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark pooled vs per-call Figma HTTP clients")
+    parser.add_argument("--frames", type=int, default=50)
+    parser.add_argument("--handshake-ms", type=float, default=60, help="Simulated TCP+TLS setup per new connection")
+    parser.add_argument("--server-ms", type=float, default=5, help="Simulated server time per request")
+    args = parser.parse_args()
+    os.environ.pop("HTTP_PROXY", None)
+    os.environ.pop("HTTPS_PROXY", None)
+
+    print(f"{args.frames} frames x 4 calls, {args.handshake_ms:.0f}ms connection setup, {args.server_ms:.0f}ms server time")
+    results = {}
+    for label, runner in (("per-call", run_unpooled), ("pooled", run_pooled)):
+        stub = StubFigma(args.handshake_ms, args.server_ms)
+        server = await stub.start()
+        results[label] = await runner(f"http://127.0.0.1:{stub.port}", args.frames)
+        server.close()
+        summarize(label, results[label], stub)
+
+    saved = statistics.mean(results["per-call"]) - statistics.mean(results["pooled"])
+    print(f"  saved per frame: {saved:.1f}ms")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
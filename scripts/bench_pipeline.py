@@ -0,0 +1,245 @@
+"""
+Offline throughput benchmark: synthetic events through the real worker pipeline.
+
+Figma, Gemini and GitLab are served from a cassette (mcp_core/services/cassette.py)
+with simulated latency, so the run needs no network or API keys. Everything
+else is the real worker code: JobQueue claims, process_tick, frame fan-out,
+routing, RAG, syntax validation + fix loop, atomic writes (or the MR call),
+pipeline spans.
+
+By default a synthetic cassette is generated (a few multi-frame files, with a
+broken component now and then so the fix path runs) and replayed in loose mode.
+Point --cassette at a directory recorded with CASSETTE_MODE=record to replay
+real traffic instead.
+
+Usage:
+    python scripts/bench_pipeline.py --events 2000 --workers 4
+    python scripts/bench_pipeline.py --events 200 --latency-scale 1      # recorded latencies
+    python scripts/bench_pipeline.py --latency-scale 0                   # pure worker overhead
+    python scripts/bench_pipeline.py --cassette ./cassettes --mr
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import automation_worker
+from mcp_core.context import ToolContext
+from mcp_core.services import job_queue
+from mcp_core.services.cassette import Cassette, install, request_key
+from mcp_core.services.job_queue import JobQueue
+from mcp_core.services.pipeline_spans import span_recorder
+from scripts.init_db import init_db
+from scripts.pipeline_report import STAGE_ORDER, percentile
+
+# Smallest valid PNG (1x1), enough for the image download / size accounting path
+TINY_PNG = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360000002000001e221bc330000000049454e44ae426082"
+)
+
+# Recorded latencies of the synthetic entries (ms); scaled by --latency-scale
+SYNTHETIC_LATENCY = {"figma_fetch": 450, "figma_image": 300, "generate": 6500, "fix": 3000, "merge_request": 1200}
+
+
+def synthetic_frame(file_index: int, frame_index: int) -> dict:
+    return {
+        "id": f"{file_index}:{frame_index}",
+        "name": f"Bench Card {file_index}-{frame_index}",
+        "type": "FRAME",
+        "absoluteBoundingBox": {"x": frame_index * 400, "y": 0, "width": 360, "height": 240},
+        "children": [
+            {"id": f"{file_index}:{frame_index}:1", "type": "TEXT", "name": "Title",
+             "characters": f"Quarterly revenue summary {file_index}-{frame_index}"},
+            {"id": f"{file_index}:{frame_index}:2", "type": "TEXT", "name": "Body",
+             "characters": "Compared with the previous period, totals grew steadily."},
+        ],
+    }
+
+
+def synthetic_component(index: int, broken: bool = False) -> str:
+    closing = "" if broken else "</div>\n"
+    return (
+        f"export default function BenchCard{index}() {{\n"
+        f"  return (\n"
+        f"    <div className=\"p-4 rounded-lg shadow\">\n"
+        f"      <h2 className=\"text-lg font-semibold\">Quarterly revenue summary</h2>\n"
+        f"      <p className=\"text-sm text-gray-600\">Compared with the previous period, totals grew steadily.</p>\n"
+        f"    {closing}"
+        f"  );\n"
+        f"}}\n"
+    )
+
+
+def write_synthetic_cassette(directory: Path, files: int = 4, frames_per_file: int = 3, components: int = 5):
+    """A small cassette that loose replay can serve any number of synthetic events from."""
+    cassette = Cassette(directory, mode="record")
+    for file_index in range(files):
+        request = {"file_key": f"benchFile{file_index}", "node_ids": [], "depth": 5}
+        document = {"id": "0:0", "type": "DOCUMENT", "name": "Document", "children": [
+            {"id": "0:1", "type": "CANVAS", "name": "Page 1",
+             "children": [synthetic_frame(file_index, i) for i in range(frames_per_file)]}
+        ]}
+        response = {"file_key": request["file_key"], "name": f"Bench File {file_index}", "last_modified": None,
+                    "nodes": [document], "tokens": {"colors": {}, "components": {}, "styles": {}}}
+        cassette.save("figma_fetch", request_key(request), request, response, SYNTHETIC_LATENCY["figma_fetch"])
+
+    cassette.save("figma_image", request_key("synthetic"), {}, "synthetic.png", SYNTHETIC_LATENCY["figma_image"], blob=TINY_PNG)
+    for index in range(components):
+        # Every fifth component misses its closing tag, so validation fails and the fix path runs
+        code = synthetic_component(index, broken=index % 5 == 4)
+        cassette.save("generate", request_key("generate", index), {}, {"code": code}, SYNTHETIC_LATENCY["generate"])
+    cassette.save("fix", request_key("fix"), {}, synthetic_component(0), SYNTHETIC_LATENCY["fix"])
+    cassette.save("merge_request", request_key("merge_request"), {}, "https://gitlab.example.com/bench/-/merge_requests/1",
+                  SYNTHETIC_LATENCY["merge_request"])
+
+
+class NullSearch:
+    """Stands in for RepoSearch (no Chroma index in the benchmark)."""
+
+    def search(self, query: str, limit: int = 10) -> list:
+        return []
+
+
+async def never_unchanged(*args, **kwargs) -> bool:
+    return False
+
+
+async def passthrough_format(code: str, filepath: str, project_root: str) -> str:
+    return code
+
+
+def count_unfinished(db_path: Path) -> int:
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM events WHERE status IN ('pending', 'processing')").fetchone()[0]
+    finally:
+        conn.close()
+
+
+async def run_worker(worker_index: int, db_path: Path, ctx: ToolContext, project_root: str, done: asyncio.Event):
+    """Worker main loop without the sleeping: tick until every event has been processed."""
+    queue = JobQueue(db_path, worker_id=f"bench-worker-{worker_index}")
+    try:
+        while not done.is_set():
+            await automation_worker.process_tick(ctx, queue, NullSearch(), project_root)
+            if await asyncio.to_thread(count_unfinished, db_path) == 0:
+                done.set()
+            else:
+                await asyncio.sleep(0.005)
+    finally:
+        await queue.close()
+
+
+async def bench(args, workdir: Path) -> float:
+    db_path = workdir / "events.db"
+    init_db(db_path)
+    project_root = workdir / "project"
+    project_root.mkdir()
+
+    automation_worker.DB_PATH = db_path
+    automation_worker.CLAIM_BATCH_SIZE = args.claim_batch
+    span_recorder.db_path = db_path
+    job_queue.DEBOUNCE_WINDOW = 0
+    if not args.allow_skip:
+        # Synthetic events repeat the same frames; without this every frame after the first is a fingerprint hit
+        automation_worker.frame_is_unchanged = never_unchanged
+    if not args.prettier:
+        automation_worker.format_code = passthrough_format
+    if args.mr:
+        automation_worker.DEMO_MODE = False
+
+    queue = JobQueue(db_path, worker_id="bench-producer")
+    for i in range(args.events):
+        await queue.enqueue({
+            "event_type": "FILE_UPDATE",
+            "file_key": f"benchFile{i % args.files}" if args.synthetic else args.file_key,
+            "file_name": f"Bench File {i}",
+            # Distinct (non-frame) node ids so events don't coalesce; the whole file is fetched
+            "node_id": f"bench-{i}",
+            "webhook_id": f"bench-{i}",
+            "timestamp": str(i),
+        })
+    await queue.close()
+
+    ctx = ToolContext(config=None, security=None, audit=None, search_config=None, approval_secret="bench-secret")
+    done = asyncio.Event()
+    start = time.perf_counter()
+    await asyncio.gather(*(run_worker(i, db_path, ctx, str(project_root), done) for i in range(args.workers)))
+    return time.perf_counter() - start
+
+
+def report(db_path: Path, elapsed: float, events: int, cassette: Cassette):
+    conn = sqlite3.connect(db_path)
+    statuses = dict(conn.execute("SELECT status, COUNT(*) FROM events GROUP BY status").fetchall())
+    rows = conn.execute("SELECT stage, duration_ms, outcome FROM pipeline_spans").fetchall()
+    conn.close()
+
+    durations = defaultdict(list)
+    not_ok = defaultdict(int)
+    for stage, duration_ms, outcome in rows:
+        durations[stage].append(duration_ms)
+        if outcome != "ok":
+            not_ok[stage] += 1
+
+    frames = len(durations.get("frame", []))
+    print(f"{events} events / {frames} frames in {elapsed:.1f}s -> "
+          f"{events / elapsed:.1f} events/s, {frames / elapsed:.1f} frames/s")
+    print(f"event status: {statuses}   cassette: {cassette.hits} exact, {cassette.misses} loose")
+    print(f"{'stage':<16}{'n':>7}{'p50 ms':>11}{'p95 ms':>11}{'p99 ms':>11}{'max ms':>11}{'not ok':>8}")
+    for stage in sorted(durations, key=lambda s: (STAGE_ORDER.index(s) if s in STAGE_ORDER else len(STAGE_ORDER), s)):
+        values = sorted(durations[stage])
+        print(f"{stage:<16}{len(values):>7}{percentile(values, 50):>11.1f}{percentile(values, 95):>11.1f}"
+              f"{percentile(values, 99):>11.1f}{values[-1]:>11.1f}{not_ok[stage]:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay synthetic events through the worker pipeline offline")
+    parser.add_argument("--events", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=1, help="Concurrent worker loops sharing the queue")
+    parser.add_argument("--claim-batch", type=int, default=automation_worker.CLAIM_BATCH_SIZE)
+    parser.add_argument("--files", type=int, default=4, help="Synthetic files (each with --frames frames)")
+    parser.add_argument("--frames", type=int, default=3)
+    parser.add_argument("--cassette", type=Path, default=None,
+                        help="Replay this recorded cassette instead of a synthetic one (strict unless --loose)")
+    parser.add_argument("--file-key", default=os.getenv("FIGMA_FILE_KEY"), help="File key the recorded cassette was made with")
+    parser.add_argument("--loose", action="store_true", help="Serve cassette misses from other recordings")
+    parser.add_argument("--latency-scale", type=float, default=0.01, help="Multiplier on recorded latency (default 0.01)")
+    parser.add_argument("--latency-ms", type=float, default=None, help="Fixed simulated latency per external call")
+    parser.add_argument("--prettier", action="store_true", help="Format through the real Prettier daemon")
+    parser.add_argument("--mr", action="store_true", help="Exercise the merge-request path instead of local writes")
+    parser.add_argument("--allow-skip", action="store_true", help="Keep fingerprint skipping of repeated frames")
+    args = parser.parse_args()
+    args.synthetic = args.cassette is None
+    if not args.synthetic and not args.file_key:
+        parser.error("--file-key (or FIGMA_FILE_KEY) is required with --cassette")
+
+    # Per-frame INFO logs would dominate the run time
+    logging.getLogger().setLevel(logging.ERROR)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        cassette_dir = args.cassette
+        if args.synthetic:
+            cassette_dir = workdir / "cassette"
+            write_synthetic_cassette(cassette_dir, files=args.files, frames_per_file=args.frames)
+        cassette = Cassette(cassette_dir, mode="replay", latency_scale=args.latency_scale,
+                            latency_ms=args.latency_ms, loose=args.loose or args.synthetic)
+        uninstall = install(cassette)
+        try:
+            elapsed = asyncio.run(bench(args, workdir))
+        finally:
+            uninstall()
+        report(workdir / "events.db", elapsed, args.events, cassette)
+
+
+if __name__ == "__main__":
+    main()
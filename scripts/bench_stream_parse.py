@@ -0,0 +1,106 @@
+"""
+Peak memory of a whole-file sync: resp.json() + extract_top_level_frames vs the
+streaming FrameSpool parse (mcp_core/services/figma_stream.py).
+
+A synthetic /v1/files document of roughly --mb megabytes is served in 64 KB
+chunks through httpx.MockTransport. Python allocations are traced with
+tracemalloc while the frames are extracted and then read back one by one, as
+the worker does.
+
+Usage:
+    python scripts/bench_stream_parse.py --mb 50
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from mcp_core.services.figma_client import FigmaClient
+from mcp_core.services.figma_stream import FrameSpool, ijson_available, spool_file_response
+
+CHUNK = 64 * 1024
+
+
+def synthetic_document(target_mb: float) -> bytes:
+    def frame(i: int) -> dict:
+        return {"id": f"1:{i}", "name": f"Frame {i}", "type": "FRAME",
+                "absoluteBoundingBox": {"x": i * 400.0, "y": 0.0, "width": 360.0, "height": 240.0},
+                "children": [{"id": f"1:{i}:{j}", "type": "TEXT", "name": f"Text {j}",
+                              "characters": f"Row {j} of frame {i}, quarterly revenue summary",
+                              "style": {"fontFamily": "Inter", "fontSize": 14.0, "lineHeightPx": 20.0}}
+                             for j in range(40)]}
+
+    frame_size = len(json.dumps(frame(0)))
+    count = max(1, int(target_mb * 1024 * 1024 / frame_size))
+    document = {"document": {"id": "0:0", "type": "DOCUMENT", "children": [
+        {"id": "0:1", "type": "CANVAS", "name": "Page 1", "children": [frame(i) for i in range(count)]}
+    ]}, "name": "Bench File", "version": "1", "lastModified": "2024-01-01T00:00:00Z"}
+    return json.dumps(document).encode()
+
+
+def transport(body: bytes) -> httpx.MockTransport:
+    async def chunks():
+        for i in range(0, len(body), CHUNK):
+            yield body[i:i + CHUNK]
+
+    return httpx.MockTransport(lambda request: httpx.Response(200, content=chunks()))
+
+
+def walk(frame: dict) -> int:
+    return 1 + sum(walk(child) for child in frame.get("children", []))
+
+
+async def run_json(client: FigmaClient) -> int:
+    """Old path: whole body, whole tree, then the frame list."""
+    resp = await client.get("/v1/files/bench?depth=5")
+    data = resp.json()
+    frames = [child for page in data["document"]["children"] for child in page["children"] if child["type"] == "FRAME"]
+    return sum(walk(frame) for frame in frames)
+
+
+async def run_stream(client: FigmaClient, stream: bool) -> int:
+    spool = FrameSpool()
+    async with client.stream("/v1/files/bench?depth=5") as resp:
+        await spool_file_response(resp, spool, stream=stream)
+    try:
+        return sum(walk(spool[i]) for i in range(len(spool)))
+    finally:
+        spool.close()
+
+
+async def measure(label: str, body: bytes, runner):
+    client = FigmaClient(base_url="http://figma.bench", token="bench", transport=transport(body))
+    tracemalloc.start()
+    start = time.perf_counter()
+    nodes = await runner(client)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    await client.aclose()
+    print(f"  {label:<22} peak={peak / 1024 / 1024:8.1f} MB  time={elapsed:6.2f}s  nodes={nodes}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Compare peak memory of whole-file parsing strategies")
+    parser.add_argument("--mb", type=float, default=50, help="Approximate document size")
+    args = parser.parse_args()
+
+    body = synthetic_document(args.mb)
+    print(f"document: {len(body) / 1024 / 1024:.1f} MB")
+    await measure("resp.json()", body, run_json)
+    await measure("spool (parse, no ijson)", body, lambda client: run_stream(client, stream=False))
+    if ijson_available():
+        await measure("spool (ijson stream)", body, lambda client: run_stream(client, stream=True))
+    else:
+        print("  ijson not installed: streaming parse skipped")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,120 @@
+"""
+Load benchmark for webhook ingest.
+
+Pushes a burst of FILE_UPDATE webhooks through the real FastAPI app (in-process,
+via httpx's ASGI transport) against a throwaway events.db and reports
+requests/sec for:
+  - legacy: one aiosqlite connection + commit + last_insert_rowid() per request
+  - writer: the shared group-committing EventWriter
+
+Usage:
+    python scripts/bench_webhook_ingest.py --requests 2000 --concurrency 64
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+import aiosqlite
+import httpx
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import webhook_server
+from scripts.init_db import init_db
+
+
+def make_legacy_save_event(db_path: Path):
+    """The pre-writer save_event: connect, insert, commit, then ask for the rowid."""
+    async def legacy_save_event(event):
+        async with aiosqlite.connect(db_path) as db:
+            try:
+                row = webhook_server.build_event_row(event)
+                await db.execute("""
+                    INSERT INTO events (event_id, event_type, file_key, file_name, node_id, timestamp, payload)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, row[:7])
+                await db.commit()
+                cursor = await db.execute("SELECT last_insert_rowid()")
+                return (await cursor.fetchone())[0]
+            except aiosqlite.IntegrityError:
+                return -1
+    return legacy_save_event
+
+
+async def run_load(total: int, concurrency: int) -> float:
+    """Fire `total` webhooks with bounded concurrency; returns elapsed seconds."""
+    transport = httpx.ASGITransport(app=webhook_server.app)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def post_one(i: int):
+            payload = {
+                "event_type": "FILE_UPDATE",
+                "file_key": "benchFileKey",
+                "file_name": "Bench File",
+                "node_id": f"1:{i}",
+                "webhook_id": str(uuid.uuid4()),
+                "timestamp": str(time.time()),
+            }
+            async with semaphore:
+                resp = await client.post("/figma-webhook", content=json.dumps(payload))
+                body = resp.json()
+                if body.get("status") != "success":
+                    raise RuntimeError(f"Unexpected response: {body}")
+
+        start = time.perf_counter()
+        await asyncio.gather(*(post_one(i) for i in range(total)))
+        return time.perf_counter() - start
+
+
+async def bench(mode: str, total: int, concurrency: int, workdir: Path) -> float:
+    db_path = workdir / f"events_{mode}.db"
+    init_db(db_path)
+
+    original_save_event = webhook_server.save_event
+    original_writer = webhook_server.event_writer
+    if mode == "legacy":
+        webhook_server.save_event = make_legacy_save_event(db_path)
+    else:
+        webhook_server.event_writer = webhook_server.EventWriter(db_path)
+
+    try:
+        elapsed = await run_load(total, concurrency)
+    finally:
+        await webhook_server.event_writer.close()
+        webhook_server.save_event = original_save_event
+        webhook_server.event_writer = original_writer
+
+    return total / elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark webhook ingest throughput")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    args = parser.parse_args()
+
+    # Keep the benchmark about I/O, not log formatting or file-key filtering
+    logging.getLogger("figma-webhook").setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    os.environ.pop("FIGMA_FILE_KEY", None)
+
+    print(f"Benchmarking {args.requests} webhooks @ concurrency {args.concurrency}")
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        legacy_rps = await bench("legacy", args.requests, args.concurrency, workdir)
+        print(f"  legacy (connect per request): {legacy_rps:8.1f} req/s")
+        writer_rps = await bench("writer", args.requests, args.concurrency, workdir)
+        print(f"  writer (group commit):        {writer_rps:8.1f} req/s")
+    print(f"  speedup: {writer_rps / legacy_rps:.2f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
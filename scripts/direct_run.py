@@ -24,12 +24,14 @@ async def direct_generate():
         return
 
     ctx = ToolContext(config=None, security=None, audit=None, search_config=None, approval_secret="secret")
-    coder = LLMCoder()
+    coder = LLMCoder(rate_limiter=ctx.rate_limiter)
     
     # 1. Fetch Figma Data
     print(f"📡 Fetching Node {node_id} from File {file_key}...")
     try:
-        data = await figma.fetch_figma_pattern(ctx, {"file_key": file_key, "node_ids": [node_id], "depth": 5})
+        # Latest version first (cheap, ETag-cached): an unchanged file is served from the node cache
+        meta = await figma.get_file_meta(ctx, file_key)
+        data = await figma.fetch_figma_pattern(ctx, {"file_key": file_key, "node_ids": [node_id], "depth": 5, "version": meta.get("version")})
         if not data.get("nodes"):
             print("❌ No nodes found. Check permissions or Node ID.")
             return
@@ -39,6 +39,11 @@ def inject_event():
         c.execute("""
             INSERT INTO events (event_id, event_type, file_key, file_name, node_id, timestamp, status, payload)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(file_key, IFNULL(node_id, '')) WHERE status = 'pending' DO UPDATE SET
+                event_id = excluded.event_id,
+                timestamp = excluded.timestamp,
+                payload = excluded.payload,
+                revision = events.revision + 1
         """, (
             event_id,
             "FILE_UPDATE",
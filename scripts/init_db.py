@@ -7,9 +7,9 @@ from pathlib import Path
 
 DB_PATH = Path(__file__).parent.parent / "events.db"
 
-def init_db():
+def init_db(db_path: Path = DB_PATH):
     """Initialize the events database with required tables."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
     
     cursor.execute("""
@@ -23,6 +23,16 @@ def init_db():
             timestamp TEXT NOT NULL,
             status TEXT DEFAULT 'pending',
             payload TEXT NOT NULL,
+            revision INTEGER NOT NULL DEFAULT 1,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            started_at TEXT,
+            completed_at TEXT,
+            pr_url TEXT,
+            error_log TEXT,
+            leased_by TEXT,
+            lease_expires_at REAL,
+            due_at REAL NOT NULL DEFAULT 0,
+            lane TEXT NOT NULL DEFAULT 'webhook',
             created_at DATETIME DEFAULT CURRENT_TIMESTAMP
         )
     """)
@@ -36,18 +46,78 @@ def init_db():
         )
     """)
     
+    # Last successful generation per frame: unchanged frames are skipped by the worker
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS frame_fingerprints (
+            file_key TEXT NOT NULL,
+            node_id TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            output_path TEXT,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (file_key, node_id)
+        )
+    """)
+
+    # Every accepted webhook delivery id; a late retry of a coalesced delivery is dropped
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS webhook_deliveries (
+            event_id TEXT PRIMARY KEY,
+            received_at REAL NOT NULL
+        )
+    """)
+    
+    # Per-stage timings written by the worker (see scripts/pipeline_report.py)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS pipeline_spans (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event_id INTEGER,
+            frame_id TEXT,
+            stage TEXT NOT NULL,
+            started_at REAL NOT NULL,
+            duration_ms REAL NOT NULL,
+            bytes_in INTEGER,
+            bytes_out INTEGER,
+            prompt_chars INTEGER,
+            outcome TEXT,
+            detail TEXT
+        )
+    """)
+    
     # Create index for faster queries
     cursor.execute("""
         CREATE INDEX IF NOT EXISTS idx_status 
         ON events(status, created_at DESC)
     """)
     
+    # Claims pick the earliest due pending events; the worker sleeps until MIN(due_at)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_events_due
+        ON events(status, due_at)
+    """)
+    
+    # Reaper scans for expired leases
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_events_lease
+        ON events(status, lease_expires_at)
+    """)
+    
+    # At most one pending row per (file, node): newer webhooks coalesce into it
+    cursor.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_events_pending_node
+        ON events(file_key, IFNULL(node_id, '')) WHERE status = 'pending'
+    """)
+    
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_spans_stage_time
+        ON pipeline_spans(stage, started_at)
+    """)
+    
     # Enable Write-Ahead Logging for concurrency (Production Hardening)
     cursor.execute("PRAGMA journal_mode=WAL;")
     
     conn.commit()
     conn.close()
-    print(f"[OK] Database initialized with WAL mode at {DB_PATH}")
+    print(f"[OK] Database initialized with WAL mode at {db_path}")
 
 if __name__ == "__main__":
     init_db()
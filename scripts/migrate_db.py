@@ -46,13 +46,89 @@ def migrate():
         "completed_at": "TEXT",
         "pr_url": "TEXT",
         "error_log": "TEXT",
-        "node_id": "TEXT"
+        "node_id": "TEXT",
+        "revision": "INTEGER NOT NULL DEFAULT 1",
+        "leased_by": "TEXT",
+        "lease_expires_at": "REAL",
+        "due_at": "REAL NOT NULL DEFAULT 0",
+        "attempts": "INTEGER NOT NULL DEFAULT 0",
+        "lane": "TEXT NOT NULL DEFAULT 'webhook'"
     }
     
     for col, dtype in missing_cols.items():
         if col not in columns:
             print(f"Adding column '{col}'...")
             cursor.execute(f"ALTER TABLE events ADD COLUMN {col} {dtype}")
+
+    if "lane" not in columns:
+        # Backfill scheduling lanes for rows that predate them
+        cursor.execute("UPDATE events SET lane = 'targeted' WHERE event_type = 'TARGETED_SYNC'")
+        cursor.execute("UPDATE events SET lane = 'poll' WHERE event_id LIKE 'poll\\_%' ESCAPE '\\'")
+    
+    # 3. Coalesce duplicate pending rows (keep the newest per file/node), then
+    #    enforce one pending row per (file_key, node_id) going forward
+    cursor.execute("""
+        UPDATE events SET status = 'superseded'
+        WHERE status = 'pending' AND id NOT IN (
+            SELECT MAX(id) FROM events WHERE status = 'pending'
+            GROUP BY file_key, IFNULL(node_id, '')
+        )
+    """)
+    if cursor.rowcount:
+        print(f"Marked {cursor.rowcount} superseded pending events")
+    cursor.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_events_pending_node
+        ON events(file_key, IFNULL(node_id, '')) WHERE status = 'pending'
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_events_due
+        ON events(status, due_at)
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_events_lease
+        ON events(status, lease_expires_at)
+    """)
+
+    # 4. Frame fingerprints (skip regeneration of unchanged frames)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS frame_fingerprints (
+            file_key TEXT NOT NULL,
+            node_id TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            output_path TEXT,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (file_key, node_id)
+        )
+    """)
+
+    # 5. Pipeline timing spans
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS pipeline_spans (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event_id INTEGER,
+            frame_id TEXT,
+            stage TEXT NOT NULL,
+            started_at REAL NOT NULL,
+            duration_ms REAL NOT NULL,
+            bytes_in INTEGER,
+            bytes_out INTEGER,
+            prompt_chars INTEGER,
+            outcome TEXT,
+            detail TEXT
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_spans_stage_time
+        ON pipeline_spans(stage, started_at)
+    """)
+
+    # 6. Webhook delivery ids (dedupe of retries that were coalesced away)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS webhook_deliveries (
+            event_id TEXT PRIMARY KEY,
+            received_at REAL NOT NULL
+        )
+    """)
             
     conn.commit()
     conn.close()
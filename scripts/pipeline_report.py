@@ -0,0 +1,130 @@
+"""
+Per-stage latency report from the pipeline_spans table.
+
+Prints p50/p95/p99 (ms) for every pipeline stage recorded by the worker in a
+time range, plus how often each stage did not end with outcome 'ok'.
+
+Usage:
+    python scripts/pipeline_report.py                 # last 24 hours
+    python scripts/pipeline_report.py --since 2h
+    python scripts/pipeline_report.py --since 2024-05-01 --until 2024-05-02
+    python scripts/pipeline_report.py --stage generate --stage validate
+"""
+import argparse
+import math
+import sqlite3
+import time
+from collections import defaultdict
+from datetime import datetime
+from pathlib import Path
+
+DB_PATH = Path(__file__).parent.parent / "events.db"
+
+# Stages in pipeline order; anything else is listed after these
+STAGE_ORDER = [
+    "pipeline", "figma_fetch", "frame", "fingerprint", "route", "image_download", "image_prep",
+    "project_context", "rag", "generate", "validate", "fix", "prettier", "write", "merge_request"
+]
+
+UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+# Generate latency is also broken down by the size of the image sent with the prompt
+IMAGE_BANDS = [(0, "no image"), (1, "< 256 KB"), (256 * 1024, "256 KB - 1 MB"), (1024 * 1024, ">= 1 MB")]
+
+
+def parse_time(value: str) -> float:
+    """Accepts a relative age ('30m', '2h', '7d') or an ISO date/datetime; returns epoch seconds."""
+    if value[-1:] in UNITS and value[:-1].replace(".", "", 1).isdigit():
+        return time.time() - float(value[:-1]) * UNITS[value[-1]]
+    return datetime.fromisoformat(value).timestamp()
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    index = max(0, math.ceil(pct / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def image_band(size) -> str:
+    size = size or 0
+    return [label for floor, label in IMAGE_BANDS if size >= floor][-1]
+
+
+def print_image_report(rows: list):
+    """Vision image sizes before/after image_prep, and generate latency per image size band."""
+    prep = [(bytes_in, out) for stage, _, _, out, _, bytes_in in rows if stage == "image_prep" and bytes_in and out]
+    if prep:
+        before, after = sum(b for b, _ in prep), sum(a for _, a in prep)
+        print(f"\nVision images: {len(prep)} prepared, avg {before / len(prep) / 1024:.0f} KB -> "
+              f"{after / len(prep) / 1024:.0f} KB ({100 * (1 - after / before):.0f}% smaller)")
+
+    bands = defaultdict(list)
+    for stage, duration_ms, _, _, _, bytes_in in rows:
+        if stage == "generate":
+            bands[image_band(bytes_in)].append(duration_ms)
+    if len(bands) > 1 or prep:
+        print(f"{'generate, image sent':<22}{'n':>6}{'p50 ms':>11}{'p95 ms':>11}")
+        for _, label in IMAGE_BANDS:
+            if bands[label]:
+                values = sorted(bands[label])
+                print(f"{label:<22}{len(values):>6}{percentile(values, 50):>11.1f}{percentile(values, 95):>11.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-stage pipeline latency percentiles")
+    parser.add_argument("--db", type=Path, default=DB_PATH)
+    parser.add_argument("--since", default="24h", help="Start of range: age like 30m/2h/7d or ISO date (default: 24h)")
+    parser.add_argument("--until", default=None, help="End of range (same formats, default: now)")
+    parser.add_argument("--stage", action="append", help="Only report these stages (repeatable)")
+    args = parser.parse_args()
+
+    since = parse_time(args.since)
+    until = parse_time(args.until) if args.until else time.time()
+
+    conn = sqlite3.connect(args.db)
+    rows = conn.execute("""
+        SELECT stage, duration_ms, outcome, bytes_out, prompt_chars, bytes_in
+        FROM pipeline_spans
+        WHERE started_at >= ? AND started_at < ?
+    """, (since, until)).fetchall()
+    event_count = conn.execute(
+        "SELECT COUNT(DISTINCT event_id) FROM pipeline_spans WHERE started_at >= ? AND started_at < ?",
+        (since, until)
+    ).fetchone()[0]
+    conn.close()
+
+    durations = defaultdict(list)
+    not_ok = defaultdict(int)
+    bytes_out = defaultdict(list)
+    prompt_chars = defaultdict(list)
+    for stage, duration_ms, outcome, out_bytes, chars, _ in rows:
+        if args.stage and stage not in args.stage:
+            continue
+        durations[stage].append(duration_ms)
+        if outcome != "ok":
+            not_ok[stage] += 1
+        if out_bytes is not None:
+            bytes_out[stage].append(out_bytes)
+        if chars is not None:
+            prompt_chars[stage].append(chars)
+
+    print(f"Pipeline spans {datetime.fromtimestamp(since):%Y-%m-%d %H:%M} -> {datetime.fromtimestamp(until):%Y-%m-%d %H:%M} "
+          f"({len(rows)} spans, {event_count} events)")
+    if not durations:
+        print("No spans recorded in this range.")
+        return
+
+    stages = sorted(durations, key=lambda s: (STAGE_ORDER.index(s) if s in STAGE_ORDER else len(STAGE_ORDER), s))
+    print(f"{'stage':<16}{'n':>6}{'p50 ms':>11}{'p95 ms':>11}{'p99 ms':>11}{'max ms':>11}{'not ok':>8}{'avg out':>10}{'avg prompt':>12}")
+    for stage in stages:
+        values = sorted(durations[stage])
+        avg_out = f"{sum(bytes_out[stage]) / len(bytes_out[stage]):.0f}" if bytes_out[stage] else "-"
+        avg_prompt = f"{sum(prompt_chars[stage]) / len(prompt_chars[stage]):.0f}" if prompt_chars[stage] else "-"
+        print(f"{stage:<16}{len(values):>6}{percentile(values, 50):>11.1f}{percentile(values, 95):>11.1f}"
+              f"{percentile(values, 99):>11.1f}{values[-1]:>11.1f}{not_ok[stage]:>8}{avg_out:>10}{avg_prompt:>12}")
+    if not args.stage:
+        print_image_report(rows)
+
+
+if __name__ == "__main__":
+    main()
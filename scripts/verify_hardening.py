@@ -4,7 +4,7 @@ import json
 import logging
 import sys
 from pathlib import Path
-from unittest.mock import MagicMock, AsyncMock, patch
+from unittest.mock import MagicMock, patch
 
 # Ensure mcp_core is importable
 sys.path.append(str(Path(__file__).parent.parent))
@@ -40,37 +40,25 @@ async def test_figma_404_handling():
     from mcp_core.tools import figma
     from mcp_core.context import ToolContext
     
+    import httpx
+    from mcp_core.services.figma_client import FigmaClient
+    
+    # Stub Figma API that answers every request with a 404
+    transport = httpx.MockTransport(lambda request: httpx.Response(404, text="Not Found"))
     ctx = MagicMock(spec=ToolContext)
+    ctx.figma = FigmaClient(transport=transport)
     
-    # Mock httpx to raise HTTPStatusError(404)
-    with patch("httpx.AsyncClient") as mock_client, \
-         patch("os.getenv", return_value="dummy_token"):
-        
-        mock_get = AsyncMock()
-        mock_client.return_value.__aenter__.return_value.get = mock_get
-        
-        # Create a mock 404 response
-        mock_resp = MagicMock()
-        mock_resp.status_code = 404
-        mock_resp.text = "Not Found"
-        
-        # To trigger clean exception handling, we need raise_for_status to raise
-        import httpx
-        def raise_404():
-            raise httpx.HTTPStatusError("404 Not Found", request=None, response=mock_resp)
-        
-        mock_resp.raise_for_status.side_effect = raise_404
-        mock_get.return_value = mock_resp
-        
+    with patch.dict("os.environ", {"FIGMA_ACCESS_TOKEN": "dummy_token"}):
         # Run tool
         result = await figma.fetch_figma_pattern(ctx, {"file_key": "INVALID_KEY"})
-        
-        if result["success"] is False and result["status_code"] == 404:
-            print("404 Handling Successful!")
-            print(result)
-        else:
-            print("404 Handling Failed.")
-            print(result)
+    await ctx.figma.aclose()
+    
+    if result["success"] is False and result["status_code"] == 404:
+        print("404 Handling Successful!")
+        print(result)
+    else:
+        print("404 Handling Failed.")
+        print(result)
 
 if __name__ == "__main__":
     asyncio.run(test_truncation())
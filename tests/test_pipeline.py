@@ -37,6 +37,11 @@ def inject_test_event():
                 event_id, event_type, file_key, file_name, 
                 timestamp, payload, status
             ) VALUES (?, ?, ?, ?, ?, ?, 'pending')
+            ON CONFLICT(file_key, IFNULL(node_id, '')) WHERE status = 'pending' DO UPDATE SET
+                event_id = excluded.event_id,
+                timestamp = excluded.timestamp,
+                payload = excluded.payload,
+                revision = events.revision + 1
         """, (
             payload['webhook_id'], 
             payload['event_type'], 
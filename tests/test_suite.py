@@ -11,6 +11,9 @@ import asyncio
 import json
 import logging
 import os
+import shutil
+import socket
+import time
 import hmac
 import hashlib
 from pathlib import Path
@@ -50,7 +53,10 @@ except ImportError:
     
     sys.modules["aiosqlite"] = mock_aiosqlite
 
-from webhook_server import app
+from webhook_server import app, EventWriter, EventBroadcaster
+from scripts.init_db import init_db
+from mcp_core.services import job_queue
+from mcp_core.services.job_queue import JobQueue
 
 
 # --- Part 1: Security & Core Infrastructure ---
@@ -260,40 +266,1298 @@ class TestWebhookEndpoint:
                 assert response.json()["status"] == "success"
 
 
-# --- Part 4: Figma API Tests ---
+class TestEventWriter:
+    """Test the group-committing webhook event writer."""
+
+    @pytest.fixture
+    def db_path(self, tmp_path):
+        path = tmp_path / "events.db"
+        init_db(path)
+        return path
+
+    @pytest.mark.asyncio
+    async def test_concurrent_submits_get_row_ids(self, db_path):
+        writer = EventWriter(db_path, batch_max=8, batch_window_ms=20)
+        events = [
+            {"webhook_id": f"wh_{i}", "timestamp": "t", "file_key": "abc", "node_id": f"1:{i}", "event_type": "FILE_UPDATE"}
+            for i in range(20)
+        ]
+        ids = await asyncio.gather(*(writer.submit(e) for e in events))
+        await writer.close()
+
+        assert sorted(ids) == list(range(1, 21))
+
+    @pytest.mark.asyncio
+    async def test_duplicate_returns_minus_one(self, db_path):
+        writer = EventWriter(db_path)
+        event = {"webhook_id": "wh_dup", "timestamp": "t", "file_key": "abc"}
+        first = await writer.submit(event)
+        second = await writer.submit(event)
+        await writer.close()
+
+        assert first > 0
+        assert second == -1
+
+    @pytest.mark.asyncio
+    async def test_pending_updates_coalesce(self, db_path):
+        writer = EventWriter(db_path)
+        ids = [
+            await writer.submit({"webhook_id": f"wh_{i}", "timestamp": "t", "file_key": "abc", "node_id": "1:2", "rev": i})
+            for i in range(5)
+        ]
+        await writer.close()
+
+        assert len(set(ids)) == 1
+        async with aiosqlite.connect(db_path) as db:
+            cursor = await db.execute("SELECT COUNT(*), MAX(revision), MAX(payload) FROM events WHERE status = 'pending'")
+            count, revision, payload = await cursor.fetchone()
+        assert count == 1
+        assert revision == 5
+        assert json.loads(payload)["rev"] == 4
+
+    @pytest.mark.asyncio
+    async def test_late_retry_of_coalesced_delivery_is_dropped(self, db_path):
+        """A Figma retry of an older delivery must not overwrite the newer payload it was coalesced into."""
+        writer = EventWriter(db_path)
+        older = {"webhook_id": "wh", "timestamp": "2024-01-01T10:00:00Z", "file_key": "abc", "node_id": "1:2", "rev": 1}
+        newer = {"webhook_id": "wh", "timestamp": "2024-01-01T10:00:05Z", "file_key": "abc", "node_id": "1:2", "rev": 2}
+        first = await writer.submit(older)
+        assert await writer.submit(newer) == first
+        async with aiosqlite.connect(db_path) as db:
+            cursor = await db.execute("SELECT due_at FROM events")
+            (due_at,) = await cursor.fetchone()
+        retried = await writer.submit(older)
+        await writer.close()
+
+        assert retried == -1
+        async with aiosqlite.connect(db_path) as db:
+            cursor = await db.execute("SELECT COUNT(*), revision, timestamp, payload, due_at FROM events")
+            count, revision, timestamp, payload, due_after = await cursor.fetchone()
+        assert count == 1 and revision == 2
+        assert timestamp == newer["timestamp"] and json.loads(payload)["rev"] == 2
+        assert due_after == due_at
+
+    @pytest.mark.asyncio
+    async def test_commit_notifies_stream_subscribers(self, db_path):
+        broadcaster = EventBroadcaster()
+        queue = broadcaster.subscribe()
+        writer = EventWriter(db_path, on_commit=broadcaster.publish)
+        event = {"webhook_id": "wh_1", "timestamp": "t", "file_key": "abc", "node_id": "1:2"}
+        event_id = await writer.submit(event)
+        await writer.submit(event)  # duplicate: no notice
+        await writer.close()
+
+        notice = queue.get_nowait()
+        assert notice["id"] == event_id
+        assert notice["node_id"] == "1:2"
+        assert queue.empty()
+
+
+class TestJobQueue:
+    """Test lease-based claiming over the events table."""
+
+    @pytest.fixture
+    def db_path(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(job_queue, "DEBOUNCE_WINDOW", 0)
+        path = tmp_path / "events.db"
+        init_db(path)
+        return path
+
+    @pytest.mark.asyncio
+    async def test_workers_never_claim_the_same_event(self, db_path):
+        producer = JobQueue(db_path)
+        for i in range(10):
+            await producer.enqueue({"webhook_id": f"wh_{i}", "timestamp": "t", "file_key": "abc", "node_id": f"1:{i}"})
+
+        workers = [JobQueue(db_path, worker_id=f"w{n}") for n in range(3)]
+        claims = await asyncio.gather(*(w.claim_batch(4) for w in workers))
+        claimed_ids = [job["id"] for batch in claims for job in batch]
+        for q in [producer, *workers]:
+            await q.close()
+
+        assert len(claimed_ids) == 10
+        assert len(set(claimed_ids)) == 10
+
+    @pytest.mark.asyncio
+    async def test_expired_lease_is_requeued(self, db_path):
+        crashed = JobQueue(db_path, worker_id="crashed", lease_seconds=-1)
+        await crashed.enqueue({"webhook_id": "wh", "timestamp": "t", "file_key": "abc", "node_id": "1:2"})
+        [job] = await crashed.claim_batch(1)
+
+        survivor = JobQueue(db_path, worker_id="survivor")
+        assert await survivor.reap_expired() == 1
+        [reclaimed] = await survivor.claim_batch(1)
+
+        assert reclaimed["id"] == job["id"]
+        assert await crashed.complete(job["id"]) is False
+        assert await survivor.complete(job["id"]) is True
+        await crashed.close()
+        await survivor.close()
+
+    @pytest.mark.asyncio
+    async def test_targeted_sync_jumps_ahead_and_files_take_turns(self, db_path, monkeypatch):
+        monkeypatch.setattr(job_queue, "TARGETED_DEBOUNCE_WINDOW", 0)
+        queue = JobQueue(db_path)
+        try:
+            # A noisy file with 30 changed frames, a quiet one, a poll and finally a !sync
+            for i in range(30):
+                await queue.enqueue({"webhook_id": f"noisy_{i}", "timestamp": "t", "file_key": "noisy", "node_id": f"1:{i}"})
+            await queue.enqueue({"webhook_id": "quiet", "timestamp": "t", "file_key": "quiet", "node_id": "2:1"})
+            await queue.enqueue({"webhook_id": "poll", "source": "poll", "timestamp": "t", "file_key": "polled", "node_id": "0:1"})
+            await queue.enqueue({"webhook_id": "c1", "event_type": "TARGETED_SYNC", "timestamp": "t", "file_key": "noisy", "node_id": "9:9"})
+
+            depths = await queue.lane_depths()
+            assert {lane: d["due"] for lane, d in depths.items()} == {"targeted": 1, "webhook": 31, "poll": 1}
+
+            first = await queue.claim_batch(3)
+            assert [job["lane"] for job in first] == ["targeted", "webhook", "webhook"]
+            assert {job["file_key"] for job in first[1:]} == {"noisy", "quiet"}
+
+            # The poll lane is behind, but not starved by the 29 noisy frames still due
+            second = await queue.claim_batch(4)
+            assert [job["lane"] for job in second] == ["webhook", "webhook", "webhook", "poll"]
+            assert len(await queue.claim_batch(40)) == 26
+        finally:
+            await queue.close()
+
+    @pytest.mark.asyncio
+    async def test_coalesced_event_keeps_highest_priority_lane(self, db_path):
+        queue = JobQueue(db_path)
+        try:
+            await queue.enqueue({"webhook_id": "c1", "event_type": "TARGETED_SYNC", "timestamp": "t", "file_key": "abc",
+                                 "node_id": "1:2", "comment_id": "c1"})
+            await queue.enqueue({"webhook_id": "wh", "timestamp": "t", "file_key": "abc", "node_id": "1:2"})
+            depths = await queue.lane_depths()
+            [job] = await queue.claim_batch(1)
+        finally:
+            await queue.close()
+
+        assert depths["targeted"]["pending"] == 1
+        assert depths["webhook"]["pending"] == 0
+        # The bulk update does not erase what made it a !sync
+        assert job["event_type"] == "TARGETED_SYNC"
+        assert job["payload"]["comment_id"] == "c1"
+
+    @pytest.mark.asyncio
+    async def test_stuck_event_is_retried_then_dead_lettered(self, db_path):
+        # Lease still valid, but processing started longer ago than the timeout (hung worker)
+        queue = JobQueue(db_path, worker_id="hung", max_attempts=2, processing_timeout=-1)
+        await queue.enqueue({"webhook_id": "wh", "timestamp": "t", "file_key": "abc", "node_id": "1:2"})
+        try:
+            [first] = await queue.claim_batch(1)
+            assert first["attempts"] == 1
+            assert await queue.reap_expired() == 1
+
+            [second] = await queue.claim_batch(1)
+            assert second["id"] == first["id"] and second["attempts"] == 2
+            assert await queue.reap_expired() == 0
+            assert await queue.claim_batch(1) == []
+        finally:
+            await queue.close()
+
+        async with aiosqlite.connect(db_path) as db:
+            cursor = await db.execute("SELECT status, error_log FROM events WHERE id = ?", (first["id"],))
+            status, error_log = await cursor.fetchone()
+        assert status == "dead_letter"
+        assert "2 attempts" in error_log
+
+    @pytest.mark.asyncio
+    async def test_failed_event_is_retried_with_backoff_then_dead_lettered(self, db_path):
+        queue = JobQueue(db_path, worker_id="w", max_attempts=2, retry_backoff=60)
+        await queue.enqueue({"webhook_id": "wh", "timestamp": "t", "file_key": "abc", "node_id": "1:2"})
+        try:
+            [first] = await queue.claim_batch(1)
+            assert await queue.fail(first["id"], "HTTPStatusError: 503") == "pending"
+            # Backing off: not claimable yet
+            assert await queue.claim_batch(1) == []
+            assert await queue.next_due_at() > time.time() + 55
+
+            async with aiosqlite.connect(db_path) as db:
+                await db.execute("UPDATE events SET due_at = 0")
+                await db.commit()
+            [second] = await queue.claim_batch(1)
+            assert second["id"] == first["id"] and second["attempts"] == 2
+            assert await queue.fail(second["id"], "HTTPStatusError: 503") == "dead_letter"
+            assert await queue.fail(second["id"], "again") is None
+        finally:
+            await queue.close()
+
+        async with aiosqlite.connect(db_path) as db:
+            cursor = await db.execute("SELECT status, error_log FROM events WHERE id = ?", (first["id"],))
+            assert await cursor.fetchone() == ("dead_letter", "HTTPStatusError: 503")
+
+    @pytest.mark.asyncio
+    async def test_pipeline_exception_requeues_event(self, db_path, monkeypatch):
+        """A Figma/Gemini error in the pipeline is retried, not marked processed."""
+        import automation_worker
+
+        monkeypatch.setattr(automation_worker, "DB_PATH", db_path)
+        queue = JobQueue(db_path, worker_id="w")
+        await queue.enqueue({"webhook_id": "wh", "timestamp": "t", "file_key": "abc", "file_name": "File", "node_id": "1:2"})
+        ctx = MagicMock()
+        try:
+            with patch.object(automation_worker, "process_pipeline", AsyncMock(side_effect=RuntimeError("Gemini 500"))), \
+                 patch.object(automation_worker, "prime_node_fetches", return_value=MagicMock()), \
+                 patch.object(automation_worker, "LLMCoder"), \
+                 patch.object(automation_worker.span_recorder, "flush", AsyncMock()):
+                assert await automation_worker.process_tick(ctx, queue, None, ".") is True
+        finally:
+            await queue.close()
+
+        async with aiosqlite.connect(db_path) as db:
+            cursor = await db.execute("SELECT status, attempts, error_log, due_at FROM events")
+            status, attempts, error_log, due_at = await cursor.fetchone()
+        assert (status, attempts) == ("pending", 1)
+        assert error_log == "RuntimeError: Gemini 500"
+        assert due_at > time.time()
+
+    @pytest.mark.asyncio
+    async def test_tick_error_releases_unstarted_jobs(self, db_path, monkeypatch):
+        """A crash while recording one job hands the rest of the batch back instead of leaving it leased."""
+        import automation_worker
+
+        monkeypatch.setattr(automation_worker, "DB_PATH", db_path)
+        queue = JobQueue(db_path, worker_id="w")
+        for node in ("1:1", "1:2"):
+            await queue.enqueue({"webhook_id": f"wh_{node}", "timestamp": "t", "file_key": "abc", "node_id": node})
+        pipeline = AsyncMock(return_value=True)
+        try:
+            with patch.object(automation_worker, "process_pipeline", pipeline), \
+                 patch.object(automation_worker, "prime_node_fetches", return_value=MagicMock()), \
+                 patch.object(automation_worker, "LLMCoder"), \
+                 patch.object(automation_worker.span_recorder, "flush", AsyncMock()), \
+                 patch.object(queue, "complete", AsyncMock(side_effect=aiosqlite.OperationalError("disk I/O error"))):
+                with pytest.raises(aiosqlite.OperationalError):
+                    await automation_worker.process_tick(MagicMock(), queue, None, ".")
+        finally:
+            await queue.close()
+
+        assert pipeline.await_count == 1
+        async with aiosqlite.connect(db_path) as db:
+            cursor = await db.execute("SELECT status, attempts, leased_by FROM events ORDER BY node_id")
+            rows = await cursor.fetchall()
+        # Neither result was recorded: both are claimable again, without an attempt used up
+        assert rows == [("pending", 0, None), ("pending", 0, None)]
+
+    @pytest.mark.asyncio
+    async def test_tick_skips_job_whose_lease_was_taken(self, db_path, monkeypatch):
+        """A job reaped and handed to another worker while earlier jobs ran is not started twice."""
+        import automation_worker
+
+        monkeypatch.setattr(automation_worker, "DB_PATH", db_path)
+        queue = JobQueue(db_path, worker_id="w")
+        for node in ("1:1", "1:2"):
+            await queue.enqueue({"webhook_id": f"wh_{node}", "timestamp": "t", "file_key": "abc", "node_id": node})
+
+        async def slow_first_job(ctx, event, *args):
+            async with aiosqlite.connect(db_path) as db:
+                await db.execute("UPDATE events SET leased_by = 'other' WHERE id != ?", (event["id"],))
+                await db.commit()
+            return True
+
+        pipeline = AsyncMock(side_effect=slow_first_job)
+        try:
+            with patch.object(automation_worker, "process_pipeline", pipeline), \
+                 patch.object(automation_worker, "prime_node_fetches", return_value=MagicMock()), \
+                 patch.object(automation_worker, "LLMCoder"), \
+                 patch.object(automation_worker.span_recorder, "flush", AsyncMock()):
+                assert await automation_worker.process_tick(MagicMock(), queue, None, ".") is True
+        finally:
+            await queue.close()
+
+        assert pipeline.await_count == 1
+        async with aiosqlite.connect(db_path) as db:
+            cursor = await db.execute("SELECT status, leased_by FROM events ORDER BY status")
+            rows = await cursor.fetchall()
+        assert rows == [("processed", None), ("processing", "other")]
+
+    @pytest.mark.asyncio
+    async def test_startup_recovers_events_of_dead_local_worker(self, db_path):
+        # A pid on this host that is certainly not running
+        dead_id = f"{socket.gethostname()}:{2 ** 22 + 12345}"
+        crashed = JobQueue(db_path, worker_id=dead_id)
+        alive = JobQueue(db_path, worker_id="other-host:1")
+        await crashed.enqueue({"webhook_id": "wh1", "timestamp": "t", "file_key": "abc", "node_id": "1:1"})
+        await crashed.claim_batch(1)
+        await alive.enqueue({"webhook_id": "wh2", "timestamp": "t", "file_key": "abc", "node_id": "1:2"})
+        await alive.claim_batch(1)
+
+        restarted = JobQueue(db_path)
+        try:
+            # Leases are still valid, only the dead process's event comes back
+            assert await restarted.reap_expired() == 0
+            assert await restarted.recover_orphans() == 1
+            [job] = await restarted.claim_batch(4)
+            assert job["node_id"] == "1:1"
+        finally:
+            for q in (crashed, alive, restarted):
+                await q.close()
+
+    @pytest.mark.asyncio
+    async def test_burst_is_debounced_into_one_run(self, db_path, monkeypatch):
+        monkeypatch.setattr(job_queue, "DEBOUNCE_WINDOW", 30)
+        queue = JobQueue(db_path)
+        for i in range(50):
+            await queue.enqueue({"webhook_id": f"wh_{i}", "timestamp": "t", "file_key": "abc"})
+
+        try:
+            assert await queue.claim_batch(10) == []
+            assert await queue.next_due_at() > time.time() + 25
+
+            # Once the quiet period has passed, the burst is a single job
+            async with aiosqlite.connect(db_path) as db:
+                await db.execute("UPDATE events SET due_at = 0")
+                await db.commit()
+            jobs = await queue.claim_batch(10)
+        finally:
+            await queue.close()
+
+        assert len(jobs) == 1
+        assert jobs[0]["revision"] == 50
+
+
+# --- Part 4: Worker Pipeline Tests ---
+
+class TestFrameExecutor:
+    """Test bounded concurrent frame processing in the worker."""
+
+    @pytest.mark.asyncio
+    async def test_bounded_parallelism_and_failure_isolation(self):
+        import automation_worker
+
+        running = 0
+        peak = 0
+
+        async def fake_single_frame(ctx, event, frame, *args):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+            if frame["name"] == "Broken":
+                raise RuntimeError("boom")
+            return True
+
+        frames = [{"id": f"1:{i}", "name": f"Frame{i}"} for i in range(9)] + [{"id": "2:0", "name": "Broken"}]
+        with patch.object(automation_worker, "process_single_frame", side_effect=fake_single_frame) as mocked:
+            ok = await automation_worker.process_frames_concurrently(
+                None, {}, frames, None, None, None, ".", concurrency=3
+            )
+
+        assert ok is False
+        assert mocked.call_count == 10
+        assert peak == 3
+
+
+
+class TestFrameFingerprints:
+    """Test content-addressed skipping of unchanged frames."""
+
+    FRAME = {
+        "id": "1:2", "name": "Card", "type": "FRAME",
+        "absoluteBoundingBox": {"x": 100, "y": 50, "width": 320, "height": 200},
+        "absoluteRenderBounds": {"x": 98, "y": 48, "width": 324, "height": 204},
+        "children": [{
+            "id": "1:3", "type": "TEXT", "characters": "Hello",
+            "absoluteBoundingBox": {"x": 116, "y": 66, "width": 80, "height": 20}
+        }]
+    }
+
+    def test_hash_ignores_volatile_fields_and_position(self):
+        from automation_worker import canonical_frame_hash
+
+        moved = json.loads(json.dumps(self.FRAME))
+        moved["absoluteBoundingBox"].update(x=600, y=400)
+        moved["children"][0]["absoluteBoundingBox"].update(x=616, y=416)
+        moved["absoluteRenderBounds"] = {"width": 400, "x": 0, "y": 0, "height": 1}
+        reordered = dict(reversed(list(moved.items())))
+
+        edited = json.loads(json.dumps(self.FRAME))
+        edited["children"][0]["characters"] = "Hello world"
+
+        assert canonical_frame_hash(reordered) == canonical_frame_hash(self.FRAME)
+        assert canonical_frame_hash(edited) != canonical_frame_hash(self.FRAME)
+
+    @pytest.mark.asyncio
+    async def test_unchanged_frame_is_skipped(self, tmp_path):
+        import automation_worker
+        from mcp_core.services.frame_fingerprints import FrameFingerprintStore
+
+        db_path = tmp_path / "events.db"
+        init_db(db_path)
+        store = FrameFingerprintStore(db_path)
+        (tmp_path / "src").mkdir()
+        (tmp_path / "src" / "Card.jsx").write_text("export const Card = () => null;")
+
+        fingerprint = automation_worker.canonical_frame_hash(self.FRAME)
+        await store.record("fileKey", "1:2", fingerprint, "src/Card.jsx")
+        assert (await store.get("fileKey", "1:2"))["fingerprint"] == fingerprint
+
+        event = {"file_key": "fileKey", "file_name": "File"}
+        with patch.object(automation_worker, "find_target_file") as find_target:
+            ok = await automation_worker.process_single_frame(
+                None, event, self.FRAME, None, None, None, str(tmp_path), store
+            )
+        assert ok is True
+        find_target.assert_not_called()
+
+        # An explicit !sync regenerates (and prefetches the image of) an unchanged frame
+        targeted = {**event, "event_type": "TARGETED_SYNC", "lane": "targeted"}
+        with patch.object(automation_worker, "find_target_file", side_effect=RuntimeError("generating")) as find_target, \
+             patch.object(automation_worker, "prefetch_vision_images", AsyncMock()) as prefetch:
+            ok = await automation_worker.process_frames_concurrently(
+                None, targeted, [self.FRAME], None, None, None, str(tmp_path), fingerprints=store
+            )
+        assert ok is False
+        find_target.assert_called_once()
+        assert prefetch.call_args.args[-1] is None
+
+        # Output deleted -> regenerate even though the design is the same
+        (tmp_path / "src" / "Card.jsx").unlink()
+        assert not await automation_worker.frame_is_unchanged(store, "fileKey", "1:2", fingerprint, str(tmp_path))
+
+
+class TestPipelineSpans:
+    """Test the per-stage span recorder."""
+
+    @pytest.mark.asyncio
+    async def test_spans_are_attributed_and_persisted(self, tmp_path):
+        import sqlite3
+        from mcp_core.services.pipeline_spans import SpanRecorder, current_event_id, current_frame_id
+
+        db_path = tmp_path / "events.db"
+        init_db(db_path)
+        recorder = SpanRecorder(db_path)
+
+        async def frame(frame_id):
+            current_frame_id.set(frame_id)
+            with recorder.span("generate", prompt_chars=10) as s:
+                await asyncio.sleep(0.01)
+                s.bytes_out = 42
+
+        token = current_event_id.set(7)
+        try:
+            await asyncio.gather(frame("1:1"), frame("1:2"))
+            with pytest.raises(RuntimeError):
+                with recorder.span("validate"):
+                    raise RuntimeError("tsc exploded")
+        finally:
+            current_event_id.reset(token)
+
+        assert await recorder.flush() == 3
+        assert await recorder.flush() == 0
+
+        conn = sqlite3.connect(db_path)
+        rows = conn.execute(
+            "SELECT event_id, frame_id, stage, duration_ms, bytes_out, outcome FROM pipeline_spans ORDER BY id"
+        ).fetchall()
+        conn.close()
+
+        generate_rows = [r for r in rows if r[2] == "generate"]
+        assert {r[1] for r in generate_rows} == {"1:1", "1:2"}
+        assert all(r[0] == 7 and r[3] >= 5 and r[4] == 42 and r[5] == "ok" for r in generate_rows)
+        assert rows[-1][2] == "validate" and rows[-1][5] == "error"
+
+    @pytest.mark.asyncio
+    async def test_single_frame_does_not_leak_its_frame_id(self):
+        """The single-frame path runs in the caller's context: later spans must not carry the frame id."""
+        import automation_worker
+        from mcp_core.services.pipeline_spans import current_frame_id
+
+        event = {"file_key": "abc", "file_name": "File"}
+        for result in (AsyncMock(return_value=True), AsyncMock(side_effect=RuntimeError("Gemini 500"))):
+            with patch.object(automation_worker, "run_frame_stages", result), \
+                 patch.object(automation_worker, "span", MagicMock()):
+                try:
+                    await automation_worker.process_single_frame(MagicMock(), event, {"id": "1:1"}, None, None, None, ".")
+                except RuntimeError:
+                    pass
+            assert current_frame_id.get() is None
+
+
+class TestFramePrefetch:
+    """Test that the independent pre-generation stages overlap."""
+
+    @pytest.mark.asyncio
+    async def test_prefetch_stages_run_concurrently(self, tmp_path):
+        import automation_worker
+
+        (tmp_path / "src").mkdir()
+        (tmp_path / "src" / "Example.jsx").write_text("export const Example = () => <div>example</div>;")
+
+        async def slow_images(ctx, file_key, node_ids, on_image=None):
+            await asyncio.sleep(0.3)
+            for node_id in node_ids:
+                on_image(node_id, b"png")
+            return {node_id: b"png" for node_id in node_ids}
+
+        def slow_context():
+            time.sleep(0.3)
+            return "// tailwind.config.js"
+
+        def slow_search(query, limit):
+            time.sleep(0.3)
+            return ["src/Example.jsx"]
+
+        search_engine = MagicMock()
+        search_engine.search.side_effect = slow_search
+        coder = MagicMock()
+        coder.agenerate_component = AsyncMock(return_value={"file_name": "Card.jsx", "code": "export const Card = () => null;"})
+        frame = {"id": "1:2", "name": "Card", "type": "FRAME",
+                 "children": [{"type": "TEXT", "characters": "A card with plenty of descriptive text"}]}
+
+        with patch.object(automation_worker.figma, "fetch_frame_images", side_effect=slow_images), \
+             patch.object(automation_worker, "get_project_context", side_effect=slow_context), \
+             patch.object(automation_worker, "find_target_file", return_value="src/Card.jsx"), \
+             patch.object(automation_worker, "check_code", AsyncMock(return_value=(True, ""))), \
+             patch.object(automation_worker, "format_code", side_effect=lambda code, *args: code):
+            start = time.perf_counter()
+            ok = await automation_worker.process_single_frame(
+                None, {"file_key": "fileKey", "file_name": "File"}, frame, coder, None, search_engine, str(tmp_path)
+            )
+            elapsed = time.perf_counter() - start
+
+        assert ok is True
+        assert elapsed < 0.6
+        kwargs = coder.agenerate_component.call_args.kwargs
+        assert kwargs["image_data"] == b"png"
+        assert kwargs["image_mime_type"] == "image/png"
+        assert kwargs["context_files"] == "// tailwind.config.js"
+        assert "example</div>" in kwargs["rag_context"]
+        # The only file written into the project is the final component
+        assert sorted(p.name for p in (tmp_path / "src").iterdir()) == ["Card.jsx", "Example.jsx"]
+        assert not list(tmp_path.glob("temp_gen_*"))
+
+    def test_prepare_image_passes_through_without_pillow(self):
+        from mcp_core.services import image_prep
+
+        jpeg = b"\xff\xd8\xff\xe0" + b"\x00" * 64
+        with patch.object(image_prep, "pillow_available", return_value=False):
+            image = image_prep.prepare_image(jpeg, max_edge=10, target_format="webp")
+
+        assert image.data is jpeg
+        assert image.mime_type == "image/jpeg"
+        assert image.outcome == "skipped"
+
+    def test_prepare_image_downscales_and_converts(self):
+        pytest.importorskip("PIL")
+        import io
+        from PIL import Image
+        from mcp_core.services.image_prep import prepare_image
+
+        buffer = io.BytesIO()
+        Image.effect_noise((3000, 1000), 40).convert("RGBA").save(buffer, format="PNG")
+        png = buffer.getvalue()
+
+        image = prepare_image(png, max_edge=1200, target_format="jpeg", quality=80)
+
+        assert image.outcome == "resized"
+        assert image.mime_type == "image/jpeg"
+        assert image.original_size == (3000, 1000) and image.size == (1200, 400)
+        assert image.original_bytes == len(png) and len(image.data) < len(png)
+        assert Image.open(io.BytesIO(image.data)).size == (1200, 400)
+        # Small enough and already PNG: untouched
+        small = prepare_image(png, max_edge=4000, target_format="png")
+        assert small.data is png and small.outcome == "unchanged"
+
+
+FAKE_PRETTIER = """
+let calls = 0;
+module.exports = {
+  version: "0.0.0-test",
+  resolveConfig: async () => ({ semi: true }),
+  format: async (code, options) => {
+    calls += 1;
+    if (code.includes("SYNTAX ERROR")) throw new Error("Unexpected token (1:1)");
+    return `// formatted ${options.filepath.split(/[\\\\/]/).pop()} call ${calls}\\n` + code.trim() + "\\n";
+  }
+};
+"""
+
+
+@pytest.mark.skipif(not shutil.which("node"), reason="node is not installed")
+class TestPrettierDaemon:
+    """Test the long-lived Prettier sidecar (against a stand-in prettier module)."""
+
+    @pytest.mark.asyncio
+    async def test_formats_in_memory_and_batches(self, tmp_path):
+        from mcp_core.utils.formatter import PrettierDaemon
+
+        module_dir = tmp_path / "node_modules" / "prettier"
+        module_dir.mkdir(parents=True)
+        (module_dir / "index.js").write_text(FAKE_PRETTIER)
+
+        daemon = PrettierDaemon(str(tmp_path), batch_window_ms=50)
+        try:
+            results = await asyncio.gather(*(
+                daemon.format(f"export const C{i} = () => null;", f"src/C{i}.jsx") for i in range(5)
+            ))
+            with pytest.raises(ValueError, match="Unexpected token"):
+                await daemon.format("SYNTAX ERROR", "src/Bad.jsx")
+            again = await daemon.format("export const D = 1;", "src/D.jsx")
+        finally:
+            await daemon.close()
+
+        assert daemon.version == "0.0.0-test"
+        assert results[3].startswith("// formatted C3.jsx")
+        # One request for the five concurrent frames, then one per later call
+        assert daemon._next_id == 3
+        assert again.startswith("// formatted D.jsx call 7")
+        assert not list((tmp_path).glob("src"))
+
+    @pytest.mark.asyncio
+    async def test_daemon_error_fails_queued_requests(self, tmp_path):
+        """A failed round trip fails every waiting caller (so they fall back), not just its own batch."""
+        from mcp_core.utils.formatter import FormatterUnavailable, PrettierDaemon
+
+        module_dir = tmp_path / "node_modules" / "prettier"
+        module_dir.mkdir(parents=True)
+        (module_dir / "index.js").write_text(FAKE_PRETTIER)
+
+        async def broken_send(batch):
+            await asyncio.sleep(0.05)
+            raise RuntimeError("prettier daemon exited")
+
+        daemon = PrettierDaemon(str(tmp_path), batch_max=1, batch_window_ms=0)
+        try:
+            with patch.object(daemon, "_send", side_effect=broken_send):
+                results = await asyncio.wait_for(asyncio.gather(
+                    *(daemon.format(f"export const C{i} = 1;", f"src/C{i}.jsx") for i in range(3)),
+                    return_exceptions=True
+                ), 5)
+        finally:
+            await daemon.close()
+
+        assert all(isinstance(result, FormatterUnavailable) for result in results)
+
+    @pytest.mark.asyncio
+    async def test_falls_back_to_npx_when_daemon_unavailable(self, tmp_path):
+        from mcp_core.utils import formatter
+
+        with patch.dict(formatter._daemons, clear=True), \
+             patch.object(formatter, "format_with_npx", AsyncMock(return_value="formatted")) as npx:
+            assert await formatter.format_code("code", "src/A.jsx", str(tmp_path)) == "formatted"
+            assert await formatter.format_code("code", "src/B.jsx", str(tmp_path)) == "formatted"
+            assert "prettier not found" in formatter.get_daemon(str(tmp_path)).unavailable
+
+        assert npx.await_count == 2
+
+
+class TestTypeCheckService:
+    """Test batched tsc validation and mapping diagnostics back to each file."""
+
+    @pytest.mark.asyncio
+    async def test_concurrent_checks_share_one_program(self, tmp_path):
+        from mcp_core.utils.validator import TypeCheckService
+
+        # A window far longer than the test, closed by batch_max: the batch is complete as soon as all three arrive
+        service = TypeCheckService(str(tmp_path / "project"), batch_window_ms=60_000, batch_max=3, cache_dir=tmp_path / "cache")
+        runs = []
+
+        async def fake_tsc():
+            config = json.loads((service.cache_dir / "tsconfig.json").read_text())
+            runs.append(config["files"])
+            assert config["compilerOptions"]["incremental"] is True
+            return 2, (
+                "root/src/components/Bad.tsx(3,7): error TS2322: Type 'number' is not assignable to type 'string'.\n"
+                "  Additional context line.\n"
+            )
+
+        with patch.object(service, "_run_tsc", side_effect=fake_tsc):
+            good, bad, other = await asyncio.gather(
+                service.check("export const Good = () => null;", "src/components/Good.tsx"),
+                service.check("const x: string = 1;", "src/components/Bad.tsx"),
+                service.check("export const Other = 1;", "src/Other.tsx"),
+            )
+
+        assert len(runs) == 1 and len(runs[0]) == 3
+        assert good[0] is True and other[0] is True
+        assert bad[0] is False
+        assert bad[1].startswith("src/components/Bad.tsx(3,7): error TS2322")
+        assert "Additional context line." in bad[1]
+        assert not (tmp_path / "project").exists()
+
+    @pytest.mark.asyncio
+    async def test_unattributed_failure_fails_every_file(self, tmp_path):
+        from mcp_core.utils.validator import TypeCheckService
+
+        service = TypeCheckService(str(tmp_path), cache_dir=tmp_path / "cache")
+        with patch.object(service, "_run_tsc", AsyncMock(return_value=(1, "error TS5058: The specified path does not exist."))):
+            results = await service.check_batch({"src/A.tsx": "export {};", "src/B.tsx": "export {};"})
+
+        assert all(not ok and "TS5058" in msg for ok, msg in results.values())
+
+    @pytest.mark.asyncio
+    async def test_check_code_syntax_checks_jsx_without_tsc(self, tmp_path):
+        from mcp_core.utils import validator
+
+        with patch.object(validator, "get_type_checker") as get_type_checker:
+            ok, msg = await validator.check_code("export const A = () => <div>hi</div>;", "src/A.jsx", str(tmp_path))
+            assert ok is True and "type check skipped" in msg
+
+            ok, msg = await validator.check_code("export const A = () => <div>hi</span>;", "src/A.tsx", str(tmp_path))
+            assert ok is False and msg.startswith("src/A.tsx(1,31): SyntaxError")
+
+        # Broken syntax never reaches the (expensive) type checker
+        get_type_checker.assert_not_called()
+
+
+class TestJSXSyntax:
+    """Test the in-process JSX/TSX syntax checker."""
+
+    VALID = """import React, { useState } from 'react';
+import { Box, Typography } from '@mui/material';
+
+// a comment with <div> and an 'apostrophe
+export const Card = ({ title, items = [] }) => {
+  const [open, setOpen] = useState(false);
+  const pattern = /<\\/?[a-z]+>/gi;
+  const half = items.length / 2;
+  return (
+    <Box sx={{ p: 2, border: '1px solid #eee' }} onClick={() => setOpen(!open)}>
+      <Typography variant="h6">{title} - don't stop</Typography>
+      {items.map((item) => <span key={item.id} {...item}>{`${item.name} x${half > 1 ? 2 : 1}`}</span>)}
+      {open && (
+        <>
+          <img src="a.png" alt='preview' />
+          {/* nothing else */}
+        </>
+      )}
+    </Box>
+  );
+};
+"""
+
+    def test_valid_jsx_and_tsx(self):
+        from mcp_core.utils.jsx_syntax import check_jsx_syntax
+
+        tsx = (
+            "const identity = <T,>(x: T): T => x;\n"
+            "type Fn = <T>(x: T) => T;\n"
+            "const apply: <T>(f: (x: T) => T, x: T) => T = (f, x) => f(x);\n"
+            "export const List: React.FC<{ ids: Array<string> }> = ({ ids }) => {\n"
+            "  const [v] = useState<string | null>(null);\n"
+            "  return <ul>{ids.map(id => <li key={id}>{id as string}</li>)}</ul>;\n"
+            "};\n"
+        )
+        assert check_jsx_syntax(self.VALID) is None
+        # Non-ASCII / escaped identifiers: the `/` after them is a division, not a regex
+        unicode_js = (
+            "const café = total / count;\n"
+            "const 名前 = width / 2, \\u0061b = café / 3;\n"
+            "export const Prix = ({ prixÉtiquette }) => <span data-ü=\"1\">{prixÉtiquette / 100}</span>;\n"
+        )
+        assert check_jsx_syntax(unicode_js) is None
+        assert check_jsx_syntax(tsx, typescript=True) is None
+        # Same shape, but an element: still scanned (and its missing close tag reported) as JSX
+        error = check_jsx_syntax("const a = cond ? x : <b>(note) </i>;\n", typescript=True)
+        assert "closing tag for <b>" in error.message
+
+    @pytest.mark.parametrize("source, line, col, fragment", [
+        ("const A = () => (\n  <Box>\n    <Typography>hi</Box>\n  </Box>\n);\n", 3, 19, "closing tag for <Typography>"),
+        ("const A = () => (\n  <Box>\n    <p>hi</p>\n);\n", 2, 3, "<Box> opened at 2:3 is never closed"),
+        ("function f() {\n  if (x) {\n    return 1;\n}\n", 1, 14, "Unclosed '{'"),
+        ("const A = () => <div>a } b</div>;\n", 1, 24, "in JSX text"),
+        ("const a = 'abc;\nconst b = 2;\n", 1, 11, "Unterminated string"),
+        ("```jsx\nconst a = 1;\n```\n", 1, 1, "code fence"),
+    ])
+    def test_reports_line_and_column(self, source, line, col, fragment):
+        from mcp_core.utils.jsx_syntax import check_jsx_syntax, format_syntax_error
+
+        error = check_jsx_syntax(source)
+        assert (error.line, error.col) == (line, col)
+        assert fragment in error.message
+        assert format_syntax_error(error, source, "Card.jsx").startswith(f"Card.jsx({line},{col}): SyntaxError")
+
+
+class TestAtomicWrite:
+    """Test the single, atomic final write of generated code."""
+
+    def test_replaces_atomically_and_skips_identical_content(self, tmp_path):
+        from mcp_core.utils.atomic_write import write_text_atomic
+
+        target = tmp_path / "src" / "components" / "Card.jsx"
+        assert write_text_atomic(target, "v1") is True
+        assert write_text_atomic(target, "v2") is True
+        assert target.read_text() == "v2"
+
+        mtime = target.stat().st_mtime_ns
+        assert write_text_atomic(target, "v2") is False
+        assert target.stat().st_mtime_ns == mtime
+        assert [p.name for p in target.parent.iterdir()] == ["Card.jsx"]
+
+    def test_failed_write_leaves_target_untouched(self, tmp_path):
+        from mcp_core.utils.atomic_write import write_text_atomic
+
+        target = tmp_path / "Card.jsx"
+        target.write_text("original")
+        with patch("mcp_core.utils.atomic_write.os.replace", side_effect=OSError("disk full")):
+            with pytest.raises(OSError):
+                write_text_atomic(target, "new")
+
+        assert target.read_text() == "original"
+        assert [p.name for p in tmp_path.iterdir()] == ["Card.jsx"]
+
+    def test_keeps_permissions_of_the_target(self, tmp_path):
+        from mcp_core.utils import atomic_write
+
+        created = tmp_path / "New.jsx"
+        atomic_write.write_text_atomic(created, "v1")
+        assert created.stat().st_mode & 0o777 == 0o666 & ~atomic_write._UMASK
+
+        existing = tmp_path / "Card.jsx"
+        existing.write_text("v1")
+        existing.chmod(0o640)
+        atomic_write.write_text_atomic(existing, "v2")
+        assert existing.stat().st_mode & 0o777 == 0o640
+
+    def test_works_without_fchmod(self, tmp_path, monkeypatch):
+        """os.fchmod does not exist on Windows before Python 3.13."""
+        from mcp_core.utils import atomic_write
+
+        monkeypatch.delattr(atomic_write.os, "fchmod", raising=False)
+        target = tmp_path / "Card.jsx"
+        target.write_text("v1")
+        target.chmod(0o640)
+        assert atomic_write.write_text_atomic(target, "v2") is True
+        assert target.read_text() == "v2"
+        assert target.stat().st_mode & 0o777 == 0o640
+
+
+class TestLLMCoderAsync:
+    """Test the non-blocking Gemini methods on LLMCoder."""
+
+    @staticmethod
+    def make_coder(generate_content_async):
+        from mcp_core.services.llm_coder import LLMCoder
+
+        coder = LLMCoder()
+        coder.model = MagicMock()
+        coder.model.generate_content_async = generate_content_async
+        return coder
+
+    @pytest.mark.asyncio
+    async def test_agenerate_component_parses_json(self):
+        part = MagicMock()
+        response = MagicMock()
+        response.candidates = [MagicMock(content=MagicMock(parts=[part]))]
+        response.text = json.dumps({"file_name": "Card.jsx", "code": "export const Card = () => null;"})
+        coder = self.make_coder(AsyncMock(return_value=response))
+
+        result = await coder.agenerate_component({"name": "Card"})
+
+        assert result["file_name"] == "Card.jsx"
+        kwargs = coder.model.generate_content_async.call_args.kwargs
+        assert kwargs["generation_config"] == {"response_mime_type": "application/json"}
+
+    @pytest.mark.asyncio
+    async def test_timeouts_do_not_block_the_loop(self):
+        async def slow_model(*args, **kwargs):
+            await asyncio.sleep(5)
+
+        coder = self.make_coder(slow_model)
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker_task = asyncio.create_task(ticker())
+        try:
+            with pytest.raises(TimeoutError):
+                await coder.agenerate_component({"name": "Card"}, timeout=0.2)
+            # fix/route fall back instead of raising
+            assert await coder.afix_code("broken", "err", timeout=0.05) == "broken"
+            assert await coder.aroute("My Card", "", [], timeout=0.05) == "FigmaDesign/MyCard.jsx"
+        finally:
+            ticker_task.cancel()
+
+        assert ticks > 5
+
+
+    @pytest.mark.asyncio
+    async def test_gemini_429_pauses_shared_bucket(self, tmp_path):
+        from mcp_core.services.llm_coder import gemini_retry_after
+        from mcp_core.services.rate_limiter import Budget, RateLimiter
+
+        class ResourceExhausted(Exception):
+            code = 429
+
+        limiter = RateLimiter(tmp_path / "rate.db", {"gemini": Budget(per_minute=600, burst=5)})
+        coder = self.make_coder(AsyncMock(side_effect=ResourceExhausted("429 Quota exceeded. Please retry in 12.5s.")))
+        coder.rate_limiter = limiter
+
+        with pytest.raises(ResourceExhausted):
+            await coder.agenerate_component({"name": "Card"})
+
+        assert gemini_retry_after(ResourceExhausted("retry_delay { seconds: 7 }")) == 7
+        assert limiter.pauses == 1
+        assert 11 < limiter._next_wait("gemini") <= 12.5
+
+class TestCassette:
+    """Test record/replay of the worker's external calls."""
+
+    @pytest.mark.asyncio
+    async def test_record_then_replay_without_network(self, tmp_path):
+        from mcp_core.services.cassette import Cassette, CassetteMiss, install
+        from mcp_core.services.llm_coder import LLMCoder
+
+        png = tmp_path / "frame.png"
+        png.write_bytes(b"\x89PNG fake")
+        fetch = AsyncMock(return_value={"nodes": [{"id": "1:2", "type": "FRAME"}]})
+        download = AsyncMock(return_value=str(png))
+        generate = AsyncMock(return_value={"file_name": "Card.jsx", "code": "<Card />"})
+
+        with patch.object(figma, "fetch_figma_pattern", fetch), \
+             patch.object(figma, "download_node_image_to_temp", download), \
+             patch.object(LLMCoder, "agenerate_component", generate):
+            uninstall = install(Cassette(tmp_path / "cassette", mode="record"))
+            try:
+                coder = LLMCoder()
+                await figma.fetch_figma_pattern(None, {"file_key": "F1", "node_ids": ["1:2"], "depth": 5})
+                await figma.download_node_image_to_temp(None, "F1", "1:2")
+                await coder.agenerate_component({"id": "1:2", "name": "Card"}, context_files="ctx")
+            finally:
+                uninstall()
+
+            assert figma.fetch_figma_pattern is fetch
+            for mock in (fetch, download, generate):
+                mock.reset_mock()
+
+            cassette = Cassette(tmp_path / "cassette", mode="replay", latency_ms=0)
+            uninstall = install(cassette)
+            try:
+                result = await figma.fetch_figma_pattern(None, {"file_key": "F1", "node_ids": ["1:2"], "depth": 5})
+                image_path = await figma.download_node_image_to_temp(None, "F1", "1:2")
+                # Prompt context is not part of the key
+                generated = await coder.agenerate_component({"id": "1:2", "name": "Card"}, context_files="other")
+                with pytest.raises(CassetteMiss):
+                    await coder.agenerate_component({"id": "9:9", "name": "Other"})
+            finally:
+                uninstall()
+
+        assert result["nodes"][0]["id"] == "1:2"
+        assert image_path != str(png) and Path(image_path).read_bytes() == b"\x89PNG fake"
+        os.remove(image_path)
+        assert generated["code"] == "<Card />"
+        assert cassette.hits == 3 and cassette.misses == 1
+        for mock in (fetch, download, generate):
+            mock.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_loose_replay_and_simulated_latency(self, tmp_path):
+        from mcp_core.services.cassette import Cassette
+
+        recorder = Cassette(tmp_path, mode="record")
+        recorder.save("fix", "aaaa", {}, "fixed-a", latency_ms=1000)
+        recorder.save("fix", "bbbb", {}, "fixed-b", latency_ms=1000)
+
+        cassette = Cassette(tmp_path, mode="replay", latency_scale=0.05, loose=True)
+        start = time.perf_counter()
+        first = await cassette.acall("fix", "0123", {}, AsyncMock())
+        elapsed = time.perf_counter() - start
+
+        assert first in ("fixed-a", "fixed-b")
+        # Same key -> same recording
+        assert await cassette.acall("fix", "0123", {}, AsyncMock()) == first
+        assert 0.04 <= elapsed < 0.5
+        assert cassette.misses == 2
+
+# --- Part 5: Figma API Tests ---
 
 class TestFigmaAPI:
     """Test Figma API integration functions."""
 
     @pytest.mark.asyncio
     async def test_fetch_figma_pattern_httpx(self):
-        """Verify fetch_figma_pattern fetches and parses Figma data."""
-        mock_response = MagicMock()
-        mock_response.status_code = 200
-        mock_response.json.return_value = {
-            "name": "Test File",
-            "lastModified": "2023-01-01",
-            "document": {"id": "0:0", "type": "DOCUMENT"},
-            "components": {},
-            "styles": {}
-        }
-        
-        with patch("httpx.AsyncClient") as mock_client_cls:
-            mock_client = AsyncMock()
-            mock_client.get.return_value = mock_response
-            
-            mock_client_cls.return_value.__aenter__.return_value = mock_client
-            mock_client_cls.return_value.__aexit__.return_value = None
-            
-            config = ServerConfig(allowed_repos=["*"], allowed_roots=[])
-            server = RepoToolsServer(config)
-            
-            with patch.dict(os.environ, {"FIGMA_ACCESS_TOKEN": "fake-token"}):
-                result = await figma.fetch_figma_pattern(server.ctx, {"file_key": "key123"})
-                
-            assert result["file_key"] == "key123"
-            assert result["name"] == "Test File"
-            mock_client.get.assert_called_once()
+        """Verify fetch_figma_pattern fetches and parses Figma data through the context's client."""
+        import httpx
+        from mcp_core.services.figma_client import FigmaClient
+
+        requests_seen = []
+
+        def handler(request):
+            requests_seen.append(request)
+            return httpx.Response(200, json={
+                "name": "Test File",
+                "lastModified": "2023-01-01",
+                "document": {"id": "0:0", "type": "DOCUMENT"},
+                "components": {},
+                "styles": {}
+            })
+
+        config = ServerConfig(allowed_repos=["*"], allowed_roots=[])
+        server = RepoToolsServer(config)
+        server.ctx.figma = FigmaClient(transport=httpx.MockTransport(handler))
+
+        with patch.dict(os.environ, {"FIGMA_ACCESS_TOKEN": "fake-token"}):
+            result = await figma.fetch_figma_pattern(server.ctx, {"file_key": "key123"})
+        await server.ctx.figma.aclose()
+
+        assert result["file_key"] == "key123"
+        assert result["name"] == "Test File"
+        assert len(requests_seen) == 1
+        assert requests_seen[0].headers["X-Figma-Token"] == "fake-token"
+
+    @pytest.mark.asyncio
+    async def test_figma_client_pools_and_retries(self):
+        """One pooled client for API and image calls; 429/5xx retried, S3 downloads sent without the token."""
+        import httpx
+        from mcp_core.services.figma_client import FigmaClient
+
+        calls = []
+
+        def handler(request):
+            calls.append(request)
+            if request.url.host == "s3.example.com":
+                return httpx.Response(200, content=b"\x89PNG")
+            if len(calls) == 1:
+                return httpx.Response(429, headers={"Retry-After": "0"})
+            if len(calls) == 2:
+                return httpx.Response(503)
+            return httpx.Response(200, json={"images": {"1:2": "https://s3.example.com/render.png"}})
+
+        client = FigmaClient(transport=httpx.MockTransport(handler), base_delay=0)
+        ctx = MagicMock(figma=client)
+        with patch.dict(os.environ, {"FIGMA_ACCESS_TOKEN": "fake-token"}):
+            path = await figma.download_node_image_to_temp(ctx, "key123", "1:2")
+            pooled = client.client
+        await client.aclose()
+
+        assert Path(path).read_bytes() == b"\x89PNG"
+        os.remove(path)
+        assert len(calls) == 4
+        assert "X-Figma-Token" not in calls[-1].headers
+        assert all(c.headers.get("X-Figma-Token") == "fake-token" for c in calls[:-1])
+        assert pooled.is_closed
+
+    @pytest.mark.asyncio
+    async def test_node_cache_serves_known_version_offline(self, tmp_path):
+        """A fetch is cached under the returned version; asking for that version again makes no request."""
+        import httpx
+        from mcp_core.services.figma_client import FigmaClient
+        from mcp_core.services.node_cache import FigmaNodeCache
+
+        requests_seen = []
+
+        def handler(request):
+            requests_seen.append(request)
+            return httpx.Response(200, json={
+                "name": "Test File",
+                "version": "42",
+                "nodes": {"1:2": {"document": {"id": "1:2", "type": "FRAME", "children": []}}}
+            })
+
+        cache = FigmaNodeCache(tmp_path / "cache.db")
+        ctx = MagicMock(figma=FigmaClient(transport=httpx.MockTransport(handler)), node_cache=cache)
+        args = {"file_key": "key123", "node_ids": ["1:2"], "depth": 5}
+        with patch.dict(os.environ, {"FIGMA_ACCESS_TOKEN": "fake-token"}):
+            fresh = await figma.fetch_figma_pattern(ctx, args)
+            cached = await figma.fetch_figma_pattern(ctx, {**args, "version": "42"})
+            newer = await figma.fetch_figma_pattern(ctx, {**args, "version": "43"})
+        await ctx.figma.aclose()
+
+        assert fresh["version"] == "42" and "cached" not in fresh
+        assert cached["cached"] is True
+        assert cached["nodes"] == fresh["nodes"]
+        assert "cached" not in newer
+        assert len(requests_seen) == 2
+        stats = await cache.stats()
+        assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 1, 1)
+
+    @pytest.mark.asyncio
+    async def test_node_cache_evicts_least_recently_used(self, tmp_path):
+        """Over the size cap, the entries used longest ago are dropped first."""
+        from mcp_core.services.node_cache import FigmaNodeCache
+
+        result = {"nodes": [{"id": "1:2", "characters": os.urandom(300).hex()}]}
+        cache = FigmaNodeCache(tmp_path / "cache.db", max_bytes=1000)
+        await cache.put("F1", "1", [], 5, result)
+        await cache.put("F1", "2", [], 5, result)
+        assert await cache.get("F1", "1", [], 5) == result
+        await cache.put("F1", "3", [], 5, result)
+
+        assert await cache.get("F1", "2", [], 5) is None
+        assert await cache.get("F1", "1", [], 5) == result
+        assert await cache.get("F1", "3", [], 5) == result
+        assert cache.evictions == 1
+
+    @pytest.mark.asyncio
+    async def test_node_fetches_coalesce_into_one_request_per_file(self):
+        """Concurrent single-node fetches for a file share one /nodes call; primed loads are reused."""
+        import httpx
+        from mcp_core.services.figma_client import FigmaClient
+
+        requests_seen = []
+
+        def handler(request):
+            requests_seen.append(request)
+            ids = request.url.params["ids"].split(",")
+            return httpx.Response(200, json={
+                "name": request.url.path.split("/")[3],
+                "nodes": {i: {"document": {"id": i, "type": "FRAME"}} for i in ids}
+            })
+
+        ctx = MagicMock(figma=FigmaClient(transport=httpx.MockTransport(handler)), node_cache=None)
+        with patch.dict(os.environ, {"FIGMA_ACCESS_TOKEN": "fake-token"}):
+            results = await asyncio.gather(*(
+                figma.fetch_figma_pattern(ctx, {"file_key": file_key, "node_ids": [node_id], "depth": 5})
+                for file_key, node_id in (("fileA", "1:1"), ("fileA", "1:2"), ("fileB", "2:1"), ("fileA", "1:1"))
+            ))
+            assert len(requests_seen) == 2
+
+            loader = figma.get_node_loader(ctx)
+            loader.prime("fileA", 5, ["3:1", "3:2"])
+            first = await figma.fetch_figma_pattern(ctx, {"file_key": "fileA", "node_ids": ["3:1"], "depth": 5})
+            second = await figma.fetch_figma_pattern(ctx, {"file_key": "fileA", "node_ids": ["3:2"], "depth": 5})
+            loader.clear()
+        await ctx.figma.aclose()
+
+        assert [r["nodes"][0]["id"] for r in results] == ["1:1", "1:2", "2:1", "1:1"]
+        assert results[2]["name"] == "fileB"
+        assert (first["nodes"][0]["id"], second["nodes"][0]["id"]) == ("3:1", "3:2")
+        assert len(requests_seen) == 3
+        assert sorted(requests_seen[0].url.params["ids"].split(",")) == ["1:1", "1:2"]
+
+    @pytest.mark.asyncio
+    async def test_frame_images_render_once_and_stay_in_memory(self):
+        """One /v1/images call for every frame, concurrent downloads, later frames served from memory."""
+        import httpx
+        from mcp_core.services.figma_client import FigmaClient
+        from mcp_core.services.image_store import FrameImageStore
+
+        render_calls = []
+        downloads = []
+
+        async def handler(request):
+            if request.url.host == "s3.example.com":
+                downloads.append(request.url.path)
+                await asyncio.sleep(0.05)
+                return httpx.Response(200, content=request.url.path.encode())
+            render_calls.append(request.url.params["ids"].split(","))
+            ids = request.url.params["ids"].split(",")
+            return httpx.Response(200, json={"images": {i: f"https://s3.example.com/{i}.png" for i in ids}})
+
+        ctx = MagicMock(figma=FigmaClient(transport=httpx.MockTransport(handler)), frame_images=FrameImageStore())
+        node_ids = [f"1:{i}" for i in range(6)]
+        with patch.dict(os.environ, {"FIGMA_ACCESS_TOKEN": "fake-token"}):
+            start = time.perf_counter()
+            figma.prefetch_frame_images(ctx, "fileA", "v7", node_ids)
+            first = await figma.get_frame_image(ctx, "fileA", "v7", "1:0")
+            await asyncio.gather(*(figma.get_frame_image(ctx, "fileA", "v7", i) for i in node_ids))
+            elapsed = time.perf_counter() - start
+            again = await figma.get_frame_image(ctx, "fileA", "v7", "1:5")
+            newer = await figma.get_frame_image(ctx, "fileA", "v8", "1:5")
+        await ctx.figma.aclose()
+
+        assert first == b"/1:0.png" and again == newer == b"/1:5.png"
+        assert render_calls == [node_ids, ["1:5"]]
+        assert len(downloads) == 7
+        assert elapsed < 0.25
+        assert ctx.frame_images.bytes == sum(len(f"/{i}.png") for i in node_ids) + len(b"/1:5.png")
+
+    @pytest.mark.asyncio
+    async def test_vision_prefetch_without_version_does_not_fetch_twice(self):
+        """Unversioned images can't be shared through the store, so the worker leaves them to each frame."""
+        import httpx
+        import automation_worker
+        from mcp_core.services.figma_client import FigmaClient
+        from mcp_core.services.image_store import FrameImageStore
+
+        render_calls = []
+
+        async def handler(request):
+            if request.url.host == "s3.example.com":
+                return httpx.Response(200, content=request.url.path.encode())
+            render_calls.append(request.url.params["ids"])
+            ids = request.url.params["ids"].split(",")
+            return httpx.Response(200, json={"images": {i: f"https://s3.example.com/{i}.png" for i in ids}})
+
+        ctx = MagicMock(figma=FigmaClient(transport=httpx.MockTransport(handler)), frame_images=FrameImageStore())
+        with patch.dict(os.environ, {"FIGMA_ACCESS_TOKEN": "fake-token"}):
+            await automation_worker.prefetch_vision_images(ctx, "fileA", None, [{"id": "1:0"}, {"id": "1:1"}], ".")
+            await asyncio.sleep(0.05)
+            image = await figma.get_frame_image(ctx, "fileA", None, "1:0")
+        await ctx.figma.aclose()
+
+        assert image == b"/1:0.png"
+        assert render_calls == ["1:0"]
+
+    DOCUMENT = {
+        "document": {"id": "0:0", "type": "DOCUMENT", "children": [
+            {"id": "0:1", "type": "CANVAS", "name": "Page 1", "children": [
+                {"id": "1:1", "type": "FRAME", "name": "Card", "opacity": 0.5,
+                 "children": [{"id": "1:2", "type": "TEXT", "characters": "Hi"}]},
+                {"id": "1:3", "type": "RECTANGLE", "name": "Loose shape"},
+            ]},
+            {"id": "0:2", "type": "CANVAS", "name": "Page 2", "children": [
+                {"id": "2:1", "type": "FRAME", "name": "Header", "children": []},
+            ]},
+        ]},
+        "components": {},
+        "name": "Big File",
+        "lastModified": "2024-01-01T00:00:00Z",
+        "version": "123",
+    }
+
+    @pytest.mark.asyncio
+    async def test_spooled_frames_match_extracted_frames(self):
+        """Without streaming the document is parsed once and its frames spooled to disk."""
+        import httpx
+        import automation_worker
+        from mcp_core.services.figma_stream import FrameSpool, spool_file_response
+
+        spool = FrameSpool(fingerprint=automation_worker.canonical_frame_hash)
+        await spool_file_response(httpx.Response(200, json=self.DOCUMENT), spool, stream=False)
+        expected = automation_worker.extract_top_level_frames(self.DOCUMENT["document"])
+        frames = [spool[i] for i in range(len(spool))]
+        spool.close()
+
+        assert frames == expected
+        assert [e["id"] for e in spool.entries] == ["1:1", "2:1"]
+        assert spool.entries[0]["fingerprint"] == automation_worker.canonical_frame_hash(expected[0])
+        assert spool.meta == {"name": "Big File", "lastModified": "2024-01-01T00:00:00Z", "version": "123"}
+
+    @pytest.mark.asyncio
+    async def test_stream_file_frames_parses_incrementally(self):
+        """With ijson the body is parsed chunk by chunk; only top-level FRAMEs are kept."""
+        pytest.importorskip("ijson")
+        import httpx
+        from mcp_core.services.figma_client import FigmaClient
+
+        body = json.dumps(self.DOCUMENT).encode()
+        chunks_read = []
+
+        async def chunked():
+            for i in range(0, len(body), 64):
+                chunks_read.append(i)
+                yield body[i:i + 64]
+
+        ctx = MagicMock(figma=FigmaClient(transport=httpx.MockTransport(lambda request: httpx.Response(200, content=chunked()))))
+        with patch.dict(os.environ, {"FIGMA_ACCESS_TOKEN": "fake-token"}):
+            spool = await figma.stream_file_frames(ctx, "fileA", depth=5)
+        await ctx.figma.aclose()
+        frames = [spool[i] for i in range(len(spool))]
+        spool.close()
+
+        assert len(chunks_read) > 5
+        assert [f["id"] for f in frames] == ["1:1", "2:1"]
+        assert frames[0]["opacity"] == 0.5 and frames[0]["children"][0]["characters"] == "Hi"
+        assert spool.meta["version"] == "123" and spool.meta["name"] == "Big File"
+
+    def test_node_ids_are_chunked_under_url_limit(self):
+        """Long id lists are split so no /nodes URL exceeds the limit."""
+        from mcp_core.services.node_loader import chunk_node_ids, nodes_url
+        from urllib.parse import quote
+
+        node_ids = [f"{i}:{i * 7}" for i in range(200)]
+        chunks = chunk_node_ids("fileKey123", node_ids, 5, max_url_chars=300)
+
+        assert len(chunks) > 1
+        assert [node_id for chunk in chunks for node_id in chunk] == node_ids
+        assert all(len(quote(nodes_url("fileKey123", chunk, 5), safe="/?=&,")) <= 300 for chunk in chunks)
 
     @pytest.mark.asyncio
     async def test_fetch_figma_pattern_no_token(self):
@@ -318,6 +1582,108 @@ class TestFigmaAPI:
         assert "events" in result
         assert "count" in result
 
+    @pytest.mark.asyncio
+    async def test_get_file_meta_uses_versions_and_etag(self):
+        """Verify change detection hits the versions endpoint and revalidates with ETag."""
+        import httpx
+
+        requests_seen = []
+        current = {"id": "123", "name": "Design File"}
+
+        def handler(request):
+            requests_seen.append(request)
+            version = current["id"]
+            etag = f'"v{version}"'
+            if request.url.path.endswith("/versions"):
+                if request.headers.get("If-None-Match") == etag:
+                    return httpx.Response(304)
+                return httpx.Response(200, headers={"ETag": etag}, json={
+                    "versions": [{"id": current["id"], "created_at": "2024-01-01T00:00:00Z"}]
+                })
+            return httpx.Response(200, json={"name": current["name"], "thumbnailUrl": "thumb"})
+
+        from mcp_core.services.figma_client import FigmaClient
+
+        client = FigmaClient(transport=httpx.MockTransport(handler))
+        with patch.object(figma, "_default_client", client), \
+             patch.dict(figma._meta_cache, clear=True), \
+             patch.dict(figma._file_info_cache, clear=True), \
+             patch.dict(os.environ, {"FIGMA_ACCESS_TOKEN": "fake-token"}):
+            first = await figma.get_file_meta(None, "key123")
+            second = await figma.get_file_meta(None, "key123")
+            # Renamed and edited: the new version brings the new name with it
+            current.update(id="124", name="Design File v2")
+            third = await figma.get_file_meta(None, "key123")
+        await client.aclose()
+
+        assert first["version"] == "123" and first["name"] == "Design File"
+        assert second["version"] == "123" and second["not_modified"] is True
+        assert third["version"] == "124" and third["name"] == "Design File v2"
+        # Name fetched once per version, not on a 304; no request downloads the document itself
+        assert [r.url.path for r in requests_seen].count("/v1/files/key123") == 2
+        assert all("depth=1" in str(r.url) or r.url.path.endswith("/versions") for r in requests_seen)
+
+    @pytest.mark.asyncio
+    async def test_rate_limiter_budget_is_shared_across_processes(self, tmp_path):
+        """Two limiters on the same database (two processes) draw from one bucket."""
+        from mcp_core.services.rate_limiter import Budget, RateLimiter, figma_bucket
+
+        budgets = {"nodes": Budget(per_minute=600, burst=2)}
+        worker_a = RateLimiter(tmp_path / "rate.db", budgets)
+        worker_b = RateLimiter(tmp_path / "rate.db", budgets)
+
+        assert await worker_a.acquire("nodes") == 0
+        assert await worker_a.acquire("nodes") == 0
+        # Bucket empty: the other process waits for the refill (10 tokens/s)
+        assert await worker_b.acquire("nodes") > 0.05
+        # Unbudgeted endpoints are never throttled
+        assert await worker_b.acquire("files") == 0
+
+        assert figma_bucket("/v1/files/key/nodes?ids=1:2") == "nodes"
+        assert figma_bucket("/v1/files/key?depth=1") == "files"
+        assert figma_bucket("/v1/images/key?ids=1:2") == "images"
+        assert figma_bucket("https://s3.example.com/render.png") is None
+
+    @pytest.mark.asyncio
+    async def test_429_pauses_endpoint_for_every_process(self, tmp_path):
+        """A 429 pauses that endpoint's bucket for Retry-After; the retry waits for the pause, not a local sleep."""
+        import httpx
+        from mcp_core.services.figma_client import FigmaClient
+        from mcp_core.services.rate_limiter import Budget, RateLimiter
+
+        budgets = {"files": Budget(per_minute=6000, burst=5), "images": Budget(per_minute=6000, burst=5)}
+        calls = []
+
+        def handler(request):
+            calls.append(time.monotonic())
+            if len(calls) == 1:
+                return httpx.Response(429, headers={"Retry-After": "1"})
+            return httpx.Response(200, json={"version": "1"})
+
+        limiter = RateLimiter(tmp_path / "rate.db", budgets)
+        other_process = RateLimiter(tmp_path / "rate.db", budgets)
+        client = FigmaClient(transport=httpx.MockTransport(handler), limiter=limiter)
+        resp = await client.get("/v1/files/key123?depth=1")
+        await client.aclose()
+
+        assert resp.status_code == 200
+        assert calls[1] - calls[0] >= 0.9
+        assert limiter.pauses == 1
+        # The pause has ended, the other process's files bucket works again; images never paused
+        assert other_process._next_wait("images") == 0
+        other_process.pause_sync("files", 30)
+        assert other_process._next_wait("files") > 25
+        assert limiter._next_wait("files") > 25
+
+    def test_adaptive_poll_interval(self):
+        import automation_worker
+
+        interval = automation_worker.FIGMA_POLL_INTERVAL
+        for _ in range(20):
+            interval = automation_worker.next_poll_interval(interval, changed=False)
+        assert interval == automation_worker.FIGMA_POLL_MAX_INTERVAL
+        assert automation_worker.next_poll_interval(interval, changed=True) == automation_worker.FIGMA_POLL_INTERVAL
+
 
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
@@ -17,19 +17,21 @@ import json
 import asyncio
 # AIOSQLite database ke sath asynchronously kaam krne ke liye
 import aiosqlite
-# Datetime module time aur dates handle krne ke liye
-from datetime import datetime, timezone
 # Pathlib file paths ko easily handle krne ke liye
 from pathlib import Path
 # Typing hints code ko more readable banane ke liye
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Callable, List, Set
+# Lifespan hook server band hone par writer ko flush krne ke liye
+from contextlib import asynccontextmanager
 
 # FastAPI framework web server banane ke liye
 from fastapi import FastAPI, Request, HTTPException, Header
 # JSONResponse custom JSON responses return krne ke liye
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 # Dotenv environment variables load krne ke liye (.env file se)
 from dotenv import load_dotenv
+# Shared upsert query aur row builder (worker bhi yehi use karta ha)
+from mcp_core.services.job_queue import DELIVERIES_SCHEMA_SQL, build_event_row, queue_depths, upsert_event
 
 # Database file ka path set kr rha ha (current file ke parent folder me events.db)
 DB_PATH = Path(__file__).parent / "events.db"
@@ -44,8 +46,15 @@ logging.basicConfig(
 # Logger object bana rha ha "figma-webhook" naam se
 logger = logging.getLogger("figma-webhook")
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Flush the event writer when the server shuts down."""
+    yield
+    # Shutdown par queue me bache events commit kr rha ha
+    await event_writer.close()
+
 # FastAPI app create kr rha ha "Figma Webhook Receiver" naam se
-app = FastAPI(title="Figma Webhook Receiver")
+app = FastAPI(title="Figma Webhook Receiver", lifespan=lifespan)
 
 def verify_signature(payload: bytes, signature: str) -> bool:
     """Verify Figma webhook signature using HMAC-SHA256."""
@@ -72,48 +81,223 @@ def verify_signature(payload: bytes, signature: str) -> bool:
     Agar match ho jaye to return True (Valid), warna False (Invalid).
     """
 
-async def save_event(event: Dict[str, Any]) -> int:
-    """Save webhook event to database asynchronously."""
-    # Database connection open kr rha ha asynchronously
-    async with aiosqlite.connect(DB_PATH) as db:
+# Group commit ki settings: ek batch me kitne events aur kitna intezar (milliseconds)
+WRITER_BATCH_MAX = int(os.getenv("WEBHOOK_WRITER_BATCH_MAX", "64"))
+WRITER_BATCH_WINDOW_MS = float(os.getenv("WEBHOOK_WRITER_BATCH_WINDOW_MS", "5"))
+
+# SSE stream ki settings: keepalive comment ka interval aur har subscriber ki queue ka size
+STREAM_KEEPALIVE_SECONDS = float(os.getenv("EVENT_STREAM_KEEPALIVE_SECONDS", "15"))
+STREAM_SUBSCRIBER_BUFFER = 256
+
+
+class EventBroadcaster:
+    """Fan-out of committed event ids to /events/stream subscribers."""
+
+    def __init__(self, buffer_size: int = STREAM_SUBSCRIBER_BUFFER):
+        self.buffer_size = buffer_size
+        self._subscribers: Set[asyncio.Queue] = set()
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.buffer_size)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        self._subscribers.discard(queue)
+
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+    def publish(self, notices: List[Dict[str, Any]]) -> None:
+        for queue in list(self._subscribers):
+            for notice in notices:
+                if queue.full():
+                    # Slow subscriber: purana notice gira do, ye sirf wake-up signal hain (data DB me safe ha)
+                    queue.get_nowait()
+                queue.put_nowait(notice)
+
+    """
+    SUMMARY (Roman Urdu):
+    Jab bhi koi event database me commit hota ha, ye class us ki id saare connected workers ko bhej deti ha.
+    Har worker (subscriber) ki apni queue hoti ha. Agar koi worker slow ho to purane notices gira diye jate hain,
+    kyun ke asal data to database me ha - ye sirf "uth jao, naya kaam aya ha" ka signal ha.
+    """
+
+
+class EventWriter:
+    """
+    Long-lived, group-committing writer for the events table.
+
+    A single background task owns one WAL connection. Handlers put rows on an
+    asyncio queue and await a future; the task drains the queue in small groups
+    (bounded by WRITER_BATCH_MAX rows or WRITER_BATCH_WINDOW_MS) and commits
+    each group with one fsync.
+    """
+
+    def __init__(
+        self,
+        db_path: Path,
+        batch_max: int = WRITER_BATCH_MAX,
+        batch_window_ms: float = WRITER_BATCH_WINDOW_MS,
+        on_commit: Optional[Callable[[List[Dict[str, Any]]], None]] = None
+    ):
+        self.db_path = db_path
+        self.on_commit = on_commit
+        self.batch_max = max(1, batch_max)
+        self.batch_window = max(0.0, batch_window_ms) / 1000
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._db: Optional[aiosqlite.Connection] = None
+
+    def _ensure_started(self) -> None:
+        # Background task sirf ek dafa start hota ha (ya jab event loop badal jaye, jaise tests me)
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._db = None
+            self._task = loop.create_task(self._run(), name="event-writer")
+
+    async def submit(self, event: Dict[str, Any]) -> int:
+        """Queue an event for the next group commit and wait for its row id (-1 on duplicate)."""
+        self._ensure_started()
+        future = self._loop.create_future()
+        await self._queue.put((build_event_row(event), future))
+        return await future
+
+    async def close(self) -> None:
+        """Flush queued events and close the connection."""
+        if self._task is None or self._task.done():
+            return
+        await self._queue.put(None)
+        await self._task
+
+    async def _connect(self) -> aiosqlite.Connection:
+        db = await aiosqlite.connect(self.db_path)
+        # WAL + NORMAL sync: readers block nahi hote aur har commit pe full fsync nahi hota
+        await db.execute("PRAGMA journal_mode=WAL")
+        await db.execute("PRAGMA synchronous=NORMAL")
+        await db.execute("PRAGMA busy_timeout=5000")
+        await db.execute(DELIVERIES_SCHEMA_SQL)
+        await db.commit()
+        return db
+
+    async def _next_batch(self) -> tuple[list, bool]:
+        """Wait for one item, then keep collecting until the count or time bound is hit."""
+        first = await self._queue.get()
+        if first is None:
+            return [], True
+
+        batch = [first]
+        deadline = self._loop.time() + self.batch_window
+        while len(batch) < self.batch_max:
+            remaining = deadline - self._loop.time()
+            try:
+                item = self._queue.get_nowait() if remaining <= 0 else await asyncio.wait_for(self._queue.get(), remaining)
+            except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    async def _run(self) -> None:
+        stop = False
         try:
-            # Webhook ID nikal rha ha, agar nahi ha to "unknown" use kr rha ha
-            webhook_id = event.get("webhook_id", "unknown")
-            # Timestamp nikal rha ha, agar nahi ha to current time use kr rha ha
-            timestamp = event.get("timestamp", datetime.now(timezone.utc).isoformat())
-            # Ek unique ID bana rha ha webhook_id aur timestamp ko mila kar
-            unique_event_id = f"{webhook_id}_{timestamp}"
-            
-            # SQL query chala rha ha data insert krne ke liye
-            await db.execute("""
-                INSERT INTO events (event_id, event_type, file_key, file_name, node_id, timestamp, payload)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            """, (
-                unique_event_id,                     # Unique ID
-                event.get("event_type", "FILE_UPDATE"), # Event type (default: FILE_UPDATE)
-                event.get("file_key"),               # Figma file key
-                event.get("file_name"),              # File ka naam
-                event.get("node_id"),                # Node ID (agar ha to)
-                timestamp,                           # Time jab event aya
-                json.dumps(event)                    # Poora event JSON format me
-            ))
-            # Changes ko database me pakka (save) kr rha ha
-            await db.commit()
-            
-            # Last inserted ID nikal rha ha taake return kar sake
-            cursor = await db.execute("SELECT last_insert_rowid()")
-            row = await cursor.fetchone() # Pehli row fetch kr rha ha
-            event_id = row[0]             # ID nikal rha ha
-            return event_id               # ID wapis bhej rha ha
-        except aiosqlite.IntegrityError:
-            # Agar event pehle se exist krta ha (duplicate) to error handle kr rha ha
-            # -1 return kr raha ha ye batane ke liye ke duplicate ha
-            return -1
+            while not stop:
+                batch, stop = await self._next_batch()
+                if batch:
+                    await self._commit_batch(batch)
+        finally:
+            if self._db is not None:
+                await self._db.close()
+                self._db = None
+
+    async def _commit_batch(self, batch: list) -> None:
+        try:
+            if self._db is None:
+                self._db = await self._connect()
+            ids = []
+            for row, _ in batch:
+                ids.append(await upsert_event(self._db, row))
+            # Poore group ke liye sirf ek commit (ek fsync)
+            await self._db.commit()
+        except Exception as e:
+            logger.warning(f"Group commit of {len(batch)} events failed ({e}); retrying one by one")
+            await self._commit_individually(batch)
+            return
+
+        for (_, future), event_id in zip(batch, ids):
+            if not future.done():
+                future.set_result(event_id)
+        self._notify(batch, ids)
+
+    def _notify(self, batch: list, ids: list) -> None:
+        # Commit ke baad naye/updated event ids subscribers ko bhej rha ha (duplicates skip)
+        if self.on_commit is None:
+            return
+        notices = [
+            {"id": event_id, "event_type": row[1], "file_key": row[2], "node_id": row[4]}
+            for (row, _), event_id in zip(batch, ids)
+            if event_id != -1
+        ]
+        if notices:
+            try:
+                self.on_commit(notices)
+            except Exception as e:
+                logger.warning(f"Commit notification failed: {e}")
+
+    async def _commit_individually(self, batch: list) -> None:
+        # Ek kharab row poore batch ko fail na kare, is liye har row alag commit hoti ha
+        ids = []
+        for row, future in batch:
+            try:
+                if self._db is None:
+                    self._db = await self._connect()
+                else:
+                    await self._db.rollback()
+                result = await upsert_event(self._db, row)
+                await self._db.commit()
+            except aiosqlite.IntegrityError:
+                # Constraint fail (jaise missing file_key) ko bhi duplicate ki tarah -1 report kr rha ha
+                # Delivery id bhi rollback ho rhi ha, warna agli commit ke sath likh jati
+                await self._db.rollback()
+                result = -1
+            except Exception as e:
+                ids.append(-1)
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            ids.append(result)
+            if not future.done():
+                future.set_result(result)
+        self._notify(batch, ids)
+
+    """
+    SUMMARY (Roman Urdu):
+    Pehle har webhook ke liye naya database connection khulta tha, ek row insert hoti thi aur commit (fsync) hota tha.
+    Ab ek hi background task ek connection rakhta ha. Handlers event queue me daalte hain aur jawab (row id) ka intezar karte hain.
+    Task chand milliseconds me aane walay saare events ko ek sath ek commit me likh deta ha, is se burst me speed bohat barh jati ha.
+    """
+
+
+# Poori app ke liye ek hi broadcaster aur ek hi writer
+event_broadcaster = EventBroadcaster()
+event_writer = EventWriter(DB_PATH, on_commit=event_broadcaster.publish)
+
+
+async def save_event(event: Dict[str, Any]) -> int:
+    """Save webhook event through the shared group-committing writer."""
+    # Event writer ko de rha ha; ye row id ya duplicate ke liye -1 wapis deta ha
+    return await event_writer.submit(event)
 
     """
     SUMMARY (Roman Urdu):
     Ye function Figma se aane walay event ko database me save karta ha.
-    Sab se pehle ye ek unique ID banata ha, phir SQL query chala kar data insert karta ha.
+    Asal kaam EventWriter karta ha jo kai events ko ek sath commit karta ha.
+    Agar same node ka pending event pehle se ho, to usi row ko update kr deta ha (coalescing) aur wohi id wapis deta ha.
     Agar same event dobara aa jaye (Duplicate), to ye error nahi deta balkay -1 return kar deta ha taake pata chal jaye ke ye duplicate ha.
     """
 
@@ -322,6 +506,61 @@ async def list_events(status: str = "pending", limit: int = 10):
     Matlab: Aap check kar sakte hain ke Figma se data aya aur save hua ya nahi.
     """
 
+# Har lane (targeted / webhook / poll) ki queue depth dekhne ke liye endpoint
+@app.get("/queue")
+async def queue_status():
+    """Pending / due / processing counts per scheduling lane."""
+    # Database connect kr rha ha
+    async with aiosqlite.connect(DB_PATH) as db:
+        # Har lane ke counts aur sab se purane due event ki age
+        lanes = await queue_depths(db)
+    return {"lanes": lanes}
+
+    """
+    SUMMARY (Roman Urdu):
+    Worker teen lanes se kaam uthata ha: '!sync' comments (targeted) sab se pehle, phir Figma webhooks,
+    phir poller ke events. Is endpoint se pata chalta ha ke kis lane me kitna kaam ruka hua ha
+    aur sab se purana due event kitni dair se intezar kr rha ha.
+    """
+
+# Worker ke liye push stream (Server-Sent Events)
+@app.get("/events/stream")
+async def stream_events(request: Request):
+    """Stream ids of newly committed events as Server-Sent Events."""
+    # Is client ke liye nayi queue subscribe kr rha ha
+    queue = event_broadcaster.subscribe()
+
+    async def event_source():
+        try:
+            # Client ko batata ha ke connection tootne par 3 second baad reconnect kare
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    notice = await asyncio.wait_for(queue.get(), timeout=STREAM_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    # Idle connection ko zinda rakhne ke liye comment line bhej rha ha
+                    if await request.is_disconnected():
+                        break
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"id: {notice['id']}\nevent: event_saved\ndata: {json.dumps(notice)}\n\n"
+        finally:
+            # Client chala gaya to queue hata rha ha
+            event_broadcaster.unsubscribe(queue)
+
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+    """
+    SUMMARY (Roman Urdu):
+    Pehle worker har 5 second baad database check karta tha (polling), jis se har '!sync' me 5 second tak ki dair hoti thi.
+    Ab worker is endpoint se connected rehta ha. Jaise hi koi event commit hota ha, uski id foran yahan se worker tak
+    pohanch jati ha aur worker usi waqt kaam shuru kr deta ha.
+    """
+
 # Main entry point - agar ye file direct chalayi jaye
 if __name__ == "__main__":
     # Uvicorn server import kr rha ha
@@ -331,6 +570,8 @@ if __name__ == "__main__":
     print(">> Endpoints:")
     print("   POST /figma-webhook - Receive Figma webhooks")
     print("   GET  /events        - List stored events")
+    print("   GET  /events/stream - Push stream of new event ids (SSE)")
+    print("   GET  /queue         - Queue depth per scheduling lane")
     print("   GET  /health        - Health check")
     # Server start kr rha ha port 8000 par
     uvicorn.run(app, host="0.0.0.0", port=8000)